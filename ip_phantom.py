@@ -8,36 +8,2916 @@ For educational and legitimate security testing purposes only.
 import time
 import sys
 import signal
+import base64
+import binascii
+import bisect
 import logging
+import logging.handlers
 import argparse
+import atexit
 import subprocess
 import json
+import math
+import queue
 import random
+import re
+import secrets
 import socket
 import os
-from typing import Optional, Dict, List
+import threading
+import collections
+import contextlib
+import heapq
+import itertools
+import select
+import concurrent.futures
+import http.client
+import importlib.util
+import ipaddress
+import sqlite3
+import ssl
+import urllib.parse
+from typing import Optional, Dict, List, Tuple, Callable
 from datetime import datetime
 
 
-class SafeStreamHandler(logging.StreamHandler):
+def _lazy_import(name: str):
+    """Return module ``name``, executing it only on first attribute access.
+    
+    Keeps modules that only some modes need (asyncio for the run loop,
+    http.server for the metrics endpoint) off the startup path.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+asyncio = _lazy_import('asyncio')
+_lazy_import('http.server')  # Used as http.server
+
+
+class _BatchFlush:
+    """Handler mixin: inside :meth:`batch` records are not flushed one by one."""
+    
+    _batching = False
+    
+    def flush(self):
+        if not self._batching:
+            super().flush()
+    
+    @contextlib.contextmanager
+    def batch(self):
+        """Write records without flushing, then flush once."""
+        self._batching = True
+        try:
+            yield
+        finally:
+            self._batching = False
+            self.flush()
+
+
+class SafeStreamHandler(_BatchFlush, logging.StreamHandler):
     """Stream handler that gracefully handles broken pipe errors."""
     
     def emit(self, record):
         try:
-            super().emit(record)
-            self.flush()
-        except (BrokenPipeError, ConnectionResetError):
-            # Silently ignore broken pipe errors
+            super().emit(record)
+            self.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Silently ignore broken pipe errors
+            pass
+        except Exception:
+            # Let other exceptions bubble up
+            self.handleError(record)
+
+
+class RotatingLogHandler(_BatchFlush, logging.handlers.RotatingFileHandler):
+    """Log file rolled over at ``max_bytes`` and every ``interval`` seconds.
+    
+    At most ``backup_count`` old files are kept, so the log never takes
+    more than ``(backup_count + 1) * max_bytes`` on disk.
+    """
+    
+    def __init__(self, filename: str, max_bytes: int, backup_count: int, interval: float = 0.0):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=max(1, backup_count),
+                         encoding='utf-8', delay=True)
+        self.interval = interval
+        self.rollover_at = None
+        if interval:
+            try:
+                started = os.stat(self.baseFilename).st_mtime
+            except OSError:
+                started = time.time()
+            self.rollover_at = started + interval
+    
+    def shouldRollover(self, record) -> bool:
+        if self.rollover_at is not None and time.time() >= self.rollover_at:
+            return True
+        return super().shouldRollover(record)
+    
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+
+
+class JSONLogFormatter(logging.Formatter):
+    """One JSON object per line: ``ts``, ``level``, ``logger`` and ``message``."""
+    
+    def format(self, record) -> str:
+        entry = {'ts': round(record.created, 3), 'level': record.levelname,
+                 'logger': record.name, 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class LogWriter:
+    """Background thread that writes queued log records in batches.
+    
+    Records are formatted and written (to the console and the log file)
+    on this thread; every handler is flushed once per batch instead of
+    once per record.
+    """
+    
+    def __init__(self, handlers: List[logging.Handler], maxsize: int = 10000,
+                 batch_size: int = 256):
+        self.queue = queue.Queue(maxsize)
+        self.handlers = list(handlers)
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+    
+    def stop(self, timeout: float = 5.0):
+        """Write what is queued, stop the thread and close the handlers."""
+        if self._thread is None:
+            return
+        thread, self._thread = self._thread, None
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(timeout)
+        with self._lock:
+            for handler in self.handlers:
+                handler.close()
+    
+    def replace(self, old: Optional[logging.Handler], new: Optional[logging.Handler]):
+        """Swap one handler for another (either may be None)."""
+        with self._lock:
+            self.handlers = [handler for handler in self.handlers if handler is not old]
+            if new is not None:
+                self.handlers.append(new)
+        if old is not None:
+            old.close()
+    
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self._lock, contextlib.ExitStack() as stack:
+                for handler in self.handlers:
+                    if isinstance(handler, _BatchFlush):
+                        stack.enter_context(handler.batch())
+                for record in batch:
+                    if record is None:
+                        return
+                    for handler in self.handlers:
+                        if record.levelno >= handler.level:
+                            handler.handle(record)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to a :class:`LogWriter` without ever blocking.
+    
+    If the writer falls ``maxsize`` records behind, new records are
+    dropped and counted rather than holding up the caller.
+    """
+    
+    def __init__(self, writer: LogWriter):
+        super().__init__(writer.queue)
+        self.writer = writer
+        self.dropped = 0
+    
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TorControlError(Exception):
+    """Raised when the Tor control port rejects a command or goes away."""
+
+
+class ControlReply:
+    """A single parsed reply from the Tor control port."""
+
+    def __init__(self, status: str, lines: List[str]):
+        self.status = status
+        self.lines = lines
+
+    @property
+    def ok(self) -> bool:
+        return self.status.startswith('2')
+
+    def values(self) -> Dict[str, str]:
+        """Return the key=value pairs of a GETINFO-style reply."""
+        values = {}
+        for line in self.lines:
+            key, sep, value = line.partition('=')
+            if sep:
+                values[key] = value[1:] if value.startswith('\n') else value
+        return values
+
+    def __str__(self):
+        return f"{self.status} {' | '.join(self.lines)}"
+
+
+class ControlReplyParser:
+    """Incremental parser turning control-port lines into replies.
+
+    Handles ``250-`` mid lines, ``250+`` data blocks (with dot-unstuffing)
+    and the final ``250 `` line. Shared by the blocking and asyncio clients.
+    """
+
+    def __init__(self):
+        self._lines = []
+        self._data = None
+        self._data_head = ''
+
+    def feed(self, line: str) -> Optional[ControlReply]:
+        """Consume one line; return the reply once it is complete."""
+        if self._data is not None:
+            if line == '.':
+                text = self._data_head
+                if self._data:
+                    text += '\n' + '\n'.join(self._data)
+                self._lines.append(text)
+                self._data = None
+            else:
+                self._data.append(line[1:] if line.startswith('..') else line)
+            return None
+        if len(line) < 4:
+            raise TorControlError(f"Malformed control reply line: {line!r}")
+        status, separator, text = line[:3], line[3], line[4:]
+        if separator == '+':
+            self._data_head, self._data = text, []
+            return None
+        self._lines.append(text)
+        if separator != ' ':
+            return None
+        reply, self._lines = ControlReply(status, self._lines), []
+        return reply
+
+
+def control_auth_command(password: Optional[str], cookie_path: Optional[str]) -> str:
+    """Build the AUTHENTICATE command (password, then cookie, then none)."""
+    if password is not None:
+        escaped = password.replace('\\', '\\\\').replace('"', '\\"')
+        return f'AUTHENTICATE "{escaped}"'
+    if cookie_path and os.path.exists(cookie_path):
+        with open(cookie_path, 'rb') as f:
+            return f'AUTHENTICATE {f.read().hex()}'
+    return 'AUTHENTICATE'
+
+
+class TorController:
+    """Persistent, pipelined client for the Tor control protocol.
+
+    The connection is opened and authenticated once and then reused for every
+    command. Replies are parsed according to the control-spec framing
+    (``250-`` mid lines, ``250+`` data blocks and the final ``250 `` line), so
+    replies split across TCP segments are handled correctly. If the
+    connection drops, the next command reconnects and re-authenticates.
+
+    Asynchronous events (``650`` replies) enabled with :meth:`set_events` are
+    queued and consumed with :meth:`wait_for_event`.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9051,
+                 cookie_path: str = '/tmp/tor-control-cookie',
+                 password: Optional[str] = None, timeout: float = 10.0):
+        self.host = host
+        self.port = port
+        self.cookie_path = cookie_path
+        self.password = password
+        self.timeout = timeout
+        self._sock = None
+        self._buffer = b''
+        self._parser = ControlReplyParser()
+        self._lock = threading.RLock()
+        self.connects = 0
+        self.event_types = []
+        self.events = collections.deque(maxlen=1000)
+
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    def connect(self):
+        """Open the control connection and authenticate."""
+        with self._lock:
+            self.close()
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sock = sock
+            self._buffer = b''
+            commands = [self._auth_command()]
+            if self.event_types:
+                commands.append('SETEVENTS ' + ' '.join(self.event_types))
+            try:
+                replies = self._roundtrip(commands)
+            except Exception:
+                self.close()
+                raise
+            if not replies[0].ok:
+                self.close()
+                raise TorControlError(f"Tor authentication failed: {replies[0]}")
+            self.connects += 1
+
+    def _auth_command(self) -> str:
+        return control_auth_command(self.password, self.cookie_path)
+
+    def close(self):
+        """Close the control connection (it is reopened on the next command)."""
+        with self._lock:
+            if self._sock is not None:
+                try:
+                    self._sock.close()
+                except OSError:
+                    pass
+            self._sock = None
+            self._buffer = b''
+            self._parser = ControlReplyParser()
+
+    def execute_many(self, commands: List[str]) -> List[ControlReply]:
+        """Pipeline several commands and return their replies in order."""
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if self._sock is None:
+                        self.connect()
+                    return self._roundtrip(commands)
+                except TorControlError:
+                    self.close()
+                    raise
+                except OSError:
+                    # Stale connection (e.g. Tor restarted): reconnect once
+                    self.close()
+                    if attempt == 2:
+                        raise
+
+    def execute(self, command: str) -> ControlReply:
+        """Send one command and return its reply."""
+        return self.execute_many([command])[0]
+
+    def signal(self, name: str) -> bool:
+        """Send ``SIGNAL <name>`` and report whether Tor accepted it."""
+        return self.execute(f'SIGNAL {name}').ok
+
+    def get_info(self, *keys: str) -> Dict[str, str]:
+        """Run ``GETINFO`` for the given keys and return their values."""
+        reply = self.execute('GETINFO ' + ' '.join(keys))
+        if not reply.ok:
+            raise TorControlError(f"GETINFO failed: {reply}")
+        return reply.values()
+
+    def set_events(self, *event_types: str):
+        """Subscribe to asynchronous events (kept across reconnects)."""
+        with self._lock:
+            self.event_types = list(event_types)
+            reply = self.execute('SETEVENTS ' + ' '.join(self.event_types))
+            if not reply.ok:
+                self.event_types = []
+                raise TorControlError(f"SETEVENTS failed: {reply}")
+
+    def wait_for_event(self, predicate: Callable[[ControlReply], bool],
+                       timeout: float) -> Optional[ControlReply]:
+        """Return the first queued or incoming event matching ``predicate``.
+
+        Events that do not match are discarded. Returns ``None`` on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while True:
+                while self.events:
+                    event = self.events.popleft()
+                    if predicate(event):
+                        return event
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._sock is None:
+                    return None
+                if b'\r\n' not in self._buffer:
+                    # Only start parsing once data has arrived, so a timeout
+                    # never leaves a half-read reply behind
+                    readable, _, _ = select.select([self._sock], [], [], remaining)
+                    if not readable:
+                        return None
+                try:
+                    reply = self._read_reply()
+                except OSError:
+                    self.close()
+                    return None
+                if reply.status == '650':
+                    self.events.append(reply)
+
+    def clear_events(self):
+        """Drop queued events."""
+        with self._lock:
+            self.events.clear()
+
+    def _roundtrip(self, commands: List[str]) -> List[ControlReply]:
+        payload = ''.join(f'{command}\r\n' for command in commands)
+        self._sock.sendall(payload.encode())
+        replies = []
+        while len(replies) < len(commands):
+            reply = self._read_reply()
+            if reply.status == '650':
+                self.events.append(reply)
+                continue
+            replies.append(reply)
+        return replies
+
+    def _read_line(self) -> str:
+        while True:
+            index = self._buffer.find(b'\r\n')
+            if index >= 0:
+                line = self._buffer[:index]
+                self._buffer = self._buffer[index + 2:]
+                return line.decode('utf-8', 'replace')
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise OSError("Tor control connection closed")
+            self._buffer += chunk
+
+    def _read_reply(self) -> ControlReply:
+        while True:
+            reply = self._parser.feed(self._read_line())
+            if reply is not None:
+                return reply
+
+
+def parse_circuit(line: str) -> Dict:
+    """Parse a circuit description from a CIRC event or ``circuit-status``.
+
+    Accepts ``[CIRC] <id> <status> [path] [KEY=VALUE ...]`` and returns a
+    dict with ``id``, ``status``, ``path`` (list of ``$fingerprint~nick``
+    hops) and ``purpose``.
+    """
+    words = line.split()
+    if words and words[0] == 'CIRC':
+        words = words[1:]
+    circuit = {'id': 0, 'status': '', 'path': [], 'purpose': 'GENERAL'}
+    if len(words) < 2 or not words[0].isdigit():
+        return circuit
+    circuit['id'] = int(words[0])
+    circuit['status'] = words[1]
+    for word in words[2:]:
+        key, sep, value = word.partition('=')
+        if sep:
+            if key == 'PURPOSE':
+                circuit['purpose'] = value
+        elif not circuit['path']:
+            circuit['path'] = word.split(',')
+    return circuit
+
+
+def hop_fingerprint(hop: str) -> str:
+    """Relay fingerprint of a circuit hop (``$fingerprint~nick`` or ``=nick``)."""
+    return hop.lstrip('$').partition('~')[0].partition('=')[0].upper()
+
+
+def address_prefix(address: str) -> str:
+    """The /16 of an IPv4 address (``a.b``), used to keep exits apart."""
+    return '.'.join(address.split('.')[:2])
+
+
+class Relay:
+    """One router status entry from the consensus."""
+
+    __slots__ = ('fingerprint', 'nickname', 'address', 'or_port', 'flags',
+                 'bandwidth', 'policy', 'country')
+
+    def __init__(self, fingerprint: str, nickname: str, address: str, or_port: int,
+                 flags: frozenset = frozenset(), bandwidth: int = 0,
+                 policy: Optional[str] = None, country: Optional[str] = None):
+        self.fingerprint = fingerprint
+        self.nickname = nickname
+        self.address = address
+        self.or_port = or_port
+        self.flags = flags
+        self.bandwidth = bandwidth
+        self.policy = policy
+        self.country = country
+
+    @property
+    def prefix(self) -> str:
+        return address_prefix(self.address)
+
+    @property
+    def is_exit(self) -> bool:
+        return 'Exit' in self.flags and 'BadExit' not in self.flags and 'Running' in self.flags
+
+    def allows(self, port: int) -> bool:
+        """Whether the exit policy summary permits ``port``.
+
+        Without a summary (microdescriptor consensus) the Exit flag, which
+        requires at least two of ports 80, 443 and 6667, stands in for it.
+        """
+        if not self.policy:
+            return self.is_exit
+        action, _, ranges = self.policy.partition(' ')
+        listed = False
+        for item in ranges.split(','):
+            low, _, high = item.partition('-')
+            try:
+                if int(low) <= port <= int(high or low):
+                    listed = True
+                    break
+            except ValueError:
+                continue
+        return listed == (action == 'accept')
+
+    def to_list(self) -> List:
+        return [self.fingerprint, self.nickname, self.address, self.or_port,
+                ' '.join(sorted(self.flags)), self.bandwidth, self.policy, self.country]
+
+    @classmethod
+    def from_list(cls, values: List) -> 'Relay':
+        fingerprint, nickname, address, or_port, flags, bandwidth, policy, country = values
+        return cls(fingerprint, nickname, address, or_port, frozenset(flags.split()),
+                   bandwidth, policy, country)
+
+
+def parse_network_status(text: str) -> List[Relay]:
+    """Parse router status entries (``GETINFO ns/all``).
+
+    Handles both consensus flavors: full ``r`` lines carry a descriptor
+    digest that microdescriptor ``r`` lines lack.
+    """
+    relays = []
+    relay = None
+    for line in text.splitlines():
+        keyword, _, rest = line.partition(' ')
+        if keyword == 'r':
+            words = rest.split()
+            if len(words) < 7:
+                relay = None
+                continue
+            # nickname identity [digest] date time address orport dirport
+            address, or_port = words[-3], words[-2]
+            try:
+                fingerprint = base64.b64decode(words[1] + '=' * (-len(words[1]) % 4)).hex().upper()
+                relay = Relay(fingerprint, words[0], address, int(or_port))
+            except (ValueError, binascii.Error):
+                relay = None
+                continue
+            relays.append(relay)
+        elif relay is None:
+            continue
+        elif keyword == 's':
+            relay.flags = frozenset(rest.split())
+        elif keyword == 'w':
+            for item in rest.split():
+                key, _, value = item.partition('=')
+                if key == 'Bandwidth' and value.isdigit():
+                    relay.bandwidth = int(value)
+        elif keyword == 'p':
+            relay.policy = rest.strip()
+    return relays
+
+
+class RelayDirectory:
+    """Exit relays from Tor's consensus, indexed for choosing diverse exits.
+
+    The consensus is fetched over the control port only when its
+    ``valid-after`` changes and is cached on disk. Refreshes run in a
+    background thread and swap in a new index, so rotations only ever pick
+    from a ready snapshot. Countries come from Tor's GeoIP database
+    (``ip-to-country``) and are looked up only for addresses not seen before.
+
+    Exits are bucketed per country when indexing; with ``countries`` the
+    default bucket only holds exits in those countries.
+    """
+
+    def __init__(self, controller: TorController, cache_path: Optional[str] = None,
+                 port: int = 443, check_interval: float = 60.0, countries: List[str] = ()):
+        self.controller = controller
+        self.cache_path = cache_path
+        self.port = port
+        self.check_interval = check_interval
+        self.countries = frozenset(countries)
+        self.valid_after = None
+        self.relays = {}
+        self.exits = []
+        self.exit_addresses = frozenset()
+        self.by_country = {}
+        self.by_prefix = {}
+        self._buckets = {}
+        self._last_check = -float('inf')
+        self._refreshing = threading.Lock()
+        self._load_cache()
+
+    def __len__(self) -> int:
+        return len(self.exits)
+
+    def _load_cache(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+            relays = [Relay.from_list(values) for values in cache['relays']]
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        self._index(relays)
+        self.valid_after = cache.get('valid_after')
+
+    def _save_cache(self):
+        if not self.cache_path:
+            return
+        temp_path = f'{self.cache_path}.tmp'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump({'valid_after': self.valid_after,
+                           'relays': [relay.to_list() for relay in self.relays.values()]}, f)
+            os.replace(temp_path, self.cache_path)
+        except OSError:
+            pass  # The cache is only an optimization
+
+    def refresh_in_background(self):
+        """Check for a new consensus (at most every ``check_interval`` s)."""
+        if time.monotonic() - self._last_check < self.check_interval or self._refreshing.locked():
+            return
+        threading.Thread(target=self.refresh, name='relay-directory', daemon=True).start()
+
+    def refresh(self) -> bool:
+        """Fetch and index the consensus if a new one arrived. True if updated."""
+        if not self._refreshing.acquire(blocking=False):
+            return False
+        try:
+            self._last_check = time.monotonic()
+            valid_after = self.controller.get_info('consensus/valid-after').get('consensus/valid-after')
+            if valid_after and valid_after == self.valid_after and self.exits:
+                return False
+            relays = parse_network_status(self.controller.get_info('ns/all').get('ns/all', ''))
+            self._fill_countries(relays)
+            self._index(relays)
+            self.valid_after = valid_after
+            self._save_cache()
+            return True
+        except (TorControlError, OSError):
+            return False
+        finally:
+            self._refreshing.release()
+
+    def _fill_countries(self, relays: List[Relay], batch: int = 200):
+        known = {relay.address: relay.country for relay in self.relays.values() if relay.country}
+        missing = []
+        for relay in relays:
+            relay.country = known.get(relay.address)
+            if relay.country is None and relay.is_exit:
+                missing.append(relay)
+        for start in range(0, len(missing), batch):
+            chunk = missing[start:start + batch]
+            try:
+                countries = self.controller.get_info(
+                    *(f'ip-to-country/{relay.address}' for relay in chunk))
+            except TorControlError:
+                return  # No GeoIP database
+            for relay in chunk:
+                country = countries.get(f'ip-to-country/{relay.address}')
+                if country and country != '??':
+                    relay.country = country.lower()
+
+    def _index(self, relays: List[Relay]):
+        exits = [relay for relay in relays if relay.is_exit and relay.allows(self.port)]
+        by_country = {}
+        by_prefix = {}
+        for relay in exits:
+            by_country.setdefault(relay.country, []).append(relay)
+            by_prefix.setdefault(relay.prefix, []).append(relay)
+        allowed = [relay for relay in exits if relay.country in self.countries] if self.countries else exits
+        # Bucket -> (relays, cumulative bandwidth) for weighted picks by bisection
+        buckets = {country: (bucket, list(itertools.accumulate(max(r.bandwidth, 1) for r in bucket)))
+                   for country, bucket in by_country.items() if country}
+        buckets[None] = (allowed, list(itertools.accumulate(max(r.bandwidth, 1) for r in allowed)))
+        # Swap in the new snapshot at once; readers never see a partial index
+        self.relays, self.exits = {relay.fingerprint: relay for relay in relays}, exits
+        self.exit_addresses = frozenset(relay.address for relay in exits)
+        self.by_country, self.by_prefix, self._buckets = by_country, by_prefix, buckets
+
+    def address_of(self, hop: str) -> Optional[str]:
+        """OR address of a circuit hop (``$fingerprint~nick``), None if unknown."""
+        relay = self.relays.get(hop_fingerprint(hop))
+        return relay.address if relay else None
+
+    def has_exits(self, country: Optional[str] = None) -> bool:
+        """Whether ``country`` (or the allowed set) has any usable exit."""
+        return bool(self._buckets.get(country, ((), ()))[0])
+
+    def choose(self, avoid_prefixes=(), seen: Optional[Callable[[str], bool]] = None,
+               country: Optional[str] = None, attempts: int = 20) -> Optional[Relay]:
+        """Pick a bandwidth-weighted random exit outside ``avoid_prefixes``.
+
+        Picks from ``country`` if given, otherwise from the allowed exits.
+        Exits whose address ``seen`` reports as recently used are skipped.
+        """
+        exits, weights = self._buckets.get(country, ((), ()))
+        if not exits:
+            return None
+        for _ in range(attempts):
+            relay = exits[bisect.bisect_left(weights, random.random() * weights[-1])]
+            if relay.prefix in avoid_prefixes or (seen and seen(relay.address)):
+                continue
+            return relay
+        return None
+
+
+class SocksError(OSError):
+    """Raised when a SOCKS5 proxy refuses or fails a connection."""
+
+
+SOCKS5_ERRORS = {
+    1: "general SOCKS server failure",
+    2: "connection not allowed by ruleset",
+    3: "network unreachable",
+    4: "host unreachable",
+    5: "connection refused",
+    6: "TTL expired",
+    7: "command not supported",
+    8: "address type not supported",
+}
+
+
+def _socks5_handshake(host: str, port: int, auth: Optional[Tuple[str, str]] = None):
+    """SOCKS5 client handshake, independent of the I/O model.
+
+    A generator that yields either bytes to send or the number of bytes to
+    receive (and is sent those bytes back). :func:`socks5_connect` and
+    :func:`async_socks5_connect` drive it over blocking and asyncio sockets.
+    """
+    yield b'\x05\x02\x00\x02' if auth else b'\x05\x01\x00'
+    version, method = yield 2
+    if version != 5 or method == 0xff:
+        raise SocksError("SOCKS proxy rejected all authentication methods")
+    if method == 2:
+        user, password = (part.encode() for part in auth)
+        yield bytes([1, len(user)]) + user + bytes([len(password)]) + password
+        if (yield 2)[1] != 0:
+            raise SocksError("SOCKS proxy authentication failed")
+
+    encoded_host = host.encode('idna')
+    yield (b'\x05\x01\x00\x03' + bytes([len(encoded_host)]) + encoded_host
+           + port.to_bytes(2, 'big'))
+    _, reply, _, address_type = yield 4
+    if reply != 0:
+        raise SocksError(f"SOCKS connect to {host}:{port} failed: "
+                         f"{SOCKS5_ERRORS.get(reply, f'error {reply}')}")
+    # Skip the bound address the proxy reports back
+    if address_type == 1:
+        yield 4 + 2
+    elif address_type == 4:
+        yield 16 + 2
+    else:
+        yield (yield 1)[0] + 2
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise SocksError("SOCKS proxy closed the connection")
+        data += chunk
+    return data
+
+
+def socks5_connect(proxy: Tuple[str, int], host: str, port: int,
+                   auth: Optional[Tuple[str, str]] = None,
+                   timeout: Optional[float] = 10.0) -> socket.socket:
+    """Open a TCP connection to host:port through a SOCKS5 proxy.
+
+    The hostname is sent to the proxy unresolved (SOCKS5h), so DNS lookups
+    happen on the proxy side - for Tor this keeps them inside the network.
+    """
+    sock = socket.create_connection(proxy, timeout=timeout)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handshake = _socks5_handshake(host, port, auth)
+        step = next(handshake)
+        while True:
+            if isinstance(step, int):
+                received = _recv_exact(sock, step)
+            else:
+                sock.sendall(step)
+                received = None
+            try:
+                step = handshake.send(received)
+            except StopIteration:
+                return sock
+    except Exception:
+        sock.close()
+        raise
+
+
+class _PooledHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection that can be tunnelled through a SOCKS5 proxy."""
+
+    def __init__(self, host, port, proxy=None, proxy_auth=None, timeout=10.0):
+        super().__init__(host, port, timeout=timeout)
+        self.proxy = proxy
+        self.proxy_auth = proxy_auth
+        self.cancel = None
+
+    def _open_socket(self) -> socket.socket:
+        if self.proxy:
+            sock = socks5_connect(self.proxy, self.host, self.port, self.proxy_auth, self.timeout)
+        else:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.cancel is not None and self.cancel.cancelled:
+            sock.close()
+            raise OSError("request cancelled")
+        return sock
+
+    def connect(self):
+        self.sock = self._open_socket()
+
+
+class _PooledHTTPSConnection(_PooledHTTPConnection):
+    """TLS variant of :class:`_PooledHTTPConnection`."""
+
+    default_port = 443
+
+    def __init__(self, host, port, context, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.context = context
+
+    def connect(self):
+        self.sock = self.context.wrap_socket(self._open_socket(), server_hostname=self.host)
+
+
+def _abort_connection(conn: http.client.HTTPConnection):
+    # shutdown() (unlike close()) wakes up a thread blocked in recv()
+    if conn.sock is not None:
+        try:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class CancelToken:
+    """Lets a hedged lookup abort the requests that lost the race."""
+
+    def __init__(self):
+        self.cancelled = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def add(self, callback: Callable[[], None]):
+        """Register an abort callback (run immediately if already cancelled)."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self):
+        """Cancel the token and run every registered abort callback."""
+        with self._lock:
+            self.cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except OSError:
+                pass
+
+
+class ServiceTracker:
+    """Rolling latency and health record for the IP-echo services.
+
+    ``ranked()`` orders services healthy-and-fastest first. Services that have
+    not answered yet follow the measured ones in their configured order.
+    """
+
+    def __init__(self, services: List[str], alpha: float = 0.3):
+        self.services = list(services)
+        self.alpha = alpha
+        self.latency = {}
+        self.failures = {service: 0 for service in self.services}
+        self._lock = threading.Lock()
+
+    def record(self, service: str, latency: Optional[float]):
+        """Record a successful lookup latency, or a failure if ``None``."""
+        with self._lock:
+            if latency is None:
+                self.failures[service] += 1
+                return
+            self.failures[service] = 0
+            previous = self.latency.get(service)
+            self.latency[service] = (latency if previous is None
+                                     else previous + self.alpha * (latency - previous))
+
+    def ranked(self) -> List[str]:
+        """Return the services in the order they should be tried."""
+        with self._lock:
+            position = {service: i for i, service in enumerate(self.services)}
+            return sorted(self.services, key=lambda service: (
+                self.failures[service],
+                self.latency.get(service, float('inf')),
+                position[service]
+            ))
+
+
+class HTTPClient:
+    """In-process HTTP client with keep-alive pooling and SOCKS5h support.
+
+    Connections are pooled per (scheme, host, port, proxy, proxy auth) and
+    reused across lookups, so repeated IP checks skip process startup and the
+    TCP, SOCKS and TLS handshakes. Stale pooled connections are retried once
+    on a fresh connection.
+    """
+
+    def __init__(self, timeout: float = 10.0, max_idle_per_host: int = 4,
+                 max_idle_keys: int = 32):
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self.max_idle_keys = max_idle_keys
+        self._idle = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._ssl_context = None
+
+    def get(self, url: str, proxy: Optional[Tuple[str, int]] = None,
+            proxy_auth: Optional[Tuple[str, str]] = None,
+            cancel: Optional['CancelToken'] = None) -> Tuple[int, bytes]:
+        """Perform a GET request and return (status, body).
+
+        If ``cancel`` is given, cancelling it aborts the request in flight.
+        """
+        parts = urllib.parse.urlsplit(url)
+        https = parts.scheme == 'https'
+        port = parts.port or (443 if https else 80)
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        key = (parts.scheme, parts.hostname, port, proxy, proxy_auth)
+
+        conn = self._checkout(key)
+        while True:
+            reused = conn is not None
+            if conn is None:
+                conn = self._new_connection(https, parts.hostname, port, proxy, proxy_auth)
+            if cancel is not None:
+                conn.cancel = cancel
+                cancel.add(lambda conn=conn: _abort_connection(conn))
+            try:
+                conn.request('GET', path, headers={'User-Agent': 'ip-phantom', 'Accept': '*/*'})
+                response = conn.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                if reused and not (cancel and cancel.cancelled):
+                    conn = None  # The server dropped an idle connection; retry fresh
+                    continue
+                raise
+            conn.cancel = None
+            if response.will_close or (cancel and cancel.cancelled):
+                conn.close()
+            else:
+                self._checkin(key, conn)
+            return response.status, body
+
+    def _new_connection(self, https, host, port, proxy, proxy_auth):
+        if https:
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            return _PooledHTTPSConnection(host, port, self._ssl_context, proxy=proxy,
+                                          proxy_auth=proxy_auth, timeout=self.timeout)
+        return _PooledHTTPConnection(host, port, proxy=proxy, proxy_auth=proxy_auth,
+                                     timeout=self.timeout)
+
+    def _checkout(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            return idle.pop() if idle else None
+
+    def _checkin(self, key, conn):
+        evicted = []
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            self._idle.move_to_end(key)
+            if len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+                conn = None
+            # Bound the pool: drop the least recently used keys
+            while len(self._idle) > self.max_idle_keys:
+                evicted.extend(self._idle.popitem(last=False)[1])
+        for stale in evicted + ([conn] if conn else []):
+            stale.close()
+
+    def close_idle(self, proxy: Optional[Tuple[str, int]] = None,
+                   proxy_auth: Optional[Tuple[str, str]] = None):
+        """Close pooled connections, optionally only those using ``proxy``
+        (and ``proxy_auth``)."""
+        with self._lock:
+            keys = [key for key in self._idle
+                    if (proxy is None or key[3] == proxy)
+                    and (proxy_auth is None or key[4] == proxy_auth)]
+            connections = [conn for key in keys for conn in self._idle.pop(key)]
+        for conn in connections:
+            conn.close()
+
+
+# Errors that mean "the connection is unusable" (IncompleteReadError is an
+# EOFError). Named so that importing this module does not load asyncio, which
+# leaves out asyncio.TimeoutError: on Python 3.8-3.10 it is a class of its own,
+# so handlers add it themselves (asyncio is loaded by the time they run).
+ASYNC_IO_ERRORS = (OSError, concurrent.futures.TimeoutError, EOFError)
+
+
+async def _async_recv_exact(loop, sock: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = await loop.sock_recv(sock, size - len(data))
+        if not chunk:
+            raise SocksError("SOCKS proxy closed the connection")
+        data += chunk
+    return data
+
+
+async def async_socks5_connect(proxy: Tuple[str, int], host: str, port: int,
+                               auth: Optional[Tuple[str, str]] = None) -> socket.socket:
+    """asyncio version of :func:`socks5_connect` (returns a non-blocking socket)."""
+    loop = asyncio.get_running_loop()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, proxy)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        handshake = _socks5_handshake(host, port, auth)
+        step = next(handshake)
+        while True:
+            if isinstance(step, int):
+                received = await _async_recv_exact(loop, sock, step)
+            else:
+                await loop.sock_sendall(sock, step)
+                received = None
+            try:
+                step = handshake.send(received)
+            except StopIteration:
+                return sock
+    except BaseException:
+        sock.close()
+        raise
+
+
+class AsyncHTTPClient:
+    """asyncio counterpart of :class:`HTTPClient`.
+
+    Keeps idle keep-alive connections per (scheme, host, port, proxy, auth),
+    tunnels through SOCKS5h and supports TLS. Only what IP checks need:
+    GET requests with Content-Length, chunked or close-delimited bodies.
+    """
+
+    def __init__(self, timeout: float = 10.0, max_idle_per_host: int = 4):
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._ssl_context = None
+
+    async def get(self, url: str, proxy: Optional[Tuple[str, int]] = None,
+                  proxy_auth: Optional[Tuple[str, str]] = None) -> Tuple[int, bytes]:
+        """Perform a GET request and return (status, body)."""
+        parts = urllib.parse.urlsplit(url)
+        https = parts.scheme == 'https'
+        port = parts.port or (443 if https else 80)
+        host_header = parts.hostname if port == (443 if https else 80) else f'{parts.hostname}:{port}'
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        key = (parts.scheme, parts.hostname, port, proxy, proxy_auth)
+
+        idle = self._idle.get(key)
+        conn = idle.pop() if idle else None
+        while True:
+            reused = conn is not None
+            try:
+                if conn is None:
+                    conn = await asyncio.wait_for(
+                        self._open(https, parts.hostname, port, proxy, proxy_auth), self.timeout)
+                status, body, keep_alive = await asyncio.wait_for(
+                    self._request(conn, host_header, path), self.timeout)
+            except ASYNC_IO_ERRORS + (asyncio.TimeoutError, ValueError):
+                if conn is not None:
+                    conn[1].close()
+                if reused:
+                    conn = None  # The server dropped an idle connection; retry fresh
+                    continue
+                raise
+            idle = self._idle.setdefault(key, [])
+            if keep_alive and len(idle) < self.max_idle_per_host:
+                idle.append(conn)
+            else:
+                conn[1].close()
+            return status, body
+
+    async def _open(self, https, host, port, proxy, proxy_auth):
+        context = None
+        if https:
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            context = self._ssl_context
+        if proxy:
+            sock = await async_socks5_connect(proxy, host, port, proxy_auth)
+            return await asyncio.open_connection(sock=sock, ssl=context,
+                                                 server_hostname=host if https else None)
+        return await asyncio.open_connection(host, port, ssl=context)
+
+    @staticmethod
+    async def _request(conn, host_header: str, path: str) -> Tuple[int, bytes, bool]:
+        reader, writer = conn
+        writer.write(f'GET {path} HTTP/1.1\r\nHost: {host_header}\r\n'
+                     f'User-Agent: ip-phantom\r\nAccept: */*\r\n\r\n'.encode())
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("server closed the connection")
+        version, status = status_line.split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            body = b''
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass  # Trailers
+                    break
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return int(status), body, keep_alive
+
+    async def aclose(self):
+        """Close every pooled connection."""
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle.clear()
+
+
+class AsyncTorController:
+    """asyncio client for the Tor control protocol.
+
+    Shares reply parsing and authentication with :class:`TorController` and
+    likewise authenticates once, pipelines and reconnects on demand.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9051,
+                 cookie_path: str = '/tmp/tor-control-cookie',
+                 password: Optional[str] = None, timeout: float = 10.0):
+        self.host = host
+        self.port = port
+        self.cookie_path = cookie_path
+        self.password = password
+        self.timeout = timeout
+        self.events = collections.deque(maxlen=1000)
+        self._reader = None
+        self._writer = None
+        self._parser = ControlReplyParser()
+        self._lock = None
+
+    @classmethod
+    def like(cls, controller: TorController) -> 'AsyncTorController':
+        """Create an async client for the same control port as ``controller``."""
+        return cls(controller.host, controller.port, controller.cookie_path,
+                   controller.password, controller.timeout)
+
+    async def connect(self):
+        """Open the control connection and authenticate."""
+        await self.close()
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        try:
+            replies = await asyncio.wait_for(
+                self._roundtrip([control_auth_command(self.password, self.cookie_path)]), self.timeout)
+        except BaseException:
+            await self.close()  # Or the next command would skip authenticating
+            raise
+        reply = replies[0]
+        if not reply.ok:
+            await self.close()
+            raise TorControlError(f"Tor authentication failed: {reply}")
+
+    async def close(self):
+        """Close the control connection (it is reopened on the next command)."""
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except ASYNC_IO_ERRORS + (asyncio.TimeoutError,):
+                pass
+        self._reader = self._writer = None
+        self._parser = ControlReplyParser()
+
+    async def execute_many(self, commands: List[str]) -> List[ControlReply]:
+        """Pipeline several commands and return their replies in order."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if self._writer is None:
+                        await self.connect()
+                    return await asyncio.wait_for(self._roundtrip(commands), self.timeout)
+                except TorControlError:
+                    await self.close()
+                    raise
+                except ASYNC_IO_ERRORS + (asyncio.TimeoutError,):
+                    # Stale connection (e.g. Tor restarted): reconnect once
+                    await self.close()
+                    if attempt == 2:
+                        raise
+
+    async def execute(self, command: str) -> ControlReply:
+        """Send one command and return its reply."""
+        return (await self.execute_many([command]))[0]
+
+    async def get_info(self, *keys: str) -> Dict[str, str]:
+        """Run ``GETINFO`` for the given keys and return their values."""
+        reply = await self.execute('GETINFO ' + ' '.join(keys))
+        if not reply.ok:
+            raise TorControlError(f"GETINFO failed: {reply}")
+        return reply.values()
+
+    async def _roundtrip(self, commands: List[str]) -> List[ControlReply]:
+        self._writer.write(''.join(f'{command}\r\n' for command in commands).encode())
+        await self._writer.drain()
+        replies = []
+        while len(replies) < len(commands):
+            raw = await self._reader.readline()
+            if not raw:
+                raise ConnectionError("Tor control connection closed")
+            reply = self._parser.feed(raw.decode('utf-8', 'replace').rstrip('\r\n'))
+            if reply is None:
+                continue
+            if reply.status == '650':
+                self.events.append(reply)
+            else:
+                replies.append(reply)
+        return replies
+
+
+async def run_in_thread(func: Callable, *args):
+    """Run a blocking call in a daemon thread and await its result.
+
+    Unlike ``run_in_executor`` the thread never delays interpreter exit, so a
+    rotation stuck on a network timeout cannot hold up shutdown.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(setter, value):
+        if not future.done():
+            setter(value)
+
+    def target():
+        try:
+            result = func(*args)
+        except BaseException as e:
+            outcome = (future.set_exception, e)
+        else:
+            outcome = (future.set_result, result)
+        try:
+            loop.call_soon_threadsafe(resolve, *outcome)
+        except RuntimeError:
+            pass  # The loop is already closed
+
+    threading.Thread(target=target, name=getattr(func, '__name__', 'worker'), daemon=True).start()
+    return await future
+
+
+def parse_ip_response(body) -> Optional[str]:
+    """Extract the IP from an echo service's JSON (``origin`` or ``ip``)."""
+    response = json.loads(body)
+    # Handle different response formats
+    ip = response.get('origin') or response.get('ip')
+    if ip:
+        # Clean IP (remove port if present)
+        return ip.split(',')[0].strip()
+    return None
+
+
+def default_state_dir() -> str:
+    """Directory for state kept across runs (``$XDG_STATE_HOME/ip-phantom``)."""
+    state_home = os.environ.get('XDG_STATE_HOME') or os.path.expanduser('~/.local/state')
+    return os.path.join(state_home, 'ip-phantom')
+
+
+# Files Tor writes once bootstrapped; with them present a restart only
+# fetches what changed instead of the whole directory
+TOR_WARM_STATE = ('cached-microdesc-consensus', 'cached-consensus')
+
+
+def find_bundled_torrc() -> Optional[str]:
+    """Locate the torrc shipped next to this script (or in the cwd)."""
+    for directory in (os.path.dirname(os.path.abspath(__file__)), os.getcwd()):
+        torrc_path = os.path.join(directory, 'torrc')
+        if os.path.exists(torrc_path):
+            return torrc_path
+    return None
+
+
+class TorInstance:
+    """A tor process managed by IP Phantom.
+
+    The default instance uses the bundled ``torrc``. Pool instances created
+    with :meth:`generated` get their own torrc, ports, DataDirectory and
+    cookie file so that several can run side by side. Either way the
+    DataDirectory is persistent, so restarts reuse the cached consensus,
+    descriptors and guards.
+    """
+
+    def __init__(self, name: str, socks_port: int, control_port: int,
+                 cookie_path: str, data_dir: str, torrc_path: Optional[str] = None,
+                 password: Optional[str] = None):
+        self.name = name
+        self.socks = ('127.0.0.1', socks_port)
+        self.control_port = control_port
+        self.cookie_path = cookie_path
+        self.data_dir = data_dir
+        self.torrc_path = torrc_path
+        self.generated_torrc = False
+        self.controller = TorController(port=control_port, cookie_path=cookie_path,
+                                        password=password)
+        self.process = None
+        # Set while the instance holds a fresh circuit nobody has used yet
+        self.ready = threading.Event()
+        self.exit_ip = None
+        # Bumped on every NEWNYM, which invalidates all existing circuits
+        self.generation = 0
+        # Earliest time (monotonic) Tor acts on another NEWNYM without delay
+        self.next_newnym = 0.0
+        # First circuit built after the last NEWNYM (see parse_circuit)
+        self.circuit = None
+        # Set by spawn() until the bootstrap time has been recorded
+        self.spawned_at = None
+        self.warm_start = False
+        # Set while our ExitNodes override is in place (undone by stop())
+        self.exit_nodes_set = False
+
+    def newnym_wait(self) -> float:
+        """Seconds until Tor would act on another NEWNYM right away."""
+        return max(0.0, self.next_newnym - time.monotonic())
+
+    @classmethod
+    def generated(cls, index: int, base_port: int, data_root: str,
+                  password: Optional[str] = None) -> 'TorInstance':
+        """Create pool instance ``index`` with its own generated torrc."""
+        socks_port = base_port + 10 * index
+        data_dir = os.path.join(data_root, f'instance-{index}')
+        instance = cls(f'tor-{index}', socks_port, socks_port + 1,
+                       os.path.join(data_dir, 'control_auth_cookie'), data_dir,
+                       torrc_path=os.path.join(data_dir, 'torrc'), password=password)
+        instance.generated_torrc = True
+        return instance
+
+    def write_torrc(self):
+        """Write the torrc for a generated instance."""
+        lines = [
+            f"SocksPort 127.0.0.1:{self.socks[1]}",
+            f"ControlPort 127.0.0.1:{self.control_port}",
+            "CookieAuthentication 1",
+            f"CookieAuthFile {self.cookie_path}",
+            f"DataDirectory {self.data_dir}",
+            "CircuitBuildTimeout 30",
+            "NewCircuitPeriod 60",
+            "MaxCircuitDirtiness 300",
+            "NumEntryGuards 8",
+            "Log notice stdout",
+        ]
+        with open(self.torrc_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def has_warm_state(self) -> bool:
+        """True if the DataDirectory holds a consensus from an earlier run."""
+        return (os.path.exists(os.path.join(self.data_dir, 'state'))
+                and any(os.path.exists(os.path.join(self.data_dir, name)) for name in TOR_WARM_STATE))
+
+    def spawn(self):
+        """Launch the tor process (returns without waiting for it)."""
+        torrc_path = self.torrc_path or find_bundled_torrc()
+        if not torrc_path:
+            raise FileNotFoundError(f"Tor configuration file 'torrc' not found in "
+                                    f"{os.path.dirname(os.path.abspath(__file__))} or {os.getcwd()}")
+        os.makedirs(self.data_dir, mode=0o700, exist_ok=True)
+        # Tor refuses a DataDirectory that others can read
+        os.chmod(self.data_dir, 0o700)
+        command = ['tor', '-f', torrc_path]
+        if self.generated_torrc:
+            self.write_torrc()
+        else:
+            # Keep the bundled torrc's settings but our persistent directory
+            command += ['--DataDirectory', self.data_dir]
+        self.ready.clear()
+        self.exit_ip = None
+        self.warm_start = self.has_warm_state()
+        self.spawned_at = time.monotonic()
+        self.process = subprocess.Popen(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+    def is_running(self) -> bool:
+        """Check that both the SOCKS and control ports accept connections."""
+        try:
+            for port in (self.socks[1], self.control_port):
+                with socket.create_connection(('127.0.0.1', port), timeout=1):
+                    pass
+            return True
+        except (ConnectionRefusedError, socket.timeout, OSError):
+            return False
+
+    def has_exited(self) -> bool:
+        """True if we launched this instance and its process has died."""
+        return self.process is not None and self.process.poll() is not None
+
+    def stop(self):
+        """Close the control connection and terminate our tor process.
+
+        A tor we did not start keeps running, so any ExitNodes we set on it
+        is reset first rather than left pinning everyone else's circuits.
+        """
+        if self.exit_nodes_set:
+            try:
+                self.controller.execute('RESETCONF ExitNodes')
+                self.exit_nodes_set = False
+            except (TorControlError, OSError):
+                pass
+        self.controller.close()
+        self.ready.clear()
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+        self.process = None
+
+
+# openvpn prints this once the tunnel is up and configured
+OPENVPN_READY = 'Initialization Sequence Completed'
+OPENVPN_REMOTE = re.compile(r'\[AF_INET\]([0-9.]+):\d+')
+# Tun devices for the tunnel carrying traffic and the one coming up next
+VPN_DEVICES = ('ipp-tun0', 'ipp-tun1')
+# Together these cover all of IPv4 and outrank the default route
+DEF1_ROUTES = ('0.0.0.0/1', '128.0.0.0/1')
+
+
+def ovpn_remotes(config_file: str) -> List[Tuple[str, int]]:
+    """The ``remote host [port]`` entries of an OpenVPN config file."""
+    remotes = []
+    with open(config_file) as f:
+        for line in f:
+            words = line.split()
+            if len(words) >= 2 and words[0] == 'remote':
+                port = int(words[2]) if len(words) > 2 and words[2].isdigit() else 1194
+                remotes.append((words[1], port))
+    return remotes
+
+
+class VPNTunnel:
+    """An openvpn client on a tun device of its own that leaves routing alone.
+
+    openvpn runs with ``--route-noexec``, so the next tunnel can connect
+    while the current one carries traffic; switching to it is then only a
+    route change (see :meth:`IPPhantom.switch_endpoint`).
+    """
+
+    def __init__(self, name: str, config_file: str, device: str, binary: str = 'openvpn',
+                 sudo: bool = False):
+        self.name = name
+        self.config_file = config_file
+        self.device = device
+        self.binary = binary
+        self.sudo = sudo
+        self.process = None
+        self.connected = False
+        self.remote = None
+        self.output = collections.deque(maxlen=20)
+        self._done = threading.Event()
+
+    def start(self):
+        """Launch openvpn; :meth:`wait_connected` tells when the tunnel is up."""
+        cmd = [self.binary, '--config', self.config_file, '--dev', self.device,
+               '--dev-type', 'tun', '--route-noexec', '--verb', '3']
+        if self.sudo:
+            cmd = ['sudo', '-n'] + cmd  # Never prompt for a password mid-rotation
+        self.process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        stdin=subprocess.DEVNULL, text=True, start_new_session=True)
+        threading.Thread(target=self._read_output, name=f'openvpn-{self.device}', daemon=True).start()
+
+    def _read_output(self):
+        for line in self.process.stdout:
+            self.output.append(line.rstrip())
+            match = OPENVPN_REMOTE.search(line)
+            if match:
+                self.remote = match.group(1)
+            if OPENVPN_READY in line:
+                self.connected = True
+                self._done.set()
+        self._done.set()  # openvpn exited
+
+    def wait_connected(self, timeout: float) -> bool:
+        """Wait until the tunnel is up; False on timeout or if openvpn exited."""
+        self._done.wait(timeout)
+        return self.connected and self.running
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def last_output(self) -> str:
+        return self.output[-1] if self.output else 'no output'
+
+    def stop(self):
+        """Stop openvpn, which removes its tun device."""
+        if not self.running:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+# Control-channel wrappers that make a server ignore unauthenticated packets
+OPENVPN_TLS_WRAPPERS = ('tls-auth', 'tls-crypt', 'tls-crypt-v2')
+# First packet of an OpenVPN handshake and the server's answer (opcode << 3 | key id)
+OPENVPN_HARD_RESET_CLIENT = 7 << 3
+OPENVPN_HARD_RESET_SERVER = 8 << 3
+
+
+def ovpn_probe_target(config_file: str) -> Optional[Tuple[str, int, str]]:
+    """(host, port, 'udp' or 'tcp') of the first remote, or None if the
+    server cannot be probed (no remote, or a tls-auth/tls-crypt key)."""
+    proto, target = 'udp', None
+    with open(config_file) as f:
+        for line in f:
+            words = line.split()
+            if not words:
+                continue
+            option = words[0].strip('<>')
+            if option in OPENVPN_TLS_WRAPPERS:
+                return None
+            if option == 'proto' and len(words) > 1:
+                proto = words[1]
+            elif option == 'remote' and len(words) >= 2 and target is None:
+                port = int(words[2]) if len(words) > 2 and words[2].isdigit() else 1194
+                target = (words[1], port, words[3] if len(words) > 3 else None)
+    if target is None:
+        return None
+    host, port, remote_proto = target
+    return host, port, 'tcp' if (remote_proto or proto).startswith('tcp') else 'udp'
+
+
+class _OpenVPNProbeProtocol:
+    # Duck-typed asyncio.DatagramProtocol: subclassing it would import
+    # asyncio along with this module
+    def __init__(self, answered: 'asyncio.Future'):
+        self.answered = answered
+
+    def connection_made(self, transport):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+    def datagram_received(self, data, addr):
+        if data and data[0] & 0xf8 == OPENVPN_HARD_RESET_SERVER and not self.answered.done():
+            self.answered.set_result(True)
+
+    def error_received(self, exc):
+        if not self.answered.done():
+            self.answered.set_exception(exc)
+
+
+async def openvpn_udp_probe(host: str, port: int):
+    """Send an OpenVPN client hard reset and wait for the server's reset.
+    
+    Raises OSError if the server refuses; the caller bounds the wait.
+    """
+    loop = asyncio.get_running_loop()
+    answered = loop.create_future()
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: _OpenVPNProbeProtocol(answered), remote_addr=(host, port))
+    try:
+        # Opcode, session id, empty ACK array, packet id 0
+        transport.sendto(bytes([OPENVPN_HARD_RESET_CLIENT]) + secrets.token_bytes(8) + bytes(5))
+        await answered
+    finally:
+        transport.close()
+
+
+def endpoint_key(endpoint: Dict) -> Tuple[str, str]:
+    return endpoint['kind'], endpoint['name']
+
+
+class EndpointHealth:
+    """Rolling availability and latency of the VPN and proxy endpoints.
+
+    Each endpoint keeps its last ``window`` probe results. ``ranked()``
+    lists the usable ones (up at the last probe and in at least
+    ``min_availability`` of the window) fastest first, then the ones not
+    probed yet in their configured order; failing endpoints are left out
+    until a probe finds them up again.
+    """
+
+    def __init__(self, endpoints: List[Dict], window: int = 10, min_availability: float = 0.5):
+        self.endpoints = list(endpoints)
+        self.window = window
+        self.min_availability = min_availability
+        self.results = {}
+        self._ranked = None
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: Dict, latency: Optional[float]):
+        """Record a probe latency, or a failure if ``None``."""
+        key = endpoint_key(endpoint)
+        with self._lock:
+            results = self.results.get(key)
+            if results is None:
+                results = self.results[key] = collections.deque(maxlen=self.window)
+            results.append(latency)
+            self._ranked = None
+
+    def stats(self, endpoint: Dict) -> Optional[Tuple[float, Optional[float], bool]]:
+        """(availability, median latency, up at the last probe), or None if never probed."""
+        with self._lock:
+            results = self.results.get(endpoint_key(endpoint))
+            return self._stats(results) if results else None
+
+    @staticmethod
+    def _stats(results) -> Tuple[float, Optional[float], bool]:
+        latencies = sorted(latency for latency in results if latency is not None)
+        return (len(latencies) / len(results), latencies[len(latencies) // 2] if latencies else None,
+                results[-1] is not None)
+
+    def measured(self, endpoint: Dict) -> bool:
+        return endpoint_key(endpoint) in self.results
+
+    def ranked(self) -> List[Dict]:
+        """The endpoints rotations may use, best first."""
+        with self._lock:
+            if self._ranked is None:
+                usable, unprobed = [], []
+                for endpoint in self.endpoints:
+                    results = self.results.get(endpoint_key(endpoint))
+                    if not results:
+                        unprobed.append(endpoint)
+                        continue
+                    availability, latency, up = self._stats(results)
+                    if up and availability >= self.min_availability:
+                        usable.append((latency, endpoint))
+                usable.sort(key=lambda entry: entry[0])
+                self._ranked = [endpoint for _, endpoint in usable] + unprobed
+            return self._ranked
+
+    def summary(self) -> Dict[str, int]:
+        """How many endpoints are usable, failing and not probed yet."""
+        ranked = self.ranked()
+        usable = sum(1 for endpoint in ranked if self.measured(endpoint))
+        unprobed = len(ranked) - usable
+        return {'usable': usable, 'failing': len(self.endpoints) - usable - unprobed,
+                'unprobed': unprobed}
+
+
+class EndpointProber:
+    """Background health checks of every VPN and proxy endpoint.
+
+    Runs on the engine's event loop: each endpoint is probed once per
+    ``interval`` seconds, at most ``rate`` probes per second and
+    ``concurrency`` at a time, from one timer heap, so thousands of
+    endpoints cost no more threads or tasks than a handful. Proxies are
+    probed with an IP lookup through them; VPN servers with the first
+    packet of an OpenVPN handshake (UDP) or a TCP connect. Servers behind
+    tls-auth/tls-crypt ignore the handshake probe and are not probed.
+    """
+
+    def __init__(self, health: EndpointHealth, url: str, interval: float = 60.0,
+                 concurrency: int = 50, rate: float = 20.0, timeout: float = 5.0,
+                 metrics: Optional['Metrics'] = None):
+        self.health = health
+        self.url = url
+        self.interval = interval
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timeout = timeout
+        self.metrics = metrics
+        self.probes = 0
+        # Fresh connections only: a pool would keep sockets to every proxy open
+        self.http = AsyncHTTPClient(timeout=timeout, max_idle_per_host=0)
+        self._targets = {}
+
+    async def run(self):
+        """Probe until cancelled."""
+        endpoints = [endpoint for endpoint in self.health.endpoints if self._target(endpoint)]
+        if not endpoints:
+            # E.g. only tls-auth VPN servers: nothing to do, but the engine
+            # treats a finished task as a reason to stop
+            try:
+                await asyncio.get_running_loop().create_future()
+            finally:
+                await self.http.aclose()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        now = time.monotonic()
+        due = [(now, i) for i in range(len(endpoints))]
+        next_slot = now
+        try:
+            while due:
+                start = max(due[0][0], next_slot)
+                now = time.monotonic()
+                if start > now:
+                    await asyncio.sleep(start - now)
+                    continue
+                _, i = heapq.heappop(due)
+                next_slot = max(next_slot, now) + 1.0 / self.rate
+                await semaphore.acquire()
+                task = asyncio.ensure_future(self._probe(endpoints[i], semaphore))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                heapq.heappush(due, (now + self.interval, i))
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.http.aclose()
+
+    def _target(self, endpoint: Dict):
+        """What to probe for an endpoint (None: cannot be probed)."""
+        key = endpoint_key(endpoint)
+        if key not in self._targets:
+            if endpoint['kind'] == 'proxy':
+                self._targets[key] = (endpoint['host'], endpoint['port'])
+            else:
+                try:
+                    self._targets[key] = ovpn_probe_target(endpoint['config_file'])
+                except (OSError, ValueError):
+                    self._targets[key] = None
+        return self._targets[key]
+
+    async def _probe(self, endpoint: Dict, semaphore: 'asyncio.Semaphore'):
+        start = time.perf_counter()
+        up = False
+        try:
+            up = await asyncio.wait_for(self.probe(endpoint), self.timeout)
+        except (asyncio.TimeoutError, ValueError, AttributeError) + ASYNC_IO_ERRORS:
+            pass  # Down: refused, unreachable or silent (a UDP server that never answers)
+        except Exception as e:
+            # Still counted as down, so a broken probe cannot leave it "not probed yet"
+            logging.getLogger(__name__).warning(f"Probe of {endpoint['name']} failed: {e!r}")
+        finally:
+            semaphore.release()
+        latency = time.perf_counter() - start
+        self.probes += 1
+        self.health.record(endpoint, latency if up else None)
+        if self.metrics:
+            self.metrics.inc('ip_phantom_endpoint_probes_total', kind=endpoint['kind'],
+                             result='up' if up else 'down')
+            if up:
+                self.metrics.observe('ip_phantom_endpoint_probe_seconds', latency, kind=endpoint['kind'])
+
+    async def probe(self, endpoint: Dict) -> bool:
+        """Check one endpoint once; True if it works."""
+        target = self._target(endpoint)
+        if endpoint['kind'] == 'proxy':
+            status, body = await self.http.get(self.url, proxy=target)
+            return status == 200 and parse_ip_response(body) is not None
+        host, port, proto = target
+        if proto == 'tcp':
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+        else:
+            await openvpn_udp_probe(host, port)
+        return True
+
+
+class Identity:
+    """A verified next identity: an isolated Tor circuit with a known exit IP.
+
+    The circuit is selected by a unique SOCKS username/password; Tor's
+    IsolateSOCKSAuth (on by default) keeps it apart from all other traffic.
+    """
+
+    def __init__(self, instance: TorInstance, auth: Tuple[str, str], exit_ip: str,
+                 generation: int, build_latency: float):
+        self.instance = instance
+        self.auth = auth
+        self.exit_ip = exit_ip
+        self.generation = generation
+        self.build_latency = build_latency
+        self.built_at = time.monotonic()
+        # Circuit probe result when circuit probing is on
+        self.probe = None
+
+    def is_fresh(self, max_age: float) -> bool:
+        """False once the circuit is too old or a NEWNYM invalidated it."""
+        return (self.instance.generation == self.generation
+                and time.monotonic() - self.built_at < max_age)
+
+
+class IdentityPrebuilder:
+    """Background pipeline that keeps up to ``depth`` identities ready.
+
+    ``build`` creates one verified identity (or returns ``None``). Identities
+    expire after ``max_age`` seconds, which must stay below Tor's
+    MaxCircuitDirtiness so the circuit still exists when it is used.
+    """
+
+    def __init__(self, build: Callable[[], Optional[Identity]], depth: int,
+                 max_age: float = 240.0):
+        self.build = build
+        self.depth = depth
+        self.max_age = max_age
+        self.queue = collections.deque()
+        self.build_latencies = collections.deque(maxlen=100)
+        self.builds = 0
+        self.failures = 0
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """Start the builder thread (no-op if already running)."""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='identity-prebuilder',
+                                            daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the builder thread after its current build."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+    def take(self, avoid: Optional[str] = None, timeout: float = 0.0,
+             seen: Optional[Callable[[str], bool]] = None) -> Optional[Identity]:
+        """Pop the oldest fresh identity whose exit differs from ``avoid``.
+
+        Identities whose exit ``seen`` reports as recently used are dropped.
+        Waits up to ``timeout`` seconds for one if the queue is empty.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                self._prune()
+                while self.queue:
+                    identity = self.queue.popleft()
+                    if identity.exit_ip != avoid and not (seen and seen(identity.exit_ip)):
+                        self._cond.notify_all()
+                        return identity
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._running:
+                    self._cond.notify_all()
+                    return None
+                self._cond.wait(remaining)
+
+    def stats(self) -> Dict:
+        """Queue depth and build latency figures for sizing ``depth``."""
+        with self._cond:
+            self._prune()
+            latencies = sorted(self.build_latencies)
+            return {
+                'ready': len(self.queue),
+                'target': self.depth,
+                'builds': self.builds,
+                'failures': self.failures,
+                'build_p50': latencies[len(latencies) // 2] if latencies else None,
+                'build_p95': latencies[int(len(latencies) * 0.95)] if latencies else None,
+            }
+
+    def _prune(self):
+        self.queue = collections.deque(
+            identity for identity in self.queue if identity.is_fresh(self.max_age))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._prune()
+                while self._running and len(self.queue) >= self.depth:
+                    self._cond.wait(timeout=5.0)
+                    self._prune()
+                if not self._running:
+                    return
+            try:
+                identity = self.build()
+            except Exception:
+                identity = None
+            with self._cond:
+                self.builds += 1
+                if identity is None:
+                    self.failures += 1
+                    self._cond.wait(timeout=1.0)  # Back off before retrying
+                elif identity.is_fresh(self.max_age) and all(
+                        queued.exit_ip != identity.exit_ip for queued in self.queue):
+                    self.build_latencies.append(identity.build_latency)
+                    self.queue.append(identity)
+                    self._cond.notify_all()
+
+
+class ExitIndex:
+    """Bounded, optionally persistent record of recently used exit IPs.
+
+    An OrderedDict in last-used order gives O(1) lookups and evicts the
+    least recently used entry beyond ``capacity``, as well as entries older
+    than ``window`` seconds (0 = no time limit). Addresses are stored packed
+    to keep memory low over long runs. With ``path`` every use is appended
+    to a log that is reloaded, and compacted, on start.
+    """
+
+    def __init__(self, capacity: int = 100000, window: float = 3600.0,
+                 path: Optional[str] = None):
+        self.capacity = capacity
+        self.window = window
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._log = None
+        if path:
+            self._load()
+            self._log = open(path, 'a', buffering=1)
+
+    @staticmethod
+    def _key(ip: str):
+        try:
+            return ipaddress.ip_address(ip).packed
+        except ValueError:
+            return ip
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, ip: str) -> bool:
+        with self._lock:
+            self._expire(time.time())
+            return self._key(ip) in self._entries
+
+    def add(self, ip: str):
+        """Record that ``ip`` was used as an exit just now."""
+        now = time.time()
+        with self._lock:
+            self._insert(self._key(ip), now)
+            if self._log is not None:
+                self._log.write(f'{ip} {now:.0f}\n')
+
+    def _insert(self, key, when: float):
+        self._entries[key] = when
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def _expire(self, now: float):
+        if not self.window:
+            return
+        cutoff = now - self.window
+        while self._entries:
+            key, when = next(iter(self._entries.items()))
+            if when >= cutoff:
+                break
+            del self._entries[key]
+
+    def _load(self):
+        lines = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    lines += 1
+                    ip, _, when = line.partition(' ')
+                    try:
+                        self._insert(self._key(ip), float(when))
+                    except ValueError:
+                        continue  # Torn last line
+        except FileNotFoundError:
+            return
+        self._expire(time.time())
+        if lines > 2 * len(self._entries) + 1000:
+            # Mostly evicted or expired entries: rewrite the log
+            temp_path = f'{self.path}.tmp'
+            with open(temp_path, 'w') as f:
+                for key, when in self._entries.items():
+                    ip = str(ipaddress.ip_address(key)) if isinstance(key, bytes) else key
+                    f.write(f'{ip} {when:.0f}\n')
+            os.replace(temp_path, self.path)
+
+    def close(self):
+        """Close the on-disk log."""
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+
+class ExitScores:
+    """Rolling per-exit circuit performance, used to reject and avoid slow exits.
+
+    Each probe of a circuit (time to first byte and, optionally, throughput)
+    is folded into an exponentially weighted average for its exit IP, so one
+    unlucky probe does not condemn an exit for good. A sample is rejected
+    when its TTFB exceeds ``max_ttfb`` seconds or its throughput falls below
+    ``min_throughput`` bytes/s (0 disables either check); an exit whose
+    averages fail the same checks is known slow. Entries are kept in an LRU
+    of ``capacity`` exits and forgotten after ``max_age`` seconds, since
+    relay load changes over time.
+    """
+
+    def __init__(self, max_ttfb: float = 0.0, min_throughput: float = 0.0,
+                 capacity: int = 10000, max_age: float = 3600.0, alpha: float = 0.3):
+        self.max_ttfb = max_ttfb
+        self.min_throughput = min_throughput
+        self.capacity = capacity
+        self.max_age = max_age
+        self.alpha = alpha
+        # ip -> [ttfb average, throughput average or None, samples, last update]
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def verdict(self, ttfb: float, throughput: Optional[float] = None) -> Optional[str]:
+        """Why a probe result is unacceptable (``'ttfb'``/``'throughput'``), or None."""
+        if self.max_ttfb and ttfb > self.max_ttfb:
+            return 'ttfb'
+        if self.min_throughput and throughput is not None and throughput < self.min_throughput:
+            return 'throughput'
+        return None
+
+    def record(self, ip: str, ttfb: float, throughput: Optional[float] = None):
+        """Fold one probe of a circuit through ``ip`` into its averages."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(ip)
+            if entry is None or now - entry[3] > self.max_age:
+                entry = self._entries[ip] = [ttfb, throughput, 0, now]
+            else:
+                entry[0] += self.alpha * (ttfb - entry[0])
+                if throughput is not None:
+                    entry[1] = throughput if entry[1] is None else entry[1] + self.alpha * (throughput - entry[1])
+            entry[2] += 1
+            entry[3] = now
+            self._entries.move_to_end(ip)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def score(self, ip: str) -> Optional[Dict]:
+        """Averages for ``ip`` ({'ttfb', 'throughput', 'samples'}), None if unknown."""
+        with self._lock:
+            entry = self._entries.get(ip)
+            if entry is None or time.monotonic() - entry[3] > self.max_age:
+                return None
+            return {'ttfb': entry[0], 'throughput': entry[1], 'samples': entry[2]}
+
+    def is_slow(self, ip: str) -> bool:
+        """Whether the rolling averages for ``ip`` fail the thresholds."""
+        score = self.score(ip)
+        return score is not None and self.verdict(score['ttfb'], score['throughput']) is not None
+
+
+# Latency histogram buckets in seconds (Prometheus ``le`` bounds)
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _prometheus_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+class Metrics:
+    """Rotation counters, latency histograms and a JSON-lines event stream.
+    
+    Recording is a dict update under a lock (plus one buffered line per
+    rotation when an event file is set), so it can stay on in production.
+    Phases timed while a rotation is in progress on the same thread are also
+    attached to that rotation's event.
+    """
+    
+    def __init__(self, events_path: Optional[str] = None):
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._events = open(events_path, 'a', buffering=1) if events_path else None
+        self._server = None
+        # RotationHistory that finished rotations are also queued to
+        self.history = None
+    
+    def inc(self, name: str, amount: float = 1, **labels):
+        """Increment a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] += amount
+    
+    def observe(self, name: str, seconds: float, **labels):
+        """Record a latency sample in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # Per-bucket counts, then sum and count
+                histogram = self.histograms[key] = [0] * len(METRIC_BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(METRIC_BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            histogram[-2] += seconds
+            histogram[-1] += 1
+    
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Time one rotation phase (``ip_phantom_phase_seconds``)."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe('ip_phantom_phase_seconds', elapsed, phase=name)
+            rotation = getattr(self._local, 'rotation', None)
+            if rotation is not None:
+                rotation['phases'][name] = round(rotation['phases'].get(name, 0.0) + elapsed, 6)
+    
+    def rotation_started(self):
+        """Start collecting phases and fields for a rotation on this thread."""
+        self._local.rotation = {'start': time.perf_counter(), 'phases': {}}
+    
+    def annotate(self, **fields):
+        """Attach fields (e.g. ``path``, ``outcome``) to the current rotation."""
+        rotation = getattr(self._local, 'rotation', None)
+        if rotation is not None:
+            rotation.update(fields)
+    
+    def rotation_finished(self, success: bool) -> Optional[str]:
+        """Count the rotation, emit its event and return its outcome."""
+        rotation = getattr(self._local, 'rotation', None)
+        if rotation is None:
+            return None
+        self._local.rotation = None
+        elapsed = time.perf_counter() - rotation.pop('start')
+        outcome = rotation.pop('outcome', None) or ('success' if success else 'failure')
+        self.inc('ip_phantom_rotations_total', outcome=outcome)
+        self.observe('ip_phantom_rotation_seconds', elapsed)
+        self.event('rotation', outcome=outcome, seconds=round(elapsed, 6), **rotation)
+        if self.history is not None:
+            self.history.add({'ts': time.time(), 'outcome': outcome, 'seconds': elapsed, **rotation})
+        return outcome
+    
+    def event(self, kind: str, **fields):
+        """Append one JSON line to the event stream (if enabled)."""
+        if self._events is None:
+            return
+        line = json.dumps({'ts': round(time.time(), 3), 'event': kind, **fields}, default=str)
+        with self._lock:
+            self._events.write(line + '\n')
+    
+    def render(self) -> str:
+        """Metrics in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(values)) for key, values in self.histograms.items())
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} counter')
+            lines.append(f'{name}{_prometheus_labels(labels)} {value:g}')
+        for (name, labels), values in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} histogram')
+            cumulative = 0
+            for bound, count in zip(METRIC_BUCKETS, values):
+                cumulative += count
+                lines.append(f'{name}_bucket{_prometheus_labels(labels + (("le", f"{bound:g}"),))} {cumulative}')
+            lines.append(f'{name}_bucket{_prometheus_labels(labels + (("le", "+Inf"),))} {values[-1]}')
+            lines.append(f'{name}_sum{_prometheus_labels(labels)} {values[-2]:.6f}')
+            lines.append(f'{name}_count{_prometheus_labels(labels)} {values[-1]}')
+        return '\n'.join(lines) + '\n'
+    
+    def serve(self, port: int, host: str = '127.0.0.1'):
+        """Serve ``/metrics`` over HTTP from a daemon thread."""
+        metrics = self
+        
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass  # Scrapes would flood the console
+        
+        self._server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+        return self._server
+    
+    def close(self):
+        """Stop the HTTP endpoint and close the event stream."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._events is not None:
+            with self._lock:
+                self._events.close()
+                self._events = None
+
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rotations (
+    ts REAL NOT NULL, backend TEXT, old_ip BLOB, new_ip BLOB, exit_fp BLOB,
+    country TEXT, seconds REAL, outcome TEXT, phases TEXT);
+CREATE INDEX IF NOT EXISTS rotations_ts ON rotations (ts);
+CREATE TABLE IF NOT EXISTS latency_hourly (
+    hour INTEGER, backend TEXT, country TEXT, outcome TEXT, bucket INTEGER, count INTEGER,
+    PRIMARY KEY (hour, backend, country, outcome, bucket)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS exits (
+    ip BLOB PRIMARY KEY, first_seen REAL, last_seen REAL, rotations INTEGER) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS exits_last_seen ON exits (last_seen);
+"""
+# Rotation latencies are rolled up in buckets 5% apart
+HISTORY_BUCKET_BASE = 1.05
+
+
+def _packed_ip(address: Optional[str]) -> Optional[bytes]:
+    try:
+        return ipaddress.ip_address(address).packed
+    except ValueError:
+        return None  # Missing or "Unknown"
+
+
+def _packed_fingerprint(fingerprint: Optional[str]) -> Optional[bytes]:
+    try:
+        packed = bytes.fromhex(fingerprint)
+    except (TypeError, ValueError):
+        return None  # A hop known only by nickname
+    return packed if len(packed) == 20 else None
+
+
+def _unpacked_ip(packed: Optional[bytes]) -> Optional[str]:
+    return str(ipaddress.ip_address(packed)) if packed else None
+
+
+def _latency_bucket(seconds: float) -> int:
+    return math.floor(math.log(max(seconds, 1e-4), HISTORY_BUCKET_BASE))
+
+
+def _bucket_percentile(buckets: collections.Counter, fraction: float) -> Optional[float]:
+    """Latency at ``fraction`` of a bucket histogram (to within 5%)."""
+    total = sum(buckets.values())
+    seen = 0
+    for bucket in sorted(buckets):
+        seen += buckets[bucket]
+        if seen >= fraction * total:
+            return HISTORY_BUCKET_BASE ** (bucket + 0.5)
+    return None
+
+
+class RotationHistory:
+    """Append-only record of every rotation in SQLite (WAL mode).
+    
+    :meth:`add` only queues the record; a writer thread inserts whatever
+    is queued in one transaction per ``flush_interval``. Next to the raw
+    rows it keeps hourly latency histograms per backend and country and
+    one row per exit IP, so the ``--history`` queries read at most an
+    hour of raw rows however many rotations are stored.
+    """
+    
+    def __init__(self, path: str, flush_interval: float = 1.0, max_pending: int = 100000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.pending = collections.deque(maxlen=max_pending)
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def _connect(self, readonly: bool = False) -> sqlite3.Connection:
+        if readonly:
+            return sqlite3.connect(f'file:{urllib.parse.quote(self.path)}?mode=ro', uri=True)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Opened here so errors surface in start(), then used by the writer thread only
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')  # WAL stays consistent; a crash loses at most a batch
+        conn.executescript(HISTORY_SCHEMA)
+        return conn
+    
+    def start(self):
+        """Open the store and start the writer thread."""
+        conn = self._connect()
+        self._thread = threading.Thread(target=self._run, args=(conn,), name='history-writer',
+                                        daemon=True)
+        self._thread.start()
+    
+    def add(self, record: Dict):
+        """Queue one finished rotation (``ts``, ``outcome``, ``seconds``,
+        ``phases`` and the fields it was annotated with)."""
+        self.pending.append(record)
+    
+    def close(self):
+        """Write what is queued and stop the writer."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(10)
+            self._thread = None
+    
+    def _run(self, conn: sqlite3.Connection):
+        try:
+            while not self._stop.wait(self.flush_interval):
+                self._flush(conn)
+            self._flush(conn)
+        finally:
+            conn.close()
+    
+    def _flush(self, conn: sqlite3.Connection):
+        batch = []
+        while self.pending:
+            batch.append(self.pending.popleft())
+        if not batch:
+            return
+        try:
+            self.write(conn, batch)
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            logging.getLogger(__name__).warning(f"Cannot write rotation history: {e}")
+    
+    @staticmethod
+    def write(conn: sqlite3.Connection, batch: List[Dict]):
+        """Insert records and update the rollups in one transaction."""
+        rows = []
+        hourly = collections.Counter()
+        exits = {}
+        for record in batch:
+            ts, seconds = record['ts'], record.get('seconds') or 0.0
+            backend, country = record.get('backend') or '', record.get('country') or ''
+            outcome = record.get('outcome') or ''
+            new_ip = _packed_ip(record.get('new_ip'))
+            rows.append((ts, backend, _packed_ip(record.get('old_ip')), new_ip,
+                         _packed_fingerprint(record.get('exit')), country, seconds, outcome,
+                         json.dumps(record.get('phases') or {}, separators=(',', ':'))))
+            hourly[(int(ts // 3600), backend, country, outcome, _latency_bucket(seconds))] += 1
+            if new_ip and outcome == 'success':
+                first, last, count = exits.get(new_ip, (ts, ts, 0))
+                exits[new_ip] = (min(first, ts), max(last, ts), count + 1)
+        with conn:
+            conn.executemany('INSERT INTO rotations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.executemany(
+                'INSERT INTO latency_hourly VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (hour, backend, country, outcome, bucket) '
+                'DO UPDATE SET count = count + excluded.count',
+                [key + (count,) for key, count in hourly.items()])
+            conn.executemany(
+                'INSERT INTO exits VALUES (?, ?, ?, ?) ON CONFLICT (ip) DO UPDATE SET '
+                'first_seen = min(first_seen, excluded.first_seen), '
+                'last_seen = max(last_seen, excluded.last_seen), '
+                'rotations = rotations + excluded.rotations',
+                [(ip,) + entry for ip, entry in exits.items()])
+    
+    def _histograms(self, conn: sqlite3.Connection, since: float) -> Dict[Tuple[str, str, str], collections.Counter]:
+        """(backend, country, outcome) -> latency buckets of the rotations since ``since``."""
+        first_hour = math.ceil(since / 3600)
+        histograms = collections.defaultdict(collections.Counter)
+        for backend, country, outcome, bucket, count in conn.execute(
+                'SELECT backend, country, outcome, bucket, SUM(count) FROM latency_hourly '
+                'WHERE hour >= ? GROUP BY backend, country, outcome, bucket', (first_hour,)):
+            histograms[(backend, country, outcome)][bucket] += count
+        # The part of the window before the first whole hour comes from the raw rows
+        for backend, country, outcome, seconds in conn.execute(
+                'SELECT backend, country, outcome, seconds FROM rotations WHERE ts >= ? AND ts < ?',
+                (since, first_hour * 3600)):
+            histograms[(backend, country, outcome)][_latency_bucket(seconds)] += 1
+        return histograms
+    
+    def summary(self, since: float) -> Dict:
+        """Rotations by backend and outcome, unique exits and the IP reuse rate since ``since``."""
+        with contextlib.closing(self._connect(readonly=True)) as conn:
+            histograms = self._histograms(conn, since)
+            unique = conn.execute('SELECT COUNT(*) FROM exits WHERE last_seen >= ?', (since,)).fetchone()[0]
+        outcomes = collections.Counter()
+        for (backend, _, outcome), buckets in histograms.items():
+            outcomes[(backend, outcome)] += sum(buckets.values())
+        successes = sum(count for (_, outcome), count in outcomes.items() if outcome == 'success')
+        return {'rotations': dict(outcomes), 'successes': successes, 'unique_exits': unique,
+                # Share of successful rotations that landed on an IP seen before in the window
+                'reuse_rate': 1 - unique / successes if successes else 0.0}
+    
+    def latency_by_country(self, since: float) -> List[Tuple[str, int, float, float]]:
+        """(country, rotations, p50, p95) of successful rotations since ``since``, slowest first."""
+        with contextlib.closing(self._connect(readonly=True)) as conn:
+            histograms = self._histograms(conn, since)
+        by_country = collections.defaultdict(collections.Counter)
+        for (_, country, outcome), buckets in histograms.items():
+            if outcome == 'success':
+                by_country[country].update(buckets)
+        rows = [(country, sum(buckets.values()), _bucket_percentile(buckets, 0.5),
+                 _bucket_percentile(buckets, 0.95)) for country, buckets in by_country.items()]
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+    
+    def recent(self, limit: int = 20) -> List[Dict]:
+        """The last ``limit`` rotations, newest first."""
+        with contextlib.closing(self._connect(readonly=True)) as conn:
+            rows = conn.execute('SELECT * FROM rotations ORDER BY ts DESC LIMIT ?', (limit,)).fetchall()
+        return [{'ts': ts, 'backend': backend, 'old_ip': _unpacked_ip(old_ip), 'new_ip': _unpacked_ip(new_ip),
+                 'exit': exit_fp.hex().upper() if exit_fp else None, 'country': country,
+                 'seconds': seconds, 'outcome': outcome, 'phases': json.loads(phases)}
+                for ts, backend, old_ip, new_ip, exit_fp, country, seconds, outcome, phases in rows]
+
+
+# Largest read per splice(2) / recv_into call in the front proxy
+PROXY_CHUNK = 1 << 16
+PROXY_SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+PROXY_MAX_HEADER = 16384
+
+HTTP_PROXY_HOP_HEADERS = ('connection', 'proxy-connection', 'keep-alive', 'proxy-authorization')
+
+
+def _wait_fd(loop, fd: int, writable: bool = False):
+    """Future resolved once ``fd`` is readable (or writable)."""
+    if writable:
+        add, remove = loop.add_writer, loop.remove_writer
+    else:
+        add, remove = loop.add_reader, loop.remove_reader
+    future = loop.create_future()
+
+    def ready():
+        remove(fd)
+        if not future.done():
+            future.set_result(None)
+
+    add(fd, ready)
+    future.add_done_callback(lambda _: remove(fd))
+    return future
+
+
+class ProxyStream:
+    """One client connection relayed by :class:`FrontProxy`."""
+
+    __slots__ = ('generation', 'key', 'sent', 'received')
+
+    def __init__(self, generation: int):
+        self.generation = generation
+        self.key = None
+        self.sent = 0
+        self.received = 0
+
+
+class ClientTable:
+    """Maps client keys to isolated Tor circuits, evicting the least recently used.
+
+    Each key gets SOCKS credentials of its own, and Tor's IsolateSOCKSAuth
+    (on by default) gives each set of credentials its own circuit. A key is
+    rotated by issuing new credentials, which needs no NEWNYM and leaves
+    every other client's circuit alone. Keys rotate on their own every
+    ``interval`` seconds (0: only through :meth:`rotate`).
+    """
+
+    def __init__(self, capacity: int = 10000, interval: float = 0.0,
+                 metrics: Optional[Metrics] = None,
+                 on_rotate: Optional[Callable[[str], None]] = None,
+                 on_evict: Optional[Callable[[str], None]] = None):
+        self.capacity = capacity
+        self.interval = interval
+        self.metrics = metrics or Metrics()
+        self.on_rotate = on_rotate
+        self.on_evict = on_evict
+        # key -> [SOCKS credentials, monotonic time they were issued]
+        self._entries = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def credentials(self, key: str) -> Tuple[str, str]:
+        """SOCKS credentials selecting ``key``'s current circuit."""
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = [self._issue(), now]
+            if len(self._entries) > self.capacity:
+                evicted, _ = self._entries.popitem(last=False)
+                self.metrics.inc('ip_phantom_client_evictions_total')
+                if self.on_evict:
+                    self.on_evict(evicted)
+        else:
+            self._entries.move_to_end(key)
+            if self.interval and now - entry[1] >= self.interval:
+                self._rotate(key, entry, 'schedule')
+        return entry[0]
+
+    def rotate(self, key: str, reason: str = 'request') -> bool:
+        """Give ``key`` a new circuit for its next connections. False if unknown."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return False
+        self._rotate(key, entry, reason)
+        return True
+
+    def _rotate(self, key: str, entry: List, reason: str):
+        entry[:] = [self._issue(), time.monotonic()]
+        self.metrics.inc('ip_phantom_client_rotations_total', reason=reason)
+        if self.on_rotate:
+            self.on_rotate(key)
+
+    @staticmethod
+    def _issue() -> Tuple[str, str]:
+        return f'client-{secrets.token_hex(8)}', secrets.token_hex(8)
+
+
+class FrontProxy:
+    """Local SOCKS5 / HTTP proxy that clients are pointed at once.
+
+    Every new connection goes out through whichever Tor instance and circuit
+    is current: ``upstream(key)`` returns its SOCKS endpoint (or ``None`` to
+    connect directly) and credentials. ``key`` identifies the client - the
+    SOCKS5 username, the username in ``Proxy-Authorization`` or the
+    ``key_header`` header - and is ``None`` for anonymous clients, so each
+    key can be given a circuit of its own (``isolated``). After
+    :meth:`rotated`, connections opened earlier may finish for
+    ``drain_timeout`` seconds before they are closed, so long-lived clients
+    reconnect on the new identity instead of being cut off mid-request.
+
+    Accepts SOCKS5 (CONNECT, no auth or username/password), HTTP CONNECT and
+    plain ``http://`` requests. ``usage`` (a :class:`RotationScheduler`)
+    is told about every upstream connect and the bytes relayed per key.
+    Data is moved with splice(2) through a pipe
+    where the platform has it, so payload never enters Python; elsewhere a
+    reused buffer and ``recv_into`` are used.
+    """
+
+    def __init__(self, upstream: Callable[[Optional[str]], Tuple[Optional[Tuple[str, int]],
+                                                                  Optional[Tuple[str, str]]]],
+                 host: str = '127.0.0.1', port: int = 9080, drain_timeout: float = 30.0,
+                 connect_timeout: float = 30.0, metrics: Optional[Metrics] = None,
+                 zero_copy: bool = True, backlog: int = 1024,
+                 key_header: str = 'X-Phantom-Client', isolated: bool = False,
+                 usage: Optional['RotationScheduler'] = None):
+        self.upstream = upstream
+        self.usage = usage
+        self.key_header = key_header.lower()
+        self.isolated = isolated
+        self.host = host
+        self.port = port
+        self.drain_timeout = drain_timeout
+        self.connect_timeout = connect_timeout
+        self.metrics = metrics or Metrics()
+        self.zero_copy = zero_copy and hasattr(os, 'splice')
+        self.backlog = backlog
+        self.generation = 0
+        self.streams = {}
+        self._sock = None
+
+    def listen(self):
+        """Bind the listening socket (port 0 picks a free port)."""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((self.host, self.port))
+            sock.listen(self.backlog)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self.port = sock.getsockname()[1]
+
+    async def serve(self):
+        """Accept connections until cancelled, then close every stream."""
+        if self._sock is None:
+            self.listen()
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                try:
+                    client, _ = await loop.sock_accept(self._sock)
+                except OSError as e:
+                    # Typically out of file descriptors: back off instead of spinning
+                    logging.getLogger(__name__).warning(f"Front proxy accept failed: {e}")
+                    await asyncio.sleep(0.1)
+                    continue
+                stream = ProxyStream(self.generation)
+                task = asyncio.ensure_future(self._handle(loop, client, stream))
+                self.streams[task] = stream
+                task.add_done_callback(self.streams.pop)
+        finally:
+            self._sock.close()
+            self._sock = None
+            tasks = list(self.streams)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def rotated(self, key: Optional[str] = None):
+        """Mark a rotation: connections opened before it start draining.
+
+        With ``isolated`` only the connections of client ``key`` (``None``:
+        anonymous clients) are affected.
+        """
+        self.generation += 1
+        if self.streams:
+            asyncio.get_running_loop().call_later(self.drain_timeout, self._close_streams,
+                                                  self.generation, key if self.isolated else None)
+
+    def _close_streams(self, generation: int, key: Optional[str]):
+        drained = [task for task, stream in self.streams.items()
+                   if stream.generation < generation and stream.key == key]
+        for task in drained:
+            task.cancel()
+        if drained:
+            self.metrics.inc('ip_phantom_proxy_drained_total', len(drained))
+
+    async def _handle(self, loop, client: socket.socket, stream: ProxyStream):
+        upstream = None
+        try:
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            request = await asyncio.wait_for(self._read_request(loop, client), self.connect_timeout)
+            if request is None:
+                return
+            protocol, host, port, ok_reply, error_reply, pending, key = request
+            if self.isolated:
+                stream.key = key
+            socks, auth = self.upstream(key)
+            started = loop.time()
+            try:
+                if socks is None:
+                    upstream = await asyncio.wait_for(self._connect_direct(loop, host, port),
+                                                      self.connect_timeout)
+                else:
+                    upstream = await asyncio.wait_for(async_socks5_connect(socks, host, port, auth),
+                                                      self.connect_timeout)
+            except ASYNC_IO_ERRORS + (asyncio.TimeoutError,):
+                self.metrics.inc('ip_phantom_proxy_connections_total', protocol=protocol, result='error')
+                if self.usage:
+                    self.usage.record_connect(stream.key, loop.time() - started, ok=False)
+                await loop.sock_sendall(client, error_reply)
+                return
+            self.metrics.inc('ip_phantom_proxy_connections_total', protocol=protocol, result='ok')
+            if self.usage:
+                self.usage.record_connect(stream.key, loop.time() - started, ok=True)
+            if ok_reply:
+                await loop.sock_sendall(client, ok_reply)
+            if pending:
+                await loop.sock_sendall(upstream, pending)
+                stream.sent += len(pending)
+            await self._relay(loop, client, upstream, stream)
+        except (asyncio.TimeoutError, ValueError, UnicodeError) + ASYNC_IO_ERRORS:
+            pass  # Malformed request or a peer went away
+        finally:
+            client.close()
+            if upstream is not None:
+                upstream.close()
+            if stream.sent or stream.received:
+                self.metrics.inc('ip_phantom_proxy_bytes_total', stream.sent, direction='sent')
+                self.metrics.inc('ip_phantom_proxy_bytes_total', stream.received, direction='received')
+                if self.usage:
+                    self.usage.record(stream.key, nbytes=stream.sent + stream.received)
+
+    @staticmethod
+    async def _connect_direct(loop, host: str, port: int) -> socket.socket:
+        infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        family, kind, proto, _, address = infos[0]
+        sock = socket.socket(family, kind, proto)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        except BaseException:
+            sock.close()
+            raise
+
+    async def _read_request(self, loop, client: socket.socket):
+        """Read a SOCKS5 or HTTP proxy request.
+
+        Returns (protocol, host, port, success reply, error reply, bytes to
+        forward first, client key), or None if the client was answered already.
+        """
+        first = await loop.sock_recv(client, 1)
+        if not first:
+            return None
+        if first == b'\x05':
+            return await self._read_socks5(loop, client)
+        return await self._read_http(loop, client, first)
+
+    async def _read_socks5(self, loop, client: socket.socket):
+        methods = await _async_recv_exact(loop, client, (await _async_recv_exact(loop, client, 1))[0])
+        key = None
+        if 2 in methods:
+            await loop.sock_sendall(client, b'\x05\x02')
+            _, user_len = await _async_recv_exact(loop, client, 2)
+            key = (await _async_recv_exact(loop, client, user_len)).decode('utf-8', 'replace') or None
+            await _async_recv_exact(loop, client, (await _async_recv_exact(loop, client, 1))[0])
+            await loop.sock_sendall(client, b'\x01\x00')
+        elif 0 in methods:
+            await loop.sock_sendall(client, b'\x05\x00')
+        else:
+            await loop.sock_sendall(client, b'\x05\xff')
+            return None
+
+        _, command, _, address_type = await _async_recv_exact(loop, client, 4)
+        if address_type == 1:
+            host = socket.inet_ntop(socket.AF_INET, await _async_recv_exact(loop, client, 4))
+        elif address_type == 4:
+            host = socket.inet_ntop(socket.AF_INET6, await _async_recv_exact(loop, client, 16))
+        elif address_type == 3:
+            host = (await _async_recv_exact(loop, client, (await _async_recv_exact(loop, client, 1))[0])).decode('idna')
+        else:
+            await loop.sock_sendall(client, b'\x05\x08\x00\x01' + bytes(6))
+            return None
+        port = int.from_bytes(await _async_recv_exact(loop, client, 2), 'big')
+        if command != 1:
+            await loop.sock_sendall(client, b'\x05\x07\x00\x01' + bytes(6))
+            return None
+        return ('socks5', host, port, b'\x05\x00\x00\x01' + bytes(6),
+                b'\x05\x01\x00\x01' + bytes(6), b'', key)
+
+    async def _read_http(self, loop, client: socket.socket, data: bytes):
+        while b'\r\n\r\n' not in data:
+            if len(data) > PROXY_MAX_HEADER:
+                await loop.sock_sendall(client, b'HTTP/1.1 431 Request Header Fields Too Large\r\n'
+                                                b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+                return None
+            chunk = await loop.sock_recv(client, 4096)
+            if not chunk:
+                return None
+            data += chunk
+        head, _, body = data.partition(b'\r\n\r\n')
+        request_line, *header_lines = head.decode('latin-1').split('\r\n')
+        method, target, version = request_line.split()
+        key = None
+        for line in header_lines:
+            name, _, value = line.partition(':')
+            name, value = name.strip().lower(), value.strip()
+            if name == self.key_header and value:
+                key = value
+            elif name == 'proxy-authorization' and key is None:
+                scheme, _, credentials = value.partition(' ')
+                if scheme.lower() == 'basic':
+                    key = base64.b64decode(credentials).decode('utf-8', 'replace').partition(':')[0] or None
+        error_reply = b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+        if method.upper() == 'CONNECT':
+            host, _, port = target.rpartition(':')
+            return ('http', host.strip('[]'), int(port),
+                    b'HTTP/1.1 200 Connection established\r\n\r\n', error_reply, body, key)
+
+        parts = urllib.parse.urlsplit(target)
+        if parts.scheme != 'http' or not parts.hostname:
+            await loop.sock_sendall(client, b'HTTP/1.1 400 Bad Request\r\n'
+                                            b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+            return None
+        # Forward in origin form; one request per connection, as the next
+        # one on a kept-alive connection could be for another host
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        headers = [line for line in header_lines
+                   if line.partition(':')[0].strip().lower() not in HTTP_PROXY_HOP_HEADERS + (self.key_header,)]
+        forwarded = '\r\n'.join([f'{method} {path} {version}'] + headers + ['Connection: close', '', ''])
+        return ('http', parts.hostname, parts.port or 80, b'', error_reply,
+                forwarded.encode('latin-1') + body, key)
+
+    async def _relay(self, loop, client: socket.socket, upstream: socket.socket, stream: ProxyStream):
+        pump = self._splice if self.zero_copy else self._copy
+        pumps = [asyncio.ensure_future(pump(loop, client, upstream, stream, 'sent')),
+                 asyncio.ensure_future(pump(loop, upstream, client, stream, 'received'))]
+        try:
+            await asyncio.gather(*pumps)
+        finally:
+            for task in pumps:
+                task.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
+
+    @staticmethod
+    async def _splice(loop, source: socket.socket, target: socket.socket,
+                      stream: ProxyStream, counter: str):
+        read_end, write_end = os.pipe()
+        try:
+            while True:
+                try:
+                    moved = os.splice(source.fileno(), write_end, PROXY_CHUNK, flags=PROXY_SPLICE_FLAGS)
+                except BlockingIOError:
+                    await _wait_fd(loop, source.fileno())
+                    continue
+                if not moved:
+                    break
+                while moved:
+                    try:
+                        written = os.splice(read_end, target.fileno(), moved, flags=PROXY_SPLICE_FLAGS)
+                    except BlockingIOError:
+                        await _wait_fd(loop, target.fileno(), writable=True)
+                        continue
+                    moved -= written
+                    setattr(stream, counter, getattr(stream, counter) + written)
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+        FrontProxy._half_close(target)
+
+    @staticmethod
+    async def _copy(loop, source: socket.socket, target: socket.socket,
+                    stream: ProxyStream, counter: str):
+        buffer = bytearray(PROXY_CHUNK)
+        view = memoryview(buffer)
+        while True:
+            received = await loop.sock_recv_into(source, buffer)
+            if not received:
+                break
+            await loop.sock_sendall(target, view[:received])
+            setattr(stream, counter, getattr(stream, counter) + received)
+        FrontProxy._half_close(target)
+
+    @staticmethod
+    def _half_close(sock: socket.socket):
+        # Pass the EOF on; the other direction may still be sending
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
             pass
-        except Exception:
-            # Let other exceptions bubble up
-            self.handleError(record)
+
+
+# Regions accepted in exit_countries, as ISO 3166 country codes
+EXIT_REGIONS = {
+    'eu': ['at', 'be', 'bg', 'hr', 'cy', 'cz', 'dk', 'ee', 'fi', 'fr', 'de', 'gr', 'hu', 'ie',
+           'it', 'lv', 'lt', 'lu', 'mt', 'nl', 'pl', 'pt', 'ro', 'sk', 'si', 'es', 'se'],
+    'europe': ['at', 'be', 'bg', 'ch', 'cz', 'de', 'dk', 'ee', 'es', 'fi', 'fr', 'gb', 'gr', 'hr',
+               'hu', 'ie', 'is', 'it', 'lt', 'lu', 'lv', 'md', 'nl', 'no', 'pl', 'pt', 'ro', 'rs',
+               'se', 'si', 'sk', 'ua'],
+    'north_america': ['us', 'ca', 'mx'],
+    'south_america': ['ar', 'br', 'cl', 'co', 'pe', 'uy'],
+    'asia': ['hk', 'id', 'in', 'jp', 'kr', 'my', 'sg', 'th', 'tw', 'vn'],
+    'oceania': ['au', 'nz'],
+    'africa': ['ke', 'ng', 'za'],
+}
+
+# Control-port events used to follow circuit changes
+TOR_EVENTS = ('CIRC', 'STREAM', 'NOTICE', 'STATUS_CLIENT')
+
+# Tor acts on at most one NEWNYM per 10 seconds and delays the rest
+NEWNYM_INTERVAL = 10.0
+
+# IP-echo services; each answers with JSON containing "origin" or "ip"
+DEFAULT_IP_SERVICES = [
+    "https://httpbin.org/ip",
+    "https://api.ipify.org?format=json",
+    "https://jsonip.com"
+]
 
 
 def safe_print(*args, **kwargs):
     """Print function that gracefully handles broken pipe errors."""
     try:
-        print(*args, **kwargs)
+        # One write per line, so the log writer thread cannot land mid-line
+        sep, end = kwargs.pop('sep', ' '), kwargs.pop('end', '\n')
+        print(sep.join(map(str, args)) + end, end='', **kwargs)
         sys.stdout.flush()
     except (BrokenPipeError, ConnectionResetError):
         # Silently ignore broken pipe errors
@@ -66,37 +2946,151 @@ class IPPhantom:
         ]
         self.demo_counter = 0
         self.shutting_down = False
-        self.tor_process = None
         self.tor_control_password = None
+        self.tor_instance_count = 1
+        self.tor_base_port = 9050
+        self.tor_data_root = os.path.join(default_state_dir(), 'tor')
+        self.tor_instances = []
+        self.active_tor = None
+        self._tor_executor = None
+        self.active_identity = None
+        self.prewarm_depth = 0
+        self.prewarm_max_age = 240.0
+        self.prebuilder = None
+        self.config = {}
+        self.rotation_method = 'tor'
+        self.tor_fallback = True
+        self.openvpn_binary = 'openvpn'
+        self.ip_binary = 'ip'
+        self.vpn_connect_timeout = 30.0
+        # Route and openvpn commands need root; sudo never prompts (-n)
+        self.vpn_sudo = os.geteuid() != 0
+        self.endpoints = None
+        self.active_endpoint = None
+        self.active_tunnel = None
+        self._standby = None
+        self._endpoint_turn = 0
+        self._endpoint_executor = None
+        self._default_route = None
+        self._pinned_routes = set()
+        self._tunnels = []
+        self.endpoint_probe_interval = 60.0
+        self.endpoint_probe_concurrency = 50
+        self.endpoint_probe_rate = 20.0
+        self.endpoint_probe_window = 10
+        self.endpoint_health = None
+        self._endpoint_used = {}
+        self.http_backend = 'native'
+        self.http_client = HTTPClient()
+        self.ip_lookup_mode = 'hedged'
+        self.hedge_delay = 0.5
+        self.direct_services = ServiceTracker(DEFAULT_IP_SERVICES)
+        self.tor_services = ServiceTracker(DEFAULT_IP_SERVICES)
+        self._lookup_executor = None
+        self.circuit_wait_timeout = 3.0
+        self.newnym_interval = NEWNYM_INTERVAL
+        # 'success', 'unchanged' or 'failure'
+        self.last_outcome = None
+        self.health_check_interval = 30.0
+        self.metrics = Metrics()
+        self.metrics_port = 0
+        self.front_proxy_port = 0
+        self.front_proxy_host = '127.0.0.1'
+        self.front_proxy_drain = 30.0
+        self.client_isolation = False
+        self.client_rotation_interval = None
+        self.client_table_size = 10000
+        self.rotation_jitter = 0.0
+        self.rotate_after_requests = 0
+        self.rotate_after_bytes = 0
+        self.rotate_after_failures = 0
+        self.slow_connect_threshold = 0.0
+        self.rotate_idle = True
+        self.exit_index = None
+        self.exit_repeat_retries = 2
+        self.exit_scores = None
+        self.circuit_probe_url = None
+        self.circuit_reject_retries = 2
+        # Probe of the circuit carrying traffic ({'exit', 'ttfb', 'throughput'})
+        self.last_probe = None
+        self.exit_selection = 'tor'
+        self.relay_cache_file = None
+        self.relay_directory = None
+        self.recent_exit_prefixes = collections.deque(maxlen=8)
+        # Last circuit seen built after a NEWNYM ({'id', 'status', 'path', 'purpose'})
+        self.last_circuit = None
+        self.exit_verification = 'echo'
+        self.echo_sample_rate = 0.1
+        # Exit fingerprint -> address an echo check saw instead of the relay's
+        self.observed_exits = {}
+        self.api_socket = None
+        self.api_port = 0
+        self.exit_countries = []
+        self.country_strategy = 'any'
+        self._country_turn = 0
+        self._tor_start_lock = threading.Lock()
+        # Held while spawning or stopping tor processes (not across bootstrap
+        # waits), so shutdown cannot miss a tor the start thread launches
+        self._tor_spawn_lock = threading.Lock()
+        self.history_file = os.path.join(default_state_dir(), 'history.db')
+        self.history = None
+        self.log_file = 'ip_phantom.log'
+        self.log_max_bytes = 10 * 1024 * 1024
+        self.log_backup_count = 5
+        self.log_rotate_interval = 0.0
+        self.log_format = 'text'
         self.setup_logging()
         self.load_configuration()
+        self.tor_instances = self._create_tor_instances()
+        self.active_tor = self.tor_instances[0]
         
         # Setup signal handlers for graceful shutdown
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
     
     def setup_logging(self):
-        """Setup logging configuration."""
-        # Create a custom formatter for clean output
-        formatter = logging.Formatter('%(message)s')
+        """Setup logging configuration.
         
-        # File handler with detailed logs
-        file_handler = logging.FileHandler('ip_phantom.log')
-        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        Callers only put records on a queue; a :class:`LogWriter` thread
+        renders them to the console and the size-bounded log file.
+        """
+        self.logger = logging.getLogger(__name__)
+        # Replace the pipeline of an earlier IPPhantom in this process
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            if isinstance(handler, LogQueueHandler):
+                atexit.unregister(handler.writer.stop)
+                handler.writer.stop()
         
         # Console handler with clean output - wrapped to handle broken pipes
         console_handler = SafeStreamHandler(sys.stdout)
-        console_handler.setFormatter(formatter)
+        console_handler.setFormatter(logging.Formatter('%(message)s'))
+        
+        self.log_file_handler = self._log_file_handler()
+        self.log_writer = LogWriter([console_handler] + ([self.log_file_handler]
+                                                        if self.log_file_handler else []))
+        self.log_writer.start()
+        atexit.register(self.log_writer.stop)  # Write out what is still queued
         
         # Configure logger
-        self.logger = logging.getLogger(__name__)
         self.logger.setLevel(logging.INFO)
-        self.logger.addHandler(file_handler)
-        self.logger.addHandler(console_handler)
+        self.logger.addHandler(LogQueueHandler(self.log_writer))
         
         # Suppress other loggers
         logging.getLogger().setLevel(logging.WARNING)
     
+    def _log_file_handler(self) -> Optional[logging.Handler]:
+        """File handler for the current log settings (None without a log file)."""
+        self._log_settings = (self.log_file, self.log_max_bytes, self.log_backup_count,
+                              self.log_rotate_interval, self.log_format)
+        if not self.log_file:
+            return None
+        handler = RotatingLogHandler(self.log_file, self.log_max_bytes, self.log_backup_count,
+                                     self.log_rotate_interval)
+        handler.setFormatter(JSONLogFormatter() if self.log_format == 'json' else
+                             logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        return handler
+    
     def load_configuration(self):
         """Load VPN/proxy configurations from config file."""
         import os
@@ -113,9 +3107,10 @@ class IPPhantom:
         try:
             with open(config_file, 'r') as f:
                 config = json.load(f)
-                self.vpn_configs = self._validate_vpn_configs(config.get('vpn_configs', []))
-                self.proxy_configs = self._validate_proxy_configs(config.get('proxy_configs', []))
-                self.logger.info(f"Loaded {len(self.vpn_configs)} VPN configs and {len(self.proxy_configs)} proxy configs")
+            self.vpn_configs = self._validate_vpn_configs(config.get('vpn_configs', []))
+            self.proxy_configs = self._validate_proxy_configs(config.get('proxy_configs', []))
+            self._load_settings(config)
+            self.logger.info(f"Loaded {len(self.vpn_configs)} VPN configs and {len(self.proxy_configs)} proxy configs")
         except FileNotFoundError:
             self.logger.warning(f"Config file {config_file} not found. Using default settings.")
             self.create_default_config()
@@ -126,6 +3121,245 @@ class IPPhantom:
             self.logger.error(f"Permission denied accessing config file: {config_file}")
             sys.exit(1)
     
+    def _load_settings(self, config: Dict):
+        """Load and validate the general (non VPN/proxy) settings."""
+        self.config = config
+        
+        http_backend = config.get('http_backend', 'native')
+        if http_backend not in ('native', 'curl'):
+            self.logger.warning(f"Unknown http_backend '{http_backend}', using 'native'")
+            http_backend = 'native'
+        self.http_backend = http_backend
+        
+        services = config.get('ip_services') or [config.get('check_ip_url')] + DEFAULT_IP_SERVICES
+        services = [url for url in dict.fromkeys(services)
+                    if isinstance(url, str) and url.startswith(('http://', 'https://'))]
+        if services:
+            self.direct_services = ServiceTracker(services)
+            self.tor_services = ServiceTracker(services)
+        
+        lookup_mode = config.get('ip_lookup_mode', 'hedged')
+        if lookup_mode not in ('hedged', 'sequential'):
+            self.logger.warning(f"Unknown ip_lookup_mode '{lookup_mode}', using 'hedged'")
+            lookup_mode = 'hedged'
+        self.ip_lookup_mode = lookup_mode
+        
+        try:
+            self.hedge_delay = max(0.0, float(config.get('hedge_delay', 0.5)))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid hedge_delay, using 0.5 seconds")
+            self.hedge_delay = 0.5
+        
+        try:
+            self.tor_instance_count = max(1, int(config.get('tor_instances', 1)))
+            self.tor_base_port = int(config.get('tor_base_port', 9050))
+            if not (1024 <= self.tor_base_port <= 65535 - 10 * self.tor_instance_count):
+                raise ValueError
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid tor_instances/tor_base_port, using one instance on 9050")
+            self.tor_instance_count, self.tor_base_port = 1, 9050
+        self.tor_data_root = os.path.expanduser(config.get('tor_data_root') or self.tor_data_root)
+        
+        try:
+            self.prewarm_depth = max(0, int(config.get('prewarm_depth', 0)))
+            self.prewarm_max_age = float(config.get('prewarm_max_age', 240.0))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid prewarm_depth/prewarm_max_age, disabling pre-built identities")
+            self.prewarm_depth = 0
+        
+        history_file = config.get('history_file')  # null = default path, "" or false = off
+        if history_file is not None:
+            self.history_file = os.path.expanduser(str(history_file)) if history_file else None
+        
+        log_file = config.get('log_file', 'ip_phantom.log')
+        self.log_file = os.path.expanduser(str(log_file)) if log_file else None
+        log_format = config.get('log_format', 'text')
+        if log_format not in ('text', 'json'):
+            self.logger.warning(f"Unknown log_format '{log_format}', using 'text'")
+            log_format = 'text'
+        self.log_format = log_format
+        try:
+            self.log_max_bytes = max(4096, int(config.get('log_max_bytes', 10 * 1024 * 1024)))
+            self.log_backup_count = max(1, int(config.get('log_backup_count', 5)))
+            self.log_rotate_interval = max(0.0, float(config.get('log_rotate_interval', 0)))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid log rotation settings, using 10 MB x 5 files")
+            self.log_max_bytes, self.log_backup_count, self.log_rotate_interval = 10 * 1024 * 1024, 5, 0.0
+        if self._log_settings != (self.log_file, self.log_max_bytes, self.log_backup_count,
+                                  self.log_rotate_interval, self.log_format):
+            previous, self.log_file_handler = self.log_file_handler, self._log_file_handler()
+            self.log_writer.replace(previous, self.log_file_handler)
+        
+        rotation_method = config.get('rotation_method', 'tor')
+        if rotation_method not in ('tor', 'vpn', 'proxy', 'mixed'):
+            self.logger.warning(f"Unknown rotation_method '{rotation_method}', using 'tor'")
+            rotation_method = 'tor'
+        self.rotation_method = rotation_method
+        self.tor_fallback = bool(config.get('tor_fallback', True))
+        self.openvpn_binary = str(config.get('openvpn_binary') or 'openvpn')
+        try:
+            self.vpn_connect_timeout = max(1.0, float(config.get('vpn_connect_timeout', 30)))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid vpn_connect_timeout, using 30 seconds")
+            self.vpn_connect_timeout = 30.0
+        try:
+            self.endpoint_probe_interval = max(0.0, float(config.get('endpoint_probe_interval', 60)))
+            self.endpoint_probe_concurrency = max(1, int(config.get('endpoint_probe_concurrency', 50)))
+            self.endpoint_probe_rate = max(0.1, float(config.get('endpoint_probe_rate', 20)))
+            self.endpoint_probe_window = max(1, int(config.get('endpoint_probe_window', 10)))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid endpoint probe settings, using defaults")
+            self.endpoint_probe_interval, self.endpoint_probe_concurrency = 60.0, 50
+            self.endpoint_probe_rate, self.endpoint_probe_window = 20.0, 10
+        
+        exit_selection = config.get('exit_selection', 'tor')
+        if exit_selection not in ('tor', 'diverse'):
+            self.logger.warning(f"Unknown exit_selection '{exit_selection}', using 'tor'")
+            exit_selection = 'tor'
+        if exit_selection == 'diverse' and self.prewarm_depth:
+            # ExitNodes applies to every circuit of an instance, pre-built ones included
+            self.logger.warning("exit_selection 'diverse' only applies to renewals when prewarm_depth is set")
+        self.exit_selection = exit_selection
+        
+        exit_verification = config.get('exit_verification', 'echo')
+        if exit_verification not in ('echo', 'local'):
+            self.logger.warning(f"Unknown exit_verification '{exit_verification}', using 'echo'")
+            exit_verification = 'echo'
+        self.exit_verification = exit_verification
+        try:
+            self.echo_sample_rate = min(1.0, max(0.0, float(config.get('echo_sample_rate', 0.1))))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid echo_sample_rate, using 0.1")
+            self.echo_sample_rate = 0.1
+        
+        countries = config.get('exit_countries') or []
+        if isinstance(countries, str):
+            countries = [countries]
+        self.exit_countries = []
+        for entry in countries:
+            entry = str(entry).strip().lower()
+            for country in EXIT_REGIONS.get(entry, [entry]):
+                if len(country) == 2 and country.isalpha():
+                    if country not in self.exit_countries:
+                        self.exit_countries.append(country)
+                else:
+                    self.logger.warning(f"Unknown country or region '{entry}' in exit_countries")
+                    break
+        country_strategy = config.get('country_strategy', 'any')
+        if country_strategy not in ('any', 'spread'):
+            self.logger.warning(f"Unknown country_strategy '{country_strategy}', using 'any'")
+            country_strategy = 'any'
+        self.country_strategy = country_strategy
+        self.relay_cache_file = config.get('relay_cache_file') or os.path.join(
+            self.tor_data_root, 'relays.json')
+        
+        try:
+            self.circuit_wait_timeout = max(0.0, float(config.get('circuit_wait_timeout', 3.0)))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid circuit_wait_timeout, using 3 seconds")
+            self.circuit_wait_timeout = 3.0
+        
+        try:
+            self.newnym_interval = max(0.0, float(config.get('newnym_interval', NEWNYM_INTERVAL)))
+        except (TypeError, ValueError):
+            self.logger.warning(f"Invalid newnym_interval, using {NEWNYM_INTERVAL:.0f} seconds")
+            self.newnym_interval = NEWNYM_INTERVAL
+        
+        try:
+            self.health_check_interval = max(0.0, float(config.get('health_check_interval', 30.0)))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid health_check_interval, using 30 seconds")
+            self.health_check_interval = 30.0
+        
+        try:
+            self.metrics_port = int(config.get('metrics_port', 0))
+            if not 0 <= self.metrics_port <= 65535:
+                raise ValueError(self.metrics_port)
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid metrics_port, disabling the metrics endpoint")
+            self.metrics_port = 0
+        
+        try:
+            self.front_proxy_port = int(config.get('front_proxy_port', 0))
+            if not 0 <= self.front_proxy_port <= 65535:
+                raise ValueError(self.front_proxy_port)
+            self.front_proxy_drain = max(0.0, float(config.get('front_proxy_drain', 30.0)))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid front_proxy_port/front_proxy_drain, disabling the front proxy")
+            self.front_proxy_port = 0
+        self.front_proxy_host = str(config.get('front_proxy_host', self.front_proxy_host))
+        
+        api_socket = config.get('api_socket')
+        self.api_socket = os.path.expanduser(str(api_socket)) if api_socket else None
+        try:
+            self.api_port = int(config.get('api_port', 0))
+            if not 0 <= self.api_port <= 65535:
+                raise ValueError(self.api_port)
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid api_port, disabling the HTTP control API")
+            self.api_port = 0
+        
+        self.client_isolation = bool(config.get('client_isolation', False))
+        try:
+            self.client_table_size = max(1, int(config.get('client_table_size', 10000)))
+            interval = config.get('client_rotation_interval')
+            self.client_rotation_interval = None if interval is None else max(0.0, float(interval))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid client_table_size/client_rotation_interval, using defaults")
+            self.client_table_size, self.client_rotation_interval = 10000, None
+        
+        try:
+            self.rotation_jitter = min(1.0, max(0.0, float(config.get('rotation_jitter', 0.0))))
+            self.rotate_after_requests = max(0, int(config.get('rotate_after_requests', 0)))
+            self.rotate_after_bytes = max(0, int(config.get('rotate_after_bytes', 0)))
+            self.rotate_after_failures = max(0, int(config.get('rotate_after_failures', 0)))
+            self.slow_connect_threshold = max(0.0, float(config.get('slow_connect_threshold', 0.0)))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid rotation triggers, rotating on the interval only")
+            self.rotation_jitter = 0.0
+            self.rotate_after_requests = self.rotate_after_bytes = self.rotate_after_failures = 0
+            self.slow_connect_threshold = 0.0
+        self.rotate_idle = bool(config.get('rotate_idle', True))
+        
+        try:
+            history_size = int(config.get('exit_history_size', 100000))
+            history_window = float(config.get('exit_history_window', 3600))
+            self.exit_repeat_retries = max(0, int(config.get('exit_repeat_retries', 2)))
+            history_file = config.get('exit_history_file')
+            if history_size > 0:
+                self.exit_index = ExitIndex(history_size, max(0.0, history_window),
+                                            str(history_file) if history_file else None)
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid exit history settings, using defaults")
+            self.exit_index = ExitIndex()
+            self.exit_repeat_retries = 2
+        except OSError as e:
+            self.logger.warning(f"Cannot open exit_history_file ({e}), keeping exit history in memory")
+            self.exit_index = ExitIndex(history_size, max(0.0, history_window))
+        
+        try:
+            max_ttfb = max(0.0, float(config.get('circuit_max_ttfb', 0)))
+            min_throughput = max(0.0, float(config.get('circuit_min_throughput', 0)))
+            self.circuit_reject_retries = max(0, int(config.get('circuit_reject_retries', 2)))
+        except (TypeError, ValueError):
+            self.logger.warning("Invalid circuit probe settings, circuit probing disabled")
+            max_ttfb = min_throughput = 0.0
+            self.circuit_reject_retries = 2
+        probe_url = config.get('circuit_probe_url')
+        self.circuit_probe_url = str(probe_url) if probe_url else None
+        if min_throughput and not self.circuit_probe_url:
+            self.logger.warning("circuit_min_throughput needs circuit_probe_url, ignoring it")
+            min_throughput = 0.0
+        if max_ttfb or min_throughput:
+            self.exit_scores = ExitScores(max_ttfb, min_throughput)
+        
+        events_file = config.get('metrics_events_file')
+        if events_file:
+            try:
+                self.metrics = Metrics(str(events_file))
+            except OSError as e:
+                self.logger.warning(f"Cannot open metrics_events_file ({e}), event stream disabled")
+    
     def _validate_vpn_configs(self, vpn_configs: List[Dict]) -> List[Dict]:
         """Validate and sanitize VPN configurations."""
         validated_configs = []
@@ -143,7 +3377,6 @@ class IPPhantom:
                 continue
             
             # Security: Validate name contains only safe characters
-            import re
             if not re.match(r'^[a-zA-Z0-9_-]+$', name):
                 self.logger.warning(f"Skipping VPN config with invalid name: {name}")
                 continue
@@ -227,8 +3460,24 @@ class IPPhantom:
                     "enabled": True
                 }
             ],
-            "rotation_method": "vpn",  # "vpn", "proxy", or "mixed"
-            "check_ip_url": "https://httpbin.org/ip"
+            "rotation_method": "tor",  # "tor", "vpn", "proxy" or "mixed"
+            "tor_fallback": True,  # Rotate via Tor when no VPN/proxy endpoint can be used
+            "history_file": None,  # Rotation history database (None = <state dir>/history.db, "" = off)
+            "log_file": "ip_phantom.log",  # null = console only
+            "log_format": "text",  # "text" or "json" (one object per line)
+            "log_max_bytes": 10485760,  # Roll the log file over at this size...
+            "log_backup_count": 5,  # ...keeping this many old files
+            "log_rotate_interval": 0,  # Also roll over every N seconds (0 = by size only)
+            "vpn_connect_timeout": 30,  # Seconds to wait for the next VPN tunnel to come up
+            "endpoint_probe_interval": 60,  # Seconds between health probes of each VPN/proxy (0 = off)
+            "endpoint_probe_rate": 20,  # Probes per second across all endpoints
+            "check_ip_url": "https://httpbin.org/ip",
+            "http_backend": "native",  # "native" (pooled, in-process) or "curl"
+            "ip_lookup_mode": "hedged",  # "hedged" (race services) or "sequential"
+            "hedge_delay": 0.5,  # Seconds before starting a backup request (0 = all at once)
+            "health_check_interval": 30,  # Seconds between Tor health checks (0 = disabled)
+            "front_proxy_port": 0,  # Local SOCKS5/HTTP proxy that follows rotations (0 = disabled)
+            "client_isolation": False  # Give each front proxy client (SOCKS username) its own circuit
         }
         
         # Security: Create config file with secure permissions
@@ -242,6 +3491,104 @@ class IPPhantom:
         except Exception as e:
             self.logger.error(f"Failed to create secure config file: {e}")
     
+    def _fetch_ip(self, url: str, proxy: Optional[Tuple[str, int]] = None,
+                  proxy_auth: Optional[Tuple[str, str]] = None,
+                  cancel: Optional[CancelToken] = None) -> Optional[str]:
+        """Query an IP-echo service and return the address it reports."""
+        if self.http_backend == 'curl':
+            body = self._curl_get(url, proxy, proxy_auth, cancel)
+        else:
+            status, body = self.http_client.get(url, proxy=proxy, proxy_auth=proxy_auth,
+                                                cancel=cancel)
+            if status != 200:
+                return None
+        return parse_ip_response(body)
+    
+    def _curl_get(self, url: str, proxy: Optional[Tuple[str, int]] = None,
+                  proxy_auth: Optional[Tuple[str, str]] = None,
+                  cancel: Optional[CancelToken] = None) -> str:
+        """Fetch a URL with the curl binary (fallback HTTP backend)."""
+        cmd = ['curl', '-s', '--connect-timeout', '10']
+        if proxy:
+            cmd += ['--socks5-hostname', f'{proxy[0]}:{proxy[1]}']
+            if proxy_auth:
+                cmd += ['--proxy-user', f'{proxy_auth[0]}:{proxy_auth[1]}']
+        with subprocess.Popen(cmd + [url], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True) as process:
+            if cancel is not None:
+                cancel.add(process.kill)
+            try:
+                stdout, _ = process.communicate(timeout=15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                raise
+        if process.returncode != 0:
+            raise OSError(f"curl exited with status {process.returncode}")
+        return stdout
+    
+    def _timed_fetch(self, tracker: ServiceTracker, service: str,
+                     proxy: Optional[Tuple[str, int]], proxy_auth: Optional[Tuple[str, str]],
+                     cancel: Optional[CancelToken] = None) -> Optional[str]:
+        """Fetch one service, recording its latency or failure."""
+        start = time.perf_counter()
+        try:
+            ip = self._fetch_ip(service, proxy, proxy_auth, cancel)
+        except (subprocess.TimeoutExpired, json.JSONDecodeError, KeyError,
+                AttributeError, OSError, http.client.HTTPException):
+            ip = None
+        if cancel is not None and cancel.cancelled:
+            return ip  # Lost the race; the abort says nothing about the service
+        elapsed = time.perf_counter() - start
+        tracker.record(service, elapsed if ip else None)
+        self.metrics.inc('ip_phantom_ip_service_requests_total', service=service,
+                         result='ok' if ip else 'error')
+        if ip:
+            self.metrics.observe('ip_phantom_ip_service_seconds', elapsed, service=service)
+        return ip
+    
+    def _lookup_ip(self, via_tor: bool = False, instance: Optional[TorInstance] = None,
+                   proxy_auth: Optional[Tuple[str, str]] = None,
+                   proxy: Optional[Tuple[str, int]] = None) -> Optional[str]:
+        """Look up the current IP using the configured services and mode.
+        
+        Tor lookups go through the active instance unless ``instance`` is
+        given; ``proxy_auth`` selects an isolated circuit on it. ``proxy``
+        looks the IP up through another SOCKS5 proxy instead.
+        """
+        tracker = self.tor_services if via_tor or proxy else self.direct_services
+        if proxy is None and via_tor:
+            proxy = (instance or self.active_tor).socks
+        services = tracker.ranked()
+        
+        if self.ip_lookup_mode == 'sequential':
+            for service in services:
+                ip = self._timed_fetch(tracker, service, proxy, proxy_auth)
+                if ip:
+                    return ip
+            return None
+        
+        # Hedged: start with the fastest service and add a backup request every
+        # hedge_delay seconds until one answers; the losers are then cancelled.
+        if self._lookup_executor is None:
+            self._lookup_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=4 * len(services), thread_name_prefix='ip-lookup')
+        cancel = CancelToken()
+        pending = set()
+        try:
+            while services or pending:
+                if services:
+                    pending.add(self._lookup_executor.submit(
+                        self._timed_fetch, tracker, services.pop(0), proxy, proxy_auth, cancel))
+                done, pending = concurrent.futures.wait(
+                    pending, timeout=self.hedge_delay if services else None,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future.result():
+                        return future.result()
+            return None
+        finally:
+            cancel.cancel()
+    
     def get_current_ip(self) -> Optional[str]:
         """Get current external IP address."""
         if self.demo_mode:
@@ -250,29 +3597,9 @@ class IPPhantom:
             return current_location["ip"]
         
         try:
-            # Using multiple IP check services for reliability
-            ip_services = [
-                "https://httpbin.org/ip",
-                "https://api.ipify.org?format=json",
-                "https://jsonip.com"
-            ]
-            
-            for service in ip_services:
-                try:
-                    result = subprocess.run([
-                        'curl', '-s', '--connect-timeout', '10', service
-                    ], capture_output=True, text=True, timeout=15)
-                    
-                    if result.returncode == 0:
-                        response = json.loads(result.stdout)
-                        # Handle different response formats
-                        ip = response.get('origin') or response.get('ip')
-                        if ip:
-                            # Clean IP (remove port if present)
-                            ip = ip.split(',')[0].strip()
-                            return ip
-                except (subprocess.TimeoutExpired, json.JSONDecodeError, KeyError, BrokenPipeError):
-                    continue
+            ip = self._lookup_ip()
+            if ip:
+                return ip
             
             self.logger.error("Failed to get current IP from all services")
             return None
@@ -285,85 +3612,317 @@ class IPPhantom:
                 self.logger.error(f"Error getting current IP: {e}")
             return None
     
-    def disconnect_current_vpn(self):
-        """Disconnect current VPN connection."""
-        if self.demo_mode:
-            return  # No actual VPN to disconnect in demo mode
-            
-        # If shutting down, skip VPN cleanup to avoid password prompts
-        if self.shutting_down:
+    def _vpn_endpoint(self, vpn_config: Dict) -> Optional[Dict]:
+        """A rotation endpoint for a VPN config, or None if its file is unusable."""
+        config_file = vpn_config.get('config_file')
+        if not config_file:
+            self.logger.error(f"No config file specified for VPN: {vpn_config['name']}")
+            return None
+        
+        # Security: Validate and sanitize config file path
+        config_file = os.path.abspath(config_file)
+        if not os.path.exists(config_file):
+            self.logger.error(f"VPN config file not found: {config_file}")
+            return None
+        if not config_file.endswith('.ovpn'):
+            self.logger.error(f"Security: Invalid VPN config file extension: {config_file}")
+            return None
+        return {**vpn_config, 'kind': 'vpn', 'config_file': config_file}
+    
+    def _rotation_endpoints(self) -> List[Dict]:
+        """The enabled VPN tunnels and proxies to rotate through, in turn.
+        
+        ``mixed`` alternates between VPNs and proxies. Only SOCKS5 proxies
+        can carry the IP lookups and the front proxy's traffic.
+        """
+        vpns, proxies = [], []
+        if self.rotation_method in ('vpn', 'mixed'):
+            for vpn_config in self.vpn_configs:
+                endpoint = self._vpn_endpoint(vpn_config) if vpn_config['enabled'] else None
+                if endpoint:
+                    vpns.append(endpoint)
+        if self.rotation_method in ('proxy', 'mixed'):
+            for proxy_config in self.proxy_configs:
+                if not proxy_config['enabled']:
+                    continue
+                if proxy_config['type'] not in ('socks5', 'socks5h'):
+                    self.logger.warning(f"Skipping proxy {proxy_config['name']}: "
+                                        f"{proxy_config['type']} proxies are not supported")
+                    continue
+                proxies.append({**proxy_config, 'kind': 'proxy'})
+        return [endpoint for pair in itertools.zip_longest(vpns, proxies)
+                for endpoint in pair if endpoint is not None]
+    
+    def _load_endpoints(self):
+        if self.endpoints is not None:
             return
-            
+        self.endpoints = self._rotation_endpoints()
+        if not self.endpoints:
+            self.logger.warning(f"No usable endpoints for rotation_method '{self.rotation_method}'")
+        elif self.endpoint_probe_interval:
+            self.endpoint_health = EndpointHealth(self.endpoints, self.endpoint_probe_window)
+    
+    def _next_endpoint(self) -> Optional[Dict]:
+        """The next endpoint other than the one carrying traffic.
+        
+        With endpoint probing, rotations cycle through the fastest quarter
+        of the endpoints that answered their last probes (or, before any
+        answered, through those not probed yet); otherwise through all
+        endpoints in turn.
+        """
+        self._load_endpoints()
+        if self.endpoint_health is not None:
+            health = self.endpoint_health
+            ranked = [endpoint for endpoint in health.ranked() if endpoint is not self.active_endpoint]
+            measured = [endpoint for endpoint in ranked if health.measured(endpoint)]
+            candidates = measured[:max(2, len(measured) // 4)] or ranked
+            if not candidates:
+                return None
+            # Least recently used first, so the fastest few take turns
+            endpoint = min(candidates, key=lambda e: self._endpoint_used.get(endpoint_key(e), -1))
+            self._endpoint_used[endpoint_key(endpoint)] = self._endpoint_turn
+            self._endpoint_turn += 1
+            return endpoint
+        for _ in range(len(self.endpoints)):
+            endpoint = self.endpoints[self._endpoint_turn % len(self.endpoints)]
+            self._endpoint_turn += 1
+            if endpoint is not self.active_endpoint:
+                return endpoint
+        return None
+    
+    def _prepare_endpoint(self, endpoint: Dict) -> Optional[Dict]:
+        """Bring an endpoint up next to the current one without touching routing.
+        
+        A proxy only needs its exit IP looked up through it; a VPN tunnel is
+        started on the free tun device, with host routes that keep its
+        server reachable through the physical gateway once traffic moves
+        off the current tunnel.
+        """
+        if endpoint['kind'] == 'proxy':
+            exit_ip = self._lookup_ip(proxy=(endpoint['host'], endpoint['port']))
+            if not exit_ip:
+                self.logger.warning(f"Proxy {endpoint['name']} is not reachable")
+                return None
+            return {'endpoint': endpoint, 'tunnel': None, 'exit_ip': exit_ip}
+        
+        busy = {tunnel.device for tunnel in self._tunnels if tunnel.running}
+        device = next((name for name in VPN_DEVICES if name not in busy), None)
+        if device is None:
+            self.logger.warning(f"No free tun device for VPN {endpoint['name']}")
+            return None
         try:
-            # Security: Use specific process filtering to prevent killing unintended processes
-            subprocess.run(['sudo', 'pkill', '-f', 'openvpn'], 
-                         capture_output=True, check=False, timeout=10)
-            
-            # Reset DNS settings (only if systemd-resolved exists)
-            import shutil
-            if shutil.which('systemctl'):
-                subprocess.run(['sudo', 'systemctl', 'restart', 'systemd-resolved'], 
-                             capture_output=True, check=False, timeout=15)
-            
-            time.sleep(2)  # Wait for disconnection
-            self.logger.info("Disconnected from current VPN")
-            
-        except Exception as e:
-            self.logger.error(f"Error disconnecting VPN: {e}")
+            for host, port in ovpn_remotes(endpoint['config_file']):
+                for info in socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM):
+                    self._pin_route(info[4][0])
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"Cannot resolve the servers of VPN {endpoint['name']}: {e}")
+        
+        tunnel = VPNTunnel(endpoint['name'], endpoint['config_file'], device,
+                           binary=self.openvpn_binary, sudo=self.vpn_sudo)
+        try:
+            tunnel.start()
+        except OSError as e:
+            self.logger.error(f"Cannot start openvpn for VPN {endpoint['name']}: {e}")
+            return None
+        # Drop tunnels whose openvpn exited by itself; stopped ones are removed as they stop
+        self._tunnels = [other for other in self._tunnels if other.running] + [tunnel]
+        if not tunnel.wait_connected(self.vpn_connect_timeout):
+            if not self.shutting_down:  # Otherwise stopped by shutdown
+                self.logger.warning(f"VPN {endpoint['name']} did not connect: {tunnel.last_output()}")
+            self._stop_tunnel(tunnel)
+            return None
+        if tunnel.remote:
+            self._pin_route(tunnel.remote)  # The server openvpn actually picked
+        return {'endpoint': endpoint, 'tunnel': tunnel, 'exit_ip': None}
     
-    def connect_vpn(self, vpn_config: Dict) -> bool:
-        """Connect to a VPN server."""
+    def _prepare_next(self):
+        """Start bringing up the next endpoint in the background."""
+        endpoint = self._next_endpoint()
+        if endpoint is None:
+            self._standby = None
+            return
+        if self._endpoint_executor is None:
+            self._endpoint_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='endpoint-standby')
+        self._standby = self._endpoint_executor.submit(self._prepare_standby, endpoint)
+    
+    def _prepare_standby(self, endpoint: Dict) -> Optional[Dict]:
+        prepared = self._prepare_endpoint(endpoint)
+        if prepared is None and self.endpoint_health is not None and not self.shutting_down:
+            self.endpoint_health.record(endpoint, None)  # Down until a probe finds it up
+        return prepared
+    
+    def _take_standby(self) -> Optional[Dict]:
+        """Wait for the prepared endpoint; None if it could not be brought up."""
+        if self._standby is None:
+            self._prepare_next()
+        future, self._standby = self._standby, None
+        if future is None:
+            return None
         try:
-            config_file = vpn_config.get('config_file')
-            if not config_file:
-                self.logger.error(f"No config file specified for VPN: {vpn_config['name']}")
-                return False
-            
-            # Security: Validate and sanitize config file path
-            import os
-            config_file = os.path.abspath(config_file)
-            if not os.path.exists(config_file):
-                self.logger.error(f"VPN config file not found: {config_file}")
-                return False
-            
-            if not config_file.endswith('.ovpn'):
-                self.logger.error(f"Security: Invalid VPN config file extension: {config_file}")
-                return False
-            
-            # Disconnect current VPN first
-            self.disconnect_current_vpn()
-            
-            # Security: Use secure subprocess execution with explicit arguments
-            cmd = ['sudo', 'openvpn', '--config', config_file, '--daemon', 
-                   '--script-security', '2', '--up-restart', '--down-pre']
-            try:
-                result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-            except subprocess.TimeoutExpired:
-                self.logger.error(f"VPN connection timeout for {vpn_config['name']}")
+            prepared = future.result(timeout=self.vpn_connect_timeout + self.http_client.timeout)
+        except concurrent.futures.TimeoutError:
+            self._standby = future  # Still coming up; use it next time
+            self.logger.warning("The next endpoint is still coming up")
+            return None
+        if prepared is None:
+            self._prepare_next()  # Try the one after it next time
+        return prepared
+    
+    def switch_endpoint(self, prepared: Dict) -> bool:
+        """Move traffic to a prepared endpoint, then stop the previous tunnel."""
+        endpoint, tunnel = prepared['endpoint'], prepared['tunnel']
+        previous = self.active_tunnel
+        if tunnel is not None:
+            # Two /1 routes outrank the default route without replacing it
+            # (openvpn's def1), so switching tunnels is one atomic batch
+            routes = ''.join(f"route replace {net} dev {tunnel.device}\n" for net in DEF1_ROUTES)
+            if self._run_ip(['-batch', '-'], input=routes) is None:
+                self._stop_tunnel(tunnel)
                 return False
-            
-            if result.returncode == 0:
-                self.logger.info(f"Connected to VPN: {vpn_config['name']}")
-                time.sleep(5)  # Wait for connection to establish
-                return True
-            else:
-                # Only log actual errors, not normal termination messages
-                if result.stderr and "BrokenPipeError" not in str(result.stderr):
-                    self.logger.error(f"Failed to connect to VPN {vpn_config['name']}: {result.stderr}")
-                else:
-                    self.logger.error(f"Failed to connect to VPN {vpn_config['name']}")
+            self._clear_proxy()
+        else:
+            if not self.set_proxy(endpoint):
                 return False
-                
-        except (BrokenPipeError, ConnectionResetError):
-            # Silently ignore broken pipe errors - these are expected during VPN switching
+            self._restore_route()
+        self.active_tunnel = tunnel
+        self.active_endpoint = endpoint
+        if previous is not None and previous is not tunnel:
+            self._stop_tunnel(previous)
+        return True
+    
+    def _stop_tunnel(self, tunnel: VPNTunnel):
+        """Stop a tunnel and forget it."""
+        tunnel.stop()
+        if tunnel in self._tunnels:
+            self._tunnels.remove(tunnel)
+    
+    def rotate_ip_via_endpoints(self) -> Optional[bool]:
+        """Rotate to the next VPN tunnel or proxy.
+        
+        The next endpoint is brought up while the current one carries
+        traffic, so a rotation is only a route (or proxy) change. Returns
+        None when no endpoint could be used.
+        """
+        with self.metrics.phase('standby_wait'):
+            prepared = self._take_standby()
+        if prepared is None:
+            return None
+        old_ip = self.current_ip or "Unknown"
+        with self.metrics.phase('switch'):
+            switched = self.switch_endpoint(prepared)
+        self._prepare_next()
+        if not switched:
+            return None
+        endpoint = prepared['endpoint']
+        kind = 'VPN' if endpoint['kind'] == 'vpn' else 'proxy'
+        self.metrics.annotate(backend=endpoint['kind'], path=endpoint['kind'], endpoint=endpoint['name'])
+        if prepared['tunnel'] is not None:
+            # Pooled connections were opened through the previous tunnel
+            self.http_client.close_idle()
+            with self.metrics.phase('post_ip_lookup'):
+                new_ip = self._lookup_ip()
+        else:
+            new_ip = prepared['exit_ip']
+        if not new_ip:
+            self.logger.warning(f"Failed to get IP via {kind} {endpoint['name']}")
             return False
-        except subprocess.TimeoutExpired:
-            self.logger.error(f"VPN connection timeout for {vpn_config['name']}")
+        self.current_ip = new_ip
+        self.metrics.annotate(old_ip=old_ip, new_ip=new_ip)
+        if new_ip == old_ip:
+            self.metrics.annotate(outcome='unchanged')
+            safe_print(f"⚠️  Switched to {kind} {endpoint['name']} but the IP did not change: {new_ip}")
             return False
-        except Exception as e:
-            if "BrokenPipeError" not in str(e):
-                self.logger.error(f"Error connecting to VPN {vpn_config['name']}: {e}")
+        safe_print(f"👻 IP changed via {kind} {endpoint['name']}: {old_ip} → {new_ip}")
+        return True
+    
+    def _default_gateway(self) -> Optional[Tuple[Optional[str], str]]:
+        """(gateway, device) of the main table's default route."""
+        if self._default_route is None:
+            output = self._run_ip(['-4', 'route', 'show', 'default'])
+            words = output.split() if output else []
+            if 'dev' in words[:-1]:
+                via = words[words.index('via') + 1] if 'via' in words[:-1] else None
+                self._default_route = (via, words[words.index('dev') + 1])
+        return self._default_route
+    
+    def _pin_route(self, ip: str):
+        """Route a VPN server around the tunnels, through the physical gateway."""
+        if ip in self._pinned_routes:
+            return
+        gateway = self._default_gateway()
+        if gateway is None:
+            self.logger.warning(f"No default route to pin VPN server {ip} to")
+            return
+        via, device = gateway
+        if self._run_ip(['route', 'replace', f'{ip}/32'] + (['via', via] if via else [])
+                        + ['dev', device]) is not None:
+            self._pinned_routes.add(ip)
+    
+    def _restore_route(self):
+        """Send traffic back over the default route."""
+        if self.active_tunnel is not None:
+            routes = ''.join(f"route del {net} dev {self.active_tunnel.device}\n" for net in DEF1_ROUTES)
+            self._run_ip(['-force', '-batch', '-'], input=routes)
+    
+    def _run_ip(self, args: List[str], input: Optional[str] = None) -> Optional[str]:
+        """Run ``ip`` with ``args``; its output, or None if it failed."""
+        cmd = [self.ip_binary] + args
+        if self.vpn_sudo:
+            cmd = ['sudo', '-n'] + cmd
+        try:
+            result = subprocess.run(cmd, input=input, capture_output=True, text=True, timeout=10)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            self.logger.error(f"Cannot run ip {' '.join(args)}: {e}")
+            return None
+        if result.returncode != 0:
+            self.logger.error(f"ip {' '.join(args)} failed: {result.stderr.strip()}")
+            return None
+        return result.stdout
+    
+    def _close_endpoints(self):
+        """Stop all tunnels and remove the routes added for them."""
+        if self._endpoint_executor is not None:
+            # A standby not yet started is dropped (cancel_futures needs 3.9)
+            if self._standby is not None:
+                self._standby.cancel()
+                self._standby = None
+            self._endpoint_executor.shutdown(wait=False)
+        self.disconnect_current_vpn()
+        for tunnel in self._tunnels:
+            tunnel.stop()
+        self._tunnels = []
+        if self._pinned_routes:
+            self._run_ip(['-force', '-batch', '-'], input=''.join(
+                f"route del {ip}/32\n" for ip in self._pinned_routes))
+            self._pinned_routes.clear()
+    
+    def disconnect_current_vpn(self):
+        """Disconnect the current VPN tunnel and restore the default route."""
+        if self.demo_mode or self.active_tunnel is None:
+            return  # No VPN to disconnect
+        
+        self._restore_route()
+        self._stop_tunnel(self.active_tunnel)
+        self.logger.info(f"Disconnected from VPN: {self.active_tunnel.name}")
+        self.active_tunnel = None
+        if self.active_endpoint and self.active_endpoint['kind'] == 'vpn':
+            self.active_endpoint = None
+    
+    def connect_vpn(self, vpn_config: Dict) -> bool:
+        """Connect to a VPN server and route traffic through it.
+        
+        The current tunnel keeps carrying traffic until the new one is up.
+        """
+        endpoint = self._vpn_endpoint(vpn_config)
+        if endpoint is None:
             return False
+        prepared = self._prepare_endpoint(endpoint)
+        if prepared is None or not self.switch_endpoint(prepared):
+            self.logger.error(f"Failed to connect to VPN {vpn_config['name']}")
+            return False
+        self.logger.info(f"Connected to VPN: {vpn_config['name']}")
+        return True
     
     def set_proxy(self, proxy_config: Dict) -> bool:
         """Configure system to use proxy."""
@@ -388,138 +3947,425 @@ class IPPhantom:
             self.logger.error(f"Error setting proxy {proxy_config['name']}: {e}")
             return False
     
-    def start_tor(self) -> bool:
-        """Start Tor daemon with our configuration."""
+    @staticmethod
+    def _clear_proxy():
+        for name in ('http_proxy', 'https_proxy', 'HTTP_PROXY', 'HTTPS_PROXY'):
+            os.environ.pop(name, None)
+    
+    @property
+    def uses_tor(self) -> bool:
+        """Whether rotations may go through Tor, so Tor has to run."""
+        return self.rotation_method == 'tor' or self.tor_fallback
+    
+    @property
+    def egress(self) -> Tuple[Optional[Tuple[str, int]], Optional[Tuple[str, str]]]:
+        """(SOCKS endpoint, credentials) traffic should leave through now; no
+        endpoint means connecting directly (over the active VPN tunnel, if any)."""
+        endpoint = self.active_endpoint
+        if endpoint is None:
+            return (self.tor_socks, self.tor_socks_auth) if self.uses_tor else (None, None)
+        if endpoint['kind'] == 'proxy':
+            return (endpoint['host'], endpoint['port']), None
+        return None, None
+    
+    @property
+    def tor_socks(self) -> Tuple[str, int]:
+        """SOCKS endpoint of the Tor instance currently carrying traffic."""
+        return self.active_tor.socks
+    
+    @property
+    def tor_socks_auth(self) -> Optional[Tuple[str, str]]:
+        """SOCKS credentials selecting the active pre-built circuit, if any."""
+        return self.active_identity.auth if self.active_identity else None
+    
+    def _create_tor_instances(self) -> List[TorInstance]:
+        """Build the Tor instance list from the configuration."""
+        if self.tor_instance_count == 1:
+            # Single instance: the bundled torrc and its fixed ports
+            return [TorInstance('tor', 9050, 9051, '/tmp/tor-control-cookie',
+                                os.path.join(self.tor_data_root, 'default'),
+                                password=self.tor_control_password)]
+        return [TorInstance.generated(i, self.tor_base_port, self.tor_data_root,
+                                      password=self.tor_control_password)
+                for i in range(self.tor_instance_count)]
+    
+    def start_tor(self, bootstrap_timeout: float = 30) -> bool:
+        """Start the Tor daemon(s) that are not running yet.
+        
+        Also acts as the pool health check: instances whose process died are
+        started again. Serialized, as the health check may call it while a
+        rotation is also (re)starting Tor.
+        """
+        with self._tor_start_lock:
+            return self._start_tor(bootstrap_timeout)
+    
+    def _start_tor(self, bootstrap_timeout: float) -> bool:
         try:
-            # Get the directory where this script is located
-            script_dir = os.path.dirname(os.path.abspath(__file__))
-            torrc_path = os.path.join(script_dir, 'torrc')
-            
-            # Fallback to current working directory if not found in script dir
-            if not os.path.exists(torrc_path):
-                torrc_path = os.path.join(os.getcwd(), 'torrc')
-            
-            if not os.path.exists(torrc_path):
-                self.logger.error(f"Tor configuration file 'torrc' not found in {script_dir} or {os.getcwd()}")
-                return False
+            starting = []
+            with self._tor_spawn_lock:
+                if self.shutting_down:
+                    return False
+                for instance in self.tor_instances:
+                    if instance.is_running():
+                        continue
+                    if instance.process is None or instance.has_exited():
+                        instance.spawn()
+                    starting.append(instance)
             
             # Check if Tor is already running
-            if self.is_tor_running():
+            if not starting:
                 self.logger.info("Tor is already running")
                 return True
             
-            # Create data directory
-            data_dir = '/tmp/tor-data'
-            os.makedirs(data_dir, mode=0o700, exist_ok=True)
-            
-            # Start Tor process
-            cmd = ['tor', '-f', torrc_path]
-            self.tor_process = subprocess.Popen(
-                cmd, 
-                stdout=subprocess.DEVNULL, 
-                stderr=subprocess.DEVNULL
-            )
-            
-            # Wait for Tor to start
-            for _ in range(30):  # Wait up to 30 seconds
-                if self.is_tor_running():
-                    self.logger.info("✓ Tor started successfully")
-                    time.sleep(2)  # Give it a moment to fully initialize
-                    return True
-                time.sleep(1)
+            # Tor opens its ports moments after launch: poll them briefly
+            # rather than once a second, and stop early if tor died
+            deadline = time.monotonic() + 30
+            while True:
+                starting = [instance for instance in starting if not instance.is_running()]
+                if not starting:
+                    break
+                if self.shutting_down:
+                    return False
+                if any(instance.has_exited() for instance in starting):
+                    self.logger.error("Tor exited during startup (is another tor using its ports?)")
+                    return False
+                if time.monotonic() > deadline:
+                    self.logger.error("Tor failed to start within timeout")
+                    return False
+                time.sleep(0.05)
             
-            self.logger.error("Tor failed to start within timeout")
-            return False
+            if len(self.tor_instances) > 1:
+                self.logger.info(f"✓ {len(self.tor_instances)} Tor instances running")
+            else:
+                self.logger.info("✓ Tor started successfully")
+            for instance in self.tor_instances:
+                bootstrapped = self._wait_for_bootstrap(instance, timeout=bootstrap_timeout)
+                if bootstrapped:
+                    self._record_bootstrap(instance)
+                    if instance is not self.active_tor:
+                        instance.ready.set()
+            return True
             
+        except FileNotFoundError as e:
+            self.logger.error(str(e))
+            return False
         except Exception as e:
             self.logger.error(f"Error starting Tor: {e}")
             return False
     
-    def is_tor_running(self) -> bool:
-        """Check if Tor is running on the expected ports."""
+    def _record_bootstrap(self, instance: TorInstance):
+        """Record how long a Tor instance we launched took to bootstrap."""
+        if instance.spawned_at is None:
+            return
+        elapsed = time.monotonic() - instance.spawned_at
+        instance.spawned_at = None
+        start = 'warm' if instance.warm_start else 'cold'
+        self.metrics.observe('ip_phantom_tor_bootstrap_seconds', elapsed, start=start)
+        self.metrics.event('tor_bootstrap', instance=instance.name, start=start, seconds=round(elapsed, 3))
+        self.logger.info(f"✓ Tor bootstrapped in {elapsed:.1f}s ({start} start, {instance.name})")
+    
+    def _wait_for_bootstrap(self, instance: TorInstance, timeout: float) -> bool:
+        """Wait for a Tor instance to finish bootstrapping and build circuits.
+        
+        Follows Tor's bootstrap status events, so an instance that is already
+        bootstrapped (a warm start) costs a single GETINFO.
+        """
         try:
-            # Check SOCKS port
-            with socket.create_connection(('127.0.0.1', 9050), timeout=1):
-                pass
-            # Check control port
-            with socket.create_connection(('127.0.0.1', 9051), timeout=1):
-                pass
-            return True
-        except (ConnectionRefusedError, socket.timeout, OSError):
+            controller = instance.controller
+            # Subscribe before asking so the event cannot slip in between
+            if not controller.event_types:
+                controller.set_events(*TOR_EVENTS)
+            info = controller.get_info('status/bootstrap-phase', 'status/circuit-established')
+            if (info.get('status/circuit-established') == '1'
+                    or 'PROGRESS=100' in info.get('status/bootstrap-phase', '')):
+                return True
+            
+            def bootstrapped(event: ControlReply) -> bool:
+                line = event.lines[0]
+                if 'BOOTSTRAP' in line:
+                    progress = dict(word.split('=', 1) for word in line.split() if '=' in word)
+                    self.logger.debug(f"Tor bootstrapping ({instance.name}): "
+                                      f"{progress.get('PROGRESS', '?')}% {progress.get('TAG', '')}")
+                return 'CIRCUIT_ESTABLISHED' in line or 'PROGRESS=100' in line
+            
+            return controller.wait_for_event(bootstrapped, timeout) is not None
+        except (TorControlError, OSError) as e:
+            self.logger.debug(f"Could not query Tor bootstrap status: {e}")
             return False
     
+    def is_tor_running(self) -> bool:
+        """Check if the active Tor instance is running on its ports."""
+        return self.active_tor.is_running()
+    
     def stop_tor(self):
-        """Stop Tor daemon."""
+        """Stop every Tor daemon we started."""
+        if self.prebuilder:
+            self.prebuilder.stop()
+        if self._tor_executor:
+            self._tor_executor.shutdown(wait=False)
+        with self._tor_spawn_lock:
+            for instance in self.tor_instances:
+                try:
+                    launched = instance.process is not None
+                    instance.stop()
+                    if launched:
+                        self.logger.info(f"Tor process terminated ({instance.name})")
+                except Exception as e:
+                    self.logger.error(f"Error stopping Tor: {e}")
+    
+    def prefetch(self, timeout: float = 300) -> bool:
+        """Bootstrap every Tor instance once to fill its persistent cache.
+        
+        Run ahead of a deploy or restart: tor downloads the consensus and
+        descriptors and picks its guards now, so the next start is warm.
+        Instances that are already running are left as they are.
+        """
+        for instance in self.tor_instances:
+            state = 'warm' if instance.has_warm_state() else 'cold'
+            safe_print(f"📦 {instance.name}: {instance.data_dir} ({state})")
         try:
-            if self.tor_process:
-                self.tor_process.terminate()
-                self.tor_process.wait(timeout=10)
-                self.logger.info("Tor process terminated")
-        except Exception as e:
-            self.logger.error(f"Error stopping Tor: {e}")
+            if not self.start_tor(bootstrap_timeout=timeout):
+                return False
+            ready = True
+            for instance in self.tor_instances:
+                if not self._wait_for_bootstrap(instance, timeout=timeout):
+                    self.logger.error(f"Tor did not finish bootstrapping ({instance.name})")
+                    ready = False
+            if ready and (self.exit_selection == 'diverse' or self.exit_verification == 'local'):
+                # Index the consensus now so the first rotations can pick exits
+                self._relay_directory().refresh()
+                safe_print(f"📦 {len(self.relay_directory.exits)} exit relays cached in {self.relay_cache_file}")
+            return ready
+        finally:
+            self.stop_tor()
+            if self.relay_directory:
+                self.relay_directory.controller.close()
     
-    def renew_tor_circuit(self) -> bool:
-        """Request a new Tor circuit to change IP address."""
+    def get_tor_controller(self) -> TorController:
+        """Return the control-port client of the active Tor instance."""
+        return self.active_tor.controller
+    
+    def renew_tor_circuit(self, instance: Optional[TorInstance] = None) -> bool:
+        """Request a new Tor circuit to change IP address.
+        
+        Returns as soon as Tor reports a fresh circuit built after the
+        NEWNYM; ``circuit_wait_timeout`` is only a fallback. Renews the
+        active instance unless another one is given.
+        
+        Tor only acts on one NEWNYM per ``newnym_interval`` and delays the
+        rest, so a renewal that comes too early waits for that point instead
+        of sending a signal that would do nothing yet; rotation requests
+        arriving meanwhile are coalesced into it.
+        """
+        instance = instance or self.active_tor
+        wait = instance.newnym_wait()
+        if wait > 0:
+            self.metrics.inc('ip_phantom_newnym_coalesced_total')
+            self.logger.info(f"⏳ Tor accepts the next NEWNYM on {instance.name} in {wait:.1f}s, waiting")
+            with self.metrics.phase('newnym_wait'):
+                if not self._sleep(wait):
+                    return False
         try:
-            # Connect to Tor control port
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as control_socket:
-                control_socket.settimeout(10)
-                control_socket.connect(('127.0.0.1', 9051))
-                
-                # Authenticate (using cookie authentication)
-                cookie_path = '/tmp/tor-control-cookie'
-                if os.path.exists(cookie_path):
-                    with open(cookie_path, 'rb') as f:
-                        cookie = f.read()
-                    auth_cmd = f'AUTHENTICATE {cookie.hex()}\r\n'
+            controller = instance.controller
+            if not controller.connected:
+                with self.metrics.phase('control_auth'):
+                    controller.connect()
+            if not controller.event_types:
+                controller.set_events(*TOR_EVENTS)
+            
+            # Every circuit listed right after NEWNYM is dirty or closing, so
+            # any circuit with a higher ID was built for the new identity.
+            commands = ['SIGNAL NEWNYM', 'GETINFO circuit-status']
+            exit_nodes = self._next_exit_nodes()
+            if exit_nodes:
+                setting, label = exit_nodes
+                commands.insert(0, f'SETCONF ExitNodes={setting}' if setting else 'RESETCONF ExitNodes')
+            with self.metrics.phase('newnym'):
+                replies = controller.execute_many(commands)
+            reply, status = replies[-2:]
+            if exit_nodes:
+                if not replies[0].ok:
+                    self.logger.warning(f"Could not set ExitNodes: {replies[0]}")
                 else:
-                    # Try without authentication
-                    auth_cmd = 'AUTHENTICATE\r\n'
-                
-                control_socket.send(auth_cmd.encode())
-                response = control_socket.recv(1024).decode()
-                
-                if '250 OK' not in response:
-                    self.logger.error(f"Tor authentication failed: {response.strip()}")
-                    return False
-                
-                # Request new circuit
-                control_socket.send(b'SIGNAL NEWNYM\r\n')
-                response = control_socket.recv(1024).decode()
+                    instance.exit_nodes_set = bool(setting)
+                    if label:
+                        self.logger.info(f"🎯 Next exit: {label}")
+            if not reply.ok:
+                self.logger.error(f"Failed to renew Tor circuit: {reply}")
+                return False
+            instance.next_newnym = time.monotonic() + self.newnym_interval
+            
+            # NEWNYM invalidates every circuit on this instance, including
+            # pre-built identities; pooled connections stay on old circuits
+            instance.generation += 1
+            if self.active_identity and self.active_identity.instance is instance:
+                self.active_identity = None
+            self.http_client.close_idle(proxy=instance.socks)
+            self.logger.info("✓ New Tor circuit requested")
+            
+            circuits = status.values().get('circuit-status', '').splitlines()
+            newest = max((parse_circuit(line)['id'] for line in circuits), default=0)
+            with self.metrics.phase('circuit_settle'):
+                self._wait_for_new_circuit(controller, newest, instance)
+            return True
                 
-                if '250 OK' in response:
-                    self.logger.info("✓ New Tor circuit requested")
-                    time.sleep(3)  # Wait for new circuit to establish
-                    return True
-                else:
-                    self.logger.error(f"Failed to renew Tor circuit: {response.strip()}")
-                    return False
-                    
+        except TorControlError as e:
+            self.logger.error(str(e))
+            return False
         except Exception as e:
             self.logger.error(f"Error renewing Tor circuit: {e}")
             return False
     
+    def _sleep(self, seconds: float) -> bool:
+        """Sleep unless IP Phantom stops first; False if it did."""
+        deadline = time.monotonic() + seconds
+        while self.running:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(remaining, 0.25))
+        return False
+    
+    def _wait_for_new_circuit(self, controller: TorController, newest: int,
+                              instance: Optional[TorInstance] = None):
+        """Wait until a circuit newer than ``newest`` is built or in use."""
+        deadline = time.monotonic() + self.circuit_wait_timeout
+        if instance is not None:
+            instance.circuit = None
+        
+        def is_new_circuit(event: ControlReply) -> bool:
+            nonlocal deadline
+            words = event.lines[0].split()
+            if not words:
+                return False
+            if words[0] == 'CIRC':
+                circuit = parse_circuit(event.lines[0])
+                if (circuit['id'] > newest and circuit['status'] == 'BUILT'
+                        and circuit['purpose'] == 'GENERAL'):
+                    self._circuit_built(instance, circuit)
+                    return True
+                return False
+            if words[0] == 'STREAM' and len(words) > 3:
+                # A stream attached to a new circuit proves it is built
+                if words[2] == 'SUCCEEDED' and words[3].isdigit() and int(words[3]) > newest:
+                    self._circuit_built(instance, {'id': int(words[3]), 'status': 'BUILT',
+                                                   'path': [], 'purpose': 'GENERAL'})
+                    return True
+                return False
+            if words[0] == 'NOTICE' and 'Rate limiting NEWNYM' in event.lines[0]:
+                delay = [int(w) for w in words if w.isdigit()]
+                if delay:
+                    self.logger.info(f"⏳ Tor is rate limiting NEWNYM, new identity in {delay[0]}s")
+                    deadline = time.monotonic() + delay[0] + self.circuit_wait_timeout
+                    if instance is not None:
+                        instance.next_newnym = time.monotonic() + delay[0] + self.newnym_interval
+            return False
+        
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.logger.debug("No new circuit event before timeout; continuing")
+                return False
+            # Re-check the deadline whenever it is extended by a rate-limit notice
+            if controller.wait_for_event(is_new_circuit, min(remaining, 0.5)):
+                return True
+    
+    def _circuit_built(self, instance: Optional[TorInstance], circuit: Dict):
+        self.last_circuit = circuit
+        if instance is not None:
+            instance.circuit = circuit
+        if circuit['path']:
+            # Only lands in the rotation history when built on the rotation's thread
+            fingerprint = hop_fingerprint(circuit['path'][-1])
+            relay = self.relay_directory.relays.get(fingerprint) if self.relay_directory else None
+            self.metrics.annotate(exit=fingerprint, country=relay.country if relay else None)
+    
+    def _local_exit_ip(self, instance: TorInstance) -> Optional[str]:
+        """Exit IP of the instance's new circuit, from the relay directory.
+        
+        Resolves the last hop of the circuit built after the NEWNYM to its
+        address in the indexed consensus, so no request has to cross the
+        circuit. Exits an echo check found to use another address resolve to
+        that address. None if the circuit or its exit is unknown.
+        """
+        circuit = instance.circuit
+        if circuit is None:
+            return None
+        if not circuit['path']:
+            # Only a STREAM event was seen: look the circuit up
+            try:
+                status = instance.controller.get_info('circuit-status').get('circuit-status', '')
+            except (TorControlError, OSError):
+                return None
+            for line in status.splitlines():
+                if parse_circuit(line)['id'] == circuit['id']:
+                    circuit['path'] = parse_circuit(line)['path']
+                    break
+        if not circuit['path']:
+            return None
+        exit_hop = circuit['path'][-1]
+        if hop_fingerprint(exit_hop) in self.observed_exits:
+            return self.observed_exits[hop_fingerprint(exit_hop)]
+        directory = self._relay_directory()
+        directory.refresh_in_background()
+        return directory.address_of(exit_hop)
+    
+    def _verify_exit(self) -> Optional[str]:
+        """The exit IP of the freshly renewed active instance.
+        
+        With ``exit_verification: "local"`` it is resolved from the circuit
+        path; an echo lookup only runs for an ``echo_sample_rate`` share of
+        rotations, or when the exit cannot be resolved locally. Samples that
+        disagree are counted and remembered per exit relay, which catches
+        exits that send their traffic out from another address.
+        """
+        if self.exit_verification != 'local':
+            return self.get_current_ip_via_tor()
+        instance = self.active_tor
+        local_ip = self._local_exit_ip(instance)
+        if local_ip and random.random() >= self.echo_sample_rate:
+            self.metrics.inc('ip_phantom_exit_verifications_total', method='local', result='resolved')
+            self.metrics.annotate(exit_verification='local')
+            return local_ip
+        echo_ip = self.get_current_ip_via_tor()
+        self.metrics.annotate(exit_verification='echo')
+        if not local_ip:
+            result = 'unresolved'
+        elif not echo_ip:
+            result = 'error'
+        elif echo_ip == local_ip:
+            result = 'match'
+        elif echo_ip in self.relay_directory.exit_addresses:
+            # Tor put the lookup on another of its new circuits; nothing to learn
+            result = 'other_circuit'
+        else:
+            result = 'mismatch'
+            exit_hop = instance.circuit['path'][-1]
+            self.observed_exits[hop_fingerprint(exit_hop)] = echo_ip
+            self.logger.info(f"🔎 Exit {exit_hop} sends traffic from {echo_ip}, "
+                             f"not its relay address {local_ip}")
+        self.metrics.inc('ip_phantom_exit_verifications_total', method='echo', result=result)
+        return echo_ip or local_ip
+    
     def get_current_ip_via_tor(self) -> Optional[str]:
         """Get current IP address through Tor proxy."""
         try:
-            # Use curl with Tor SOCKS proxy
-            result = subprocess.run([
-                'curl', '-s', '--socks5-hostname', '127.0.0.1:9050',
-                '--connect-timeout', '10', 'https://httpbin.org/ip'
-            ], capture_output=True, text=True, timeout=15)
-            
-            if result.returncode == 0:
-                response = json.loads(result.stdout)
-                return response.get('origin', '').split(',')[0].strip()
-            else:
-                return None
-                
+            return self._lookup_ip(via_tor=True, proxy_auth=self.tor_socks_auth)
         except Exception as e:
             self.logger.error(f"Error getting IP via Tor: {e}")
             return None
     
     def rotate_ip(self) -> bool:
         """Rotate to a new IP address using Tor or demo mode."""
+        self.metrics.rotation_started()
+        success = False
+        try:
+            success = self._rotate_ip()
+            return success
+        finally:
+            self.last_outcome = self.metrics.rotation_finished(success)
+    
+    def _rotate_ip(self) -> bool:
         try:
             if self.demo_mode:
                 # Demo mode: simulate successful IP changing with country info
@@ -541,7 +4387,20 @@ class IPPhantom:
                 safe_print(f"👻 IP changed: {old_ip} → {new_ip}")
                 return True
             
+            if self.rotation_method != 'tor':
+                rotated = self.rotate_ip_via_endpoints()
+                if rotated is not None:
+                    return rotated
+                if not self.tor_fallback:
+                    self.logger.error("No VPN or proxy endpoint available for rotation")
+                    return False
+                self.logger.info("No VPN or proxy endpoint available, rotating via Tor")
+                self.metrics.annotate(fallback='tor')
+                self.active_endpoint = None
+                self._clear_proxy()
+            
             # Use Tor for real IP rotation
+            self.metrics.annotate(backend='tor')
             return self.rotate_ip_via_tor()
             
         except Exception as e:
@@ -549,35 +4408,236 @@ class IPPhantom:
             return False
     
     def rotate_ip_via_tor(self) -> bool:
-        """Rotate IP address using Tor circuit renewal."""
+        """Rotate IP address using Tor circuit renewal.
+        
+        Landing on an exit used within the exit history counts as a repeat
+        and is rotated away from again, up to ``exit_repeat_retries`` times.
+        With circuit probing, a circuit that is too slow (or whose exit is
+        known to be slow) is rejected the same way, up to
+        ``circuit_reject_retries`` times.
+        """
+        repeats = rejections = 0
+        while True:
+            if not self._rotate_ip_via_tor():
+                return False
+            if self._recently_used_exit(self.current_ip):
+                self.metrics.inc('ip_phantom_exit_repeats_total')
+                repeats += 1
+                self.metrics.annotate(exit_retries=repeats)
+                if repeats <= self.exit_repeat_retries:
+                    self.logger.info(f"♻️  Exit {self.current_ip} was used recently, "
+                                     f"rotating again ({repeats}/{self.exit_repeat_retries})")
+                    continue
+                self.logger.warning(f"⚠️  Still on a recently used exit ({self.current_ip}) "
+                                    f"after {self.exit_repeat_retries} retries")
+            reason = self._check_circuit()
+            if reason is None:
+                break
+            self.metrics.inc('ip_phantom_circuit_rejections_total', reason=reason)
+            rejections += 1
+            self.metrics.annotate(circuit_rejections=rejections)
+            if rejections > self.circuit_reject_retries:
+                self.logger.warning(f"⚠️  Keeping a slow circuit via {self.current_ip} "
+                                    f"after {self.circuit_reject_retries} rejections")
+                break
+            self.logger.info(f"🐢 Circuit via {self.current_ip} is too slow ({reason}), "
+                             f"rotating again ({rejections}/{self.circuit_reject_retries})")
+        if self.exit_index is not None:
+            self.exit_index.add(self.current_ip)
+        self.recent_exit_prefixes.append(address_prefix(self.current_ip))
+        return True
+    
+    def _check_circuit(self) -> Optional[str]:
+        """Probe the circuit now carrying traffic; why to reject it, or None.
+        
+        Pre-built identities were probed when they were built, and exits
+        already known to be slow are rejected without probing again.
+        """
+        if self.exit_scores is None:
+            return None
+        identity = self.active_identity
+        if identity is not None and identity.probe is not None:
+            self.last_probe = identity.probe
+            return None
+        if self.exit_scores.is_slow(self.current_ip):
+            return 'known_slow'
+        with self.metrics.phase('circuit_probe'):
+            probe = self.probe_circuit(proxy_auth=self.tor_socks_auth)
+        self.last_probe = probe
+        return self._score_probe(probe)
+    
+    def probe_circuit(self, instance: Optional[TorInstance] = None,
+                      proxy_auth: Optional[Tuple[str, str]] = None) -> Dict:
+        """Measure a circuit: time to first byte and optional throughput.
+        
+        TTFB is timed against the fastest IP-echo service, over a connection
+        that the preceding IP lookup has usually already attached to the
+        circuit, so it measures the circuit rather than its setup. With
+        ``circuit_probe_url`` that URL is downloaded to measure throughput.
+        A failed request counts as a TTFB of the HTTP timeout.
+        """
+        instance = instance or self.active_tor
+        probe = {'exit': self.current_ip if instance is self.active_tor else instance.exit_ip,
+                 'ttfb': self.http_client.timeout, 'throughput': None, 'ok': False}
+        try:
+            start = time.perf_counter()
+            status, body = self.http_client.get(self.tor_services.ranked()[0], proxy=instance.socks,
+                                                proxy_auth=proxy_auth)
+            if status != 200:
+                return probe
+            probe['ttfb'] = time.perf_counter() - start
+            if self.circuit_probe_url:
+                start = time.perf_counter()
+                status, body = self.http_client.get(self.circuit_probe_url, proxy=instance.socks,
+                                                    proxy_auth=proxy_auth)
+                if status != 200:
+                    return probe
+                probe['throughput'] = len(body) / max(time.perf_counter() - start, 1e-6)
+            probe['ok'] = True
+        except (OSError, http.client.HTTPException) as e:
+            self.logger.debug(f"Circuit probe failed: {e}")
+        return probe
+    
+    def _score_probe(self, probe: Dict) -> Optional[str]:
+        """Record a probe in the exit scores; why to reject the circuit, or None."""
+        self.metrics.observe('ip_phantom_circuit_ttfb_seconds', probe['ttfb'])
+        self.metrics.annotate(circuit_ttfb=round(probe['ttfb'], 4))
+        if probe['throughput'] is not None:
+            self.metrics.annotate(circuit_throughput=round(probe['throughput']))
+        if probe['exit']:
+            self.exit_scores.record(probe['exit'], probe['ttfb'], probe['throughput'])
+        if not probe['ok']:
+            return 'error'
+        return self.exit_scores.verdict(probe['ttfb'], probe['throughput'])
+    
+    def _avoided_exit(self, ip: str) -> bool:
+        """Exits not to pick next: recently used, or known to be slow."""
+        return self._recently_used_exit(ip) or (self.exit_scores is not None
+                                                and self.exit_scores.is_slow(ip))
+    
+    def _next_exit_nodes(self) -> Optional[Tuple[str, Optional[str]]]:
+        """The ExitNodes value (and a log label) for the next circuit.
+        
+        ``None`` leaves Tor's configuration alone; an empty value resets a
+        previously pinned exit. Until the relay directory is indexed, country
+        targets use Tor's own ``{cc}`` syntax, so no rotation waits for it.
+        """
+        if self.exit_selection != 'diverse' and not self.exit_countries:
+            return None
+        country = None
+        if self.exit_countries and self.country_strategy == 'spread':
+            directory = self.relay_directory
+            for _ in self.exit_countries:
+                country = self.exit_countries[self._country_turn % len(self.exit_countries)]
+                self._country_turn += 1
+                # Skip countries the indexed consensus has no usable exits in
+                if not directory or not len(directory) or directory.has_exits(country):
+                    break
+        if self.exit_selection == 'diverse':
+            relay = self._choose_exit(country)
+            if relay:
+                where = f', {relay.country.upper()}' if relay.country else ''
+                return f'${relay.fingerprint}', f'{relay.nickname} ({relay.address}{where})'
+        countries = [country] if country else self.exit_countries
+        if countries:
+            return (','.join(f'{{{code}}}' for code in countries),
+                    f"any exit in {', '.join(code.upper() for code in countries)}")
+        return '', None
+    
+    def _relay_directory(self) -> RelayDirectory:
+        """Return the relay directory, creating it on first use."""
+        if self.relay_directory is None:
+            # A connection of its own, so that fetching the consensus never
+            # holds up commands on the rotation controller
+            source = self.tor_instances[0].controller
+            self.relay_directory = RelayDirectory(
+                TorController(source.host, source.port, source.cookie_path,
+                              source.password, source.timeout),
+                cache_path=self.relay_cache_file, countries=self.exit_countries)
+        return self.relay_directory
+    
+    def _choose_exit(self, country: Optional[str] = None) -> Optional[Relay]:
+        """Pick a diverse next exit from the relay directory.
+        
+        Refreshes run in the background, so the first rotations after start
+        may still let Tor choose while the consensus is being indexed.
+        """
+        self._relay_directory().refresh_in_background()
+        return self.relay_directory.choose(avoid_prefixes=self.recent_exit_prefixes,
+                                           seen=self._avoided_exit, country=country)
+    
+    def _rotate_ip_via_tor(self) -> bool:
         try:
             # Ensure Tor is running
-            if not self.start_tor():
+            with self.metrics.phase('tor_ready'):
+                started = self.start_tor()
+            if not started:
                 self.logger.error("Failed to start Tor")
                 return False
             
+            # Switch to a pre-built, already verified identity if one is ready
+            if self.prewarm_depth:
+                self._start_prebuilder()
+                identity = self.prebuilder.take(avoid=self.current_ip,
+                                                timeout=self.circuit_wait_timeout,
+                                                seen=self._avoided_exit)
+                if identity:
+                    self.metrics.annotate(path='prebuilt')
+                    return self._switch_to_identity(identity)
+                self.logger.info("No pre-built identity ready, renewing the circuit")
+            
+            # With a pool, hand traffic to an instance whose fresh circuit is
+            # already built instead of waiting for a new one
+            if len(self.tor_instances) > 1:
+                standby = self._next_ready_instance()
+                if standby:
+                    self.metrics.annotate(path='handoff')
+                    return self._handoff_to_instance(standby)
+                self.logger.info("No standby Tor instance ready, renewing the active one")
+            
             # Get current IP before rotation
-            old_ip = self.get_current_ip_via_tor()
+            self.metrics.annotate(path='renew')
+            old_ip = None
+            if self.exit_verification == 'local':
+                # Already known from the previous rotation; no round trip needed
+                old_ip = self.active_identity.exit_ip if self.active_identity else self.active_tor.exit_ip
+            if not old_ip:
+                with self.metrics.phase('pre_ip_lookup'):
+                    old_ip = self.get_current_ip_via_tor()
             if not old_ip:
                 old_ip = "Unknown"
             
             self.logger.info(f"Current IP (via Tor): {old_ip}")
             
+            # Rather than wait out the active instance's NEWNYM limit, renew
+            # another instance that can act on one now and move to it
+            if self.active_tor.newnym_wait() > 0:
+                other = self._newnym_ready_instance()
+                if other:
+                    self.logger.info(f"🔀 NEWNYM on {self.active_tor.name} is rate limited, "
+                                     f"renewing {other.name} instead")
+                    self.metrics.annotate(path='renew_other')
+                    self.active_identity = None
+                    self.active_tor = other
+            
             # Request new Tor circuit
             if self.renew_tor_circuit():
                 # Verify IP change
-                time.sleep(2)  # Wait for new circuit
-                new_ip = self.get_current_ip_via_tor()
+                with self.metrics.phase('post_ip_lookup'):
+                    new_ip = self._verify_exit()
+                self.active_tor.exit_ip = new_ip
+                self.metrics.annotate(old_ip=old_ip, new_ip=new_ip)
                 
                 if new_ip and new_ip != old_ip:
                     self.current_ip = new_ip
                     safe_print(f"👻 IP changed via Tor: {old_ip} → {new_ip}")
                     return True
                 elif new_ip:
-                    # Sometimes Tor may not change IP immediately, but circuit was renewed
+                    # A new circuit through the same exit: not a new identity
+                    self.metrics.annotate(outcome='unchanged')
                     self.current_ip = new_ip
-                    safe_print(f"👻 Tor circuit renewed: {new_ip} (IP may change shortly)")
-                    return True
+                    safe_print(f"⚠️  Tor circuit renewed but the exit IP did not change: {new_ip}")
+                    return False
                 else:
                     self.logger.warning("Failed to get new IP after Tor circuit renewal")
                     return False
@@ -588,8 +4648,124 @@ class IPPhantom:
             self.logger.error(f"Error during Tor IP rotation: {e}")
             return False
     
-    def signal_handler(self, signum, frame):
-        """Handle shutdown signals gracefully."""
+    def _next_ready_instance(self) -> Optional[TorInstance]:
+        """Return the next instance (round-robin) holding a fresh circuit."""
+        start = self.tor_instances.index(self.active_tor)
+        count = len(self.tor_instances)
+        for offset in range(1, count):
+            instance = self.tor_instances[(start + offset) % count]
+            if instance.ready.is_set():
+                return instance
+        return None
+    
+    def _newnym_ready_instance(self) -> Optional[TorInstance]:
+        """Another pool instance that is idle and can act on a NEWNYM now."""
+        for instance in self.tor_instances:
+            if (instance is not self.active_tor and not instance.ready.is_set()
+                    and not instance.newnym_wait() and instance.is_running()):
+                return instance
+        return None
+    
+    def _current_tor_exit(self) -> Optional[str]:
+        """Exit IP of the circuit carrying traffic, looked up if unknown."""
+        if self.active_identity:
+            return self.active_identity.exit_ip
+        return self.active_tor.exit_ip or self.get_current_ip_via_tor()
+    
+    def _recently_used_exit(self, ip: str) -> bool:
+        return self.exit_index is not None and ip in self.exit_index
+    
+    def _start_prebuilder(self):
+        """Start the background identity pipeline on first use."""
+        if self.prebuilder is None:
+            self.prebuilder = IdentityPrebuilder(self._build_identity, self.prewarm_depth,
+                                                 self.prewarm_max_age)
+        self.prebuilder.start()
+    
+    def _build_identity(self) -> Optional[Identity]:
+        """Build one isolated circuit and verify its exit IP."""
+        instance = self.active_tor
+        generation = instance.generation
+        auth = (f'phantom-{secrets.token_hex(8)}', secrets.token_hex(8))
+        start = time.perf_counter()
+        # The first lookup with new credentials makes Tor build the circuit
+        exit_ip = self._lookup_ip(via_tor=True, instance=instance, proxy_auth=auth)
+        if not exit_ip:
+            return None
+        identity = Identity(instance, auth, exit_ip, generation, time.perf_counter() - start)
+        if self.exit_scores is not None:
+            # Probe in the background so switching to the identity never waits
+            if self.exit_scores.is_slow(exit_ip):
+                self.metrics.inc('ip_phantom_circuit_rejections_total', reason='known_slow')
+                return None
+            identity.probe = self.probe_circuit(instance, auth)
+            identity.probe['exit'] = exit_ip
+            reason = self._score_probe(identity.probe)
+            if reason:
+                self.metrics.inc('ip_phantom_circuit_rejections_total', reason=reason)
+                return None
+        return identity
+    
+    def prewarm_stats(self) -> Dict:
+        """Pre-built identity queue depth and build latency (empty if off)."""
+        return self.prebuilder.stats() if self.prebuilder else {}
+    
+    def _switch_to_identity(self, identity: Identity) -> bool:
+        """Make a pre-built identity carry traffic; no waiting involved."""
+        old_ip = self._current_tor_exit() or "Unknown"
+        previous = self.active_identity
+        self.active_tor = identity.instance
+        self.active_identity = identity
+        self.current_ip = identity.exit_ip
+        self.metrics.annotate(old_ip=old_ip, new_ip=identity.exit_ip)
+        if previous:
+            self.http_client.close_idle(proxy=previous.instance.socks, proxy_auth=previous.auth)
+        
+        safe_print(f"👻 IP changed via Tor: {old_ip} → {identity.exit_ip}")
+        stats = self.prebuilder.stats()
+        if stats['build_p50'] is not None:
+            self.logger.info(f"📦 Pre-built identities: {stats['ready']}/{stats['target']} ready, "
+                             f"build p50 {stats['build_p50']:.2f}s p95 {stats['build_p95']:.2f}s")
+        return True
+    
+    def _handoff_to_instance(self, standby: TorInstance) -> bool:
+        """Switch traffic to ``standby`` and rebuild the previous instance."""
+        previous = self.active_tor
+        old_ip = self._current_tor_exit() or "Unknown"
+        
+        standby.ready.clear()
+        self.active_identity = None
+        self.active_tor = standby
+        new_ip = self._verify_exit()
+        standby.exit_ip = new_ip
+        
+        # The previous instance builds its next identity in the background
+        if self._tor_executor is None:
+            self._tor_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.tor_instances), thread_name_prefix='tor-rebuild')
+        self._tor_executor.submit(self._rebuild_instance, previous)
+        
+        if not new_ip:
+            self.logger.warning(f"Failed to get IP via Tor instance {standby.name}")
+            return False
+        self.current_ip = new_ip
+        self.metrics.annotate(old_ip=old_ip, new_ip=new_ip)
+        if new_ip != old_ip:
+            safe_print(f"👻 IP changed via Tor: {old_ip} → {new_ip}")
+        else:
+            self.metrics.annotate(outcome='unchanged')
+            safe_print(f"⚠️  Tor instance switched but the exit IP did not change: {new_ip}")
+            return False
+        return True
+    
+    def _rebuild_instance(self, instance: TorInstance):
+        """Give an instance a fresh circuit and mark it ready for handoff."""
+        instance.exit_ip = None
+        if self.renew_tor_circuit(instance):
+            instance.ready.set()
+    
+    def shutdown(self):
+        """Stop rotating and clean up VPN/Tor (safe to call more than once)."""
         if self.shutting_down:
             return  # Already shutting down
             
@@ -602,27 +4778,55 @@ class IPPhantom:
             # Cleanup: disconnect VPN/Tor only if not in demo mode
             if not self.demo_mode:
                 try:
-                    self.disconnect_current_vpn()
+                    self._close_endpoints()
                     self.stop_tor()
                 except Exception:
                     pass  # Silent cleanup
+            self.metrics.close()
+            if self.history is not None:
+                self.history.close()
+            if self.exit_index is not None:
+                self.exit_index.close()
             
             safe_print("✅ IP Phantom stopped safely.")
         except (BrokenPipeError, ConnectionResetError):
             # Silently ignore broken pipe errors during shutdown
             pass
+    
+    def signal_handler(self, signum, frame):
+        """Handle shutdown signals gracefully."""
+        if self.shutting_down:
+            return  # Already shutting down
+        self.shutdown()
         sys.exit(0)
     
     def run(self):
         """Main execution loop."""
         if self.demo_mode:
             safe_print(f"🚀 Starting IP Phantom Demo (changing IP every {self.interval}s)")
+        elif self.rotation_method != 'tor':
+            safe_print(f"👻 Starting IP Phantom with {self.rotation_method} rotation "
+                       f"(changing IP every {self.interval}s)")
+            if self.tor_fallback:
+                safe_print("🌐 Falling back to Tor when no VPN or proxy is available")
         else:
             safe_print(f"👻 Starting IP Phantom with Tor (changing IP every {self.interval}s)")
             safe_print("🌐 Using Tor network for anonymous IP changing")
+            if (self.interval < self.newnym_interval and len(self.tor_instances) == 1
+                    and not self.prewarm_depth):
+                safe_print(f"ℹ️  Tor allows one new identity per {self.newnym_interval:.0f}s, so "
+                           f"rotations will be coalesced; use tor_instances or prewarm_depth to rotate faster")
         safe_print("Press Ctrl+C to stop")
         safe_print()
         
+        if not self.demo_mode and self.rotation_method != 'tor':
+            # The first VPN tunnel or proxy comes up while the initial IP is looked up
+            self._prepare_next()
+        if not self.demo_mode and self.uses_tor:
+            # Start Tor, or adopt one that is already bootstrapped, while the
+            # initial IP is looked up; the first rotation waits on the same lock
+            threading.Thread(target=self.start_tor, name='tor-start', daemon=True).start()
+        
         # Get initial IP
         initial_ip = self.get_current_ip()
         if initial_ip:
@@ -634,38 +4838,773 @@ class IPPhantom:
                 safe_print(f"📍 Initial IP: {initial_ip}")
             self.current_ip = initial_ip
         
-        rotation_count = 0
+        if self.history_file and not self.demo_mode:
+            try:
+                self.history = RotationHistory(self.history_file)
+                self.history.start()
+                self.metrics.history = self.history
+            except (OSError, sqlite3.Error) as e:
+                self.logger.warning(f"Cannot open the rotation history {self.history_file}: {e}")
+                self.history = None
+        
+        if self.metrics_port:
+            try:
+                self.metrics.serve(self.metrics_port)
+                safe_print(f"📈 Metrics at http://127.0.0.1:{self.metrics_port}/metrics")
+            except OSError as e:
+                self.logger.warning(f"Cannot serve metrics on port {self.metrics_port}: {e}")
         
         try:
-            while self.running:
-                # Perform IP rotation
-                if self.rotate_ip():
-                    rotation_count += 1
-                    if self.demo_mode:
-                        safe_print(f"✅ Identity change #{rotation_count} complete")
-                else:
-                    safe_print("⚠️  Connection failed, retrying...")
-                
-                # Wait for specified interval with countdown
-                if self.running:
-                    safe_print(f"⏳ Waiting {self.interval} seconds...")
-                    for i in range(self.interval):
-                        if not self.running:
-                            break
-                        try:
-                            time.sleep(1)
-                        except KeyboardInterrupt:
-                            raise  # Re-raise to be caught by outer handler
-                    if self.running:  # Only print if we haven't been interrupted
-                        safe_print()
-                    
-        except KeyboardInterrupt:
-            self.signal_handler(signal.SIGINT, None)
+            asyncio.run(AsyncRotationEngine(self, self.health_check_interval).run())
         except Exception as e:
             safe_print(f"❌ Unexpected error: {e}")
             sys.exit(1)
 
 
+class RotationPolicy:
+    """When a key (the global identity or a front proxy client) rotates.
+
+    Every ``interval`` seconds, varied by up to ``jitter`` (a fraction of the
+    interval), and early after ``max_requests`` connections, ``max_bytes``
+    relayed bytes or ``max_failures`` consecutive failed or slow (over
+    ``slow_threshold`` seconds) connects. 0 disables a trigger. With
+    ``rotate_idle`` off, scheduled rotations are skipped for keys that saw
+    no connection since their last rotation.
+    """
+
+    __slots__ = ('interval', 'jitter', 'max_requests', 'max_bytes', 'max_failures',
+                 'slow_threshold', 'rotate_idle')
+
+    def __init__(self, interval: float, jitter: float = 0.0, max_requests: int = 0,
+                 max_bytes: int = 0, max_failures: int = 0, slow_threshold: float = 0.0,
+                 rotate_idle: bool = True):
+        self.interval = interval
+        self.jitter = jitter
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.max_failures = max_failures
+        self.slow_threshold = slow_threshold
+        self.rotate_idle = rotate_idle
+
+    def delay(self) -> float:
+        """Seconds until the next scheduled rotation."""
+        if self.jitter:
+            return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        return self.interval
+
+
+class _Schedule:
+    __slots__ = ('entry', 'requests', 'bytes', 'failures', 'rotating')
+
+    def __init__(self):
+        self.entry = None
+        self.requests = 0
+        self.bytes = 0
+        self.failures = 0
+        self.rotating = False
+
+
+class RotationScheduler:
+    """Runs rotations for many keys from one heap of deadlines.
+
+    One task sleeps until the earliest deadline, so hundreds of per-client
+    schedules cost a heap entry each rather than a task or timer each.
+    ``rotate(key, reason)`` is awaited for every due rotation (reason
+    ``schedule``) and for early ones triggered by usage (``requests``,
+    ``bytes``), failures (``failure``, ``slow``) or :meth:`trigger`. Keys
+    rotate concurrently, but a key never overlaps itself. ``key`` is
+    ``None`` for the global identity and a client key otherwise.
+    """
+
+    def __init__(self, rotate: Callable, policy: RotationPolicy,
+                 client_policy: Optional[RotationPolicy] = None, metrics: Optional[Metrics] = None):
+        self.rotate = rotate
+        self.policy = policy
+        self.client_policy = client_policy or policy
+        self.metrics = metrics or Metrics()
+        # Called with (key, missed slots) and (key, seconds until next rotation)
+        self.on_overrun = None
+        self.on_rescheduled = None
+        self._heap = []
+        self._schedules = {}
+        self._counter = itertools.count()
+        self._tasks = set()
+        self._wakeup = None
+        self._loop = None
+        self._stopped = False
+
+    def __len__(self) -> int:
+        return len(self._schedules)
+
+    def policy_for(self, key: Optional[str]) -> RotationPolicy:
+        return self.policy if key is None else self.client_policy
+
+    def add(self, key: Optional[str], delay: Optional[float] = None):
+        """Start scheduling ``key`` (first rotation after ``delay`` or one period)."""
+        if key in self._schedules:
+            return
+        self._schedules[key] = _Schedule()
+        if delay is None:
+            if not self.policy_for(key).interval:
+                return  # Only usage and failures rotate this key
+            delay = self.policy_for(key).delay()
+        self._push(key, self._time() + delay, 'schedule')
+
+    def remove(self, key: Optional[str]):
+        """Stop scheduling ``key``."""
+        schedule = self._schedules.pop(key, None)
+        if schedule is not None and schedule.entry is not None:
+            schedule.entry[-1] = False
+
+    def trigger(self, key: Optional[str], reason: str = 'request') -> bool:
+        """Rotate ``key`` now. False if unknown or already rotating."""
+        schedule = self._schedules.get(key)
+        if schedule is None or schedule.rotating:
+            return False
+        if schedule.entry is not None and schedule.entry[3] != 'schedule':
+            return True  # An early rotation is already queued
+        self.metrics.inc('ip_phantom_rotation_triggers_total', reason=reason)
+        self._push(key, self._time(), reason)
+        return True
+
+    def reschedule(self, key: Optional[str], delay: float) -> bool:
+        """Move ``key``'s next scheduled rotation to ``delay`` seconds from now."""
+        schedule = self._schedules.get(key)
+        if schedule is None:
+            return False
+        if schedule.rotating or (schedule.entry is not None and schedule.entry[3] != 'schedule'):
+            return True  # Rescheduled from the policy once that rotation is done
+        self._push(key, self._time() + delay, 'schedule')
+        return True
+
+    def next_due(self, key: Optional[str]) -> Optional[float]:
+        """Seconds until ``key`` rotates next, or None if nothing is scheduled."""
+        schedule = self._schedules.get(key)
+        if schedule is None or schedule.entry is None:
+            return None
+        return max(0.0, schedule.entry[0] - self._time())
+
+    def record(self, key: Optional[str], requests: int = 0, nbytes: int = 0):
+        """Count connections and bytes for ``key``, rotating early past the limits."""
+        schedule = self._schedules.get(key)
+        if schedule is None:
+            return
+        schedule.requests += requests
+        schedule.bytes += nbytes
+        policy = self.policy_for(key)
+        if policy.max_requests and schedule.requests >= policy.max_requests:
+            self.trigger(key, 'requests')
+        elif policy.max_bytes and schedule.bytes >= policy.max_bytes:
+            self.trigger(key, 'bytes')
+
+    def record_connect(self, key: Optional[str], seconds: float, ok: bool):
+        """Count an upstream connect; consecutive failed or slow ones trigger a rotation."""
+        schedule = self._schedules.get(key)
+        if schedule is None:
+            return
+        policy = self.policy_for(key)
+        slow = ok and policy.slow_threshold and seconds > policy.slow_threshold
+        if ok and not slow:
+            schedule.failures = 0
+        else:
+            schedule.failures += 1
+            if policy.max_failures and schedule.failures >= policy.max_failures:
+                self.trigger(key, 'slow' if slow else 'failure')
+        if ok:
+            self.record(key, requests=1)
+
+    def stop(self):
+        """Make :meth:`run` return."""
+        self._stopped = True
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self):
+        """Start due rotations until stopped (or cancelled)."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        try:
+            while not self._stopped:
+                heap = self._heap
+                while heap and not heap[0][-1]:
+                    heapq.heappop(heap)  # Superseded entry
+                now = self._time()
+                if heap and heap[0][0] <= now:
+                    due, _, key, reason, _ = heapq.heappop(heap)
+                    schedule = self._schedules[key]
+                    schedule.entry = None
+                    self._start(key, schedule, due, reason)
+                    continue
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), heap[0][0] - now if heap else None)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            tasks = list(self._tasks)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _time(self) -> float:
+        return self._loop.time() if self._loop else time.monotonic()
+
+    def _push(self, key: Optional[str], due: float, reason: str):
+        schedule = self._schedules[key]
+        if schedule.entry is not None:
+            schedule.entry[-1] = False
+        schedule.entry = [due, next(self._counter), key, reason, True]
+        heapq.heappush(self._heap, schedule.entry)
+        if self._wakeup is not None and self._heap[0] is schedule.entry:
+            self._wakeup.set()
+
+    def _start(self, key: Optional[str], schedule: _Schedule, due: float, reason: str):
+        policy = self.policy_for(key)
+        if reason == 'schedule' and not policy.rotate_idle and not schedule.requests:
+            self.metrics.inc('ip_phantom_rotations_skipped_total', reason='idle')
+            self._reschedule(key, due, reason)
+            return
+        schedule.rotating = True
+        task = asyncio.ensure_future(self._rotate(key, schedule, due, reason))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _rotate(self, key: Optional[str], schedule: _Schedule, due: float, reason: str):
+        try:
+            await self.rotate(key, reason)
+        except Exception as e:
+            logging.getLogger(__name__).debug(f"Rotation of {key or 'the global identity'} failed: {e}")
+        finally:
+            schedule.rotating = False
+            schedule.requests = schedule.bytes = schedule.failures = 0
+        if self._schedules.get(key) is schedule and not self._stopped:
+            self._reschedule(key, due, reason)
+
+    def _reschedule(self, key: Optional[str], due: float, reason: str):
+        policy = self.policy_for(key)
+        if not policy.interval:
+            return  # Only usage and failures rotate this key
+        now = self._time()
+        if reason == 'schedule':
+            # Fixed rate: measured from the previous deadline, not from now
+            next_due = due + policy.delay()
+            if next_due < now:
+                # Overran one or more slots: skip them rather than bursting
+                missed = int((now - next_due) // max(policy.interval, 1)) + 1
+                next_due += missed * policy.interval
+                if self.on_overrun:
+                    self.on_overrun(key, missed)
+        else:
+            next_due = now + policy.delay()
+        self._push(key, next_due, 'schedule')
+        if self.on_rescheduled:
+            self.on_rescheduled(key, next_due - now)
+
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                409: 'Conflict', 413: 'Payload Too Large', 504: 'Gateway Timeout'}
+
+
+class ControlAPI:
+    """Local JSON API to steer a running engine.
+
+    Plain HTTP/1.1 on a Unix domain socket and/or 127.0.0.1:
+
+    - ``GET /status``: current IP, circuit (and its probe), last rotation and schedule
+    - ``POST /rotate``: rotate now (``{"client": key}`` for one client;
+      ``?wait=1`` answers once the rotation is done, with the new IP;
+      ``{"queued": false, "rotating": true}`` if one is already running)
+    - ``POST /pause`` / ``POST /resume``: stop or restart scheduled rotations
+    - ``POST /set-interval``: ``{"interval": seconds}``
+
+    Requests are served on the engine's event loop and only ever queue
+    work for the scheduler, so a burst of calls cannot hold up a rotation.
+    """
+
+    def __init__(self, engine: 'AsyncRotationEngine', socket_path: Optional[str] = None,
+                 port: int = 0, host: str = '127.0.0.1', wait_timeout: float = 120.0):
+        self.engine = engine
+        self.socket_path = socket_path
+        self.port = port
+        self.host = host
+        self.wait_timeout = wait_timeout
+        self._servers = []
+
+    async def start(self):
+        """Start listening on the configured socket and/or port."""
+        if self.socket_path:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)  # Left over from an unclean exit
+            server = await asyncio.start_unix_server(self._serve, path=self.socket_path)
+            # Anyone who can connect can rotate: owner only
+            os.chmod(self.socket_path, 0o600)
+            self._servers.append(server)
+        if self.port:
+            server = await asyncio.start_server(self._serve, self.host, self.port)
+            self.port = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+
+    async def close(self):
+        """Stop listening and remove the Unix socket."""
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+        if self.socket_path and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    return
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length', 0))
+                if length > 65536:
+                    status, payload = 413, {'error': 'request body too large'}
+                    body = b''
+                else:
+                    body = await reader.readexactly(length) if length else b''
+                    status, payload = await self.handle(method.upper(), target, body)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                data = json.dumps(payload).encode()
+                writer.write(f'HTTP/1.1 {status} {HTTP_REASONS.get(status, "")}\r\n'
+                             f'Content-Type: application/json\r\nContent-Length: {len(data)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode() + data)
+                await writer.drain()
+                if not keep_alive or status == 413:
+                    return
+        except ValueError:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        except ASYNC_IO_ERRORS + (asyncio.TimeoutError,):
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, method: str, target: str, body: bytes = b'') -> Tuple[int, Dict]:
+        """Answer one API call with (HTTP status, JSON payload)."""
+        parts = urllib.parse.urlsplit(target)
+        endpoint = parts.path.strip('/')
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        try:
+            params = json.loads(body) if body.strip() else {}
+            if not isinstance(params, dict):
+                raise ValueError("expected a JSON object")
+        except ValueError as e:
+            return self._count(endpoint, 400, {'error': f'invalid JSON body: {e}'})
+        params = {**query, **params}
+
+        routes = {'status': ('GET', self._status), 'rotate': ('POST', self._rotate),
+                  'pause': ('POST', self._pause), 'resume': ('POST', self._resume),
+                  'set-interval': ('POST', self._set_interval)}
+        if endpoint not in routes:
+            return self._count('unknown', 404, {'error': f'unknown endpoint /{endpoint}',
+                                                'endpoints': sorted(routes)})
+        allowed, handler = routes[endpoint]
+        if method != allowed:
+            return self._count(endpoint, 405, {'error': f'use {allowed} /{endpoint}'})
+        return self._count(endpoint, *(await handler(params)))
+
+    def _count(self, endpoint: str, status: int, payload: Dict) -> Tuple[int, Dict]:
+        self.engine.phantom.metrics.inc('ip_phantom_api_requests_total', endpoint=endpoint,
+                                        status=str(status))
+        return status, payload
+
+    async def _status(self, params: Dict) -> Tuple[int, Dict]:
+        return 200, self.engine.status()
+
+    async def _rotate(self, params: Dict) -> Tuple[int, Dict]:
+        engine = self.engine
+        client = params.get('client')
+        if client is not None and engine.clients is None:
+            return 409, {'error': 'per-client rotation needs client_isolation and the front proxy'}
+        wait = str(params.get('wait', '')).lower() in ('1', 'true', 'yes')
+        done = engine.rotation_done() if wait and client is None else None
+        queued = engine.request_rotation(client)
+        if not queued:
+            if client is not None:
+                return 404, {'rotated': False, 'error': f'unknown client {client}'}
+            if not engine.rotating:
+                return 409, {'rotated': False, 'error': 'rotation not possible now'}
+            # A rotation is already running: it serves this request too
+        if done is None:
+            return 200, {'queued': True} if queued else {'queued': False, 'rotating': True}
+        try:
+            rotated = await asyncio.wait_for(done, self.wait_timeout)
+        except asyncio.TimeoutError:
+            return 504, {'queued': True, 'error': 'rotation still running'}
+        return 200, {'rotated': rotated, 'ip': engine.phantom.current_ip,
+                     'last_rotation': engine.last_rotation}
+
+    async def _pause(self, params: Dict) -> Tuple[int, Dict]:
+        self.engine.paused = True
+        return 200, {'paused': True}
+
+    async def _resume(self, params: Dict) -> Tuple[int, Dict]:
+        self.engine.paused = False
+        return 200, {'paused': False}
+
+    async def _set_interval(self, params: Dict) -> Tuple[int, Dict]:
+        try:
+            interval = float(params['interval'])
+            if not 1 <= interval <= 86400:
+                raise ValueError(interval)
+        except (KeyError, TypeError, ValueError):
+            return 400, {'error': 'interval must be between 1 and 86400 seconds'}
+        self.engine.set_interval(interval)
+        return 200, {'interval': interval, 'next_rotation_in': self.engine._next_rotation_in()}
+
+
+class AsyncRotationEngine:
+    """Event loop that drives rotations and Tor health checks.
+    
+    A :class:`RotationScheduler` starts rotations on a fixed-rate schedule
+    (``interval`` seconds apart, measured from the previous start, so slow
+    rotations do not make the schedule drift), optionally jittered, and
+    early on front proxy usage or failures; per-client schedules share it.
+    The blocking rotation backends run in a worker thread; health checks
+    use the async control-port and HTTP clients and run concurrently with
+    rotations instead of between them.
+    """
+    
+    def __init__(self, phantom: 'IPPhantom', health_interval: float = 30.0):
+        self.phantom = phantom
+        self.health_interval = health_interval
+        self.rotation_count = 0
+        self.http = AsyncHTTPClient(timeout=phantom.http_client.timeout)
+        self.controllers = {}
+        self.rotating = False
+        self.front_proxy = None
+        self.clients = None
+        self.scheduler = None
+        self.control_api = None
+        self.endpoint_prober = None
+        self.paused = False
+        # {'reason', 'success', 'seconds', 'finished_at'} of the last global rotation
+        self.last_rotation = None
+        self._rotation_waiters = []
+        self._loop = None
+    
+    def _policy(self, interval: float, rotate_idle: bool) -> RotationPolicy:
+        phantom = self.phantom
+        return RotationPolicy(interval, jitter=phantom.rotation_jitter,
+                              max_requests=phantom.rotate_after_requests,
+                              max_bytes=phantom.rotate_after_bytes,
+                              max_failures=phantom.rotate_after_failures,
+                              slow_threshold=phantom.slow_connect_threshold,
+                              rotate_idle=rotate_idle)
+    
+    async def run(self):
+        """Run until cancelled (SIGINT/SIGTERM), then clean up."""
+        loop = asyncio.get_running_loop()
+        main_task = asyncio.current_task()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, main_task.cancel)
+            except (NotImplementedError, RuntimeError):
+                pass  # Not supported here; KeyboardInterrupt still works
+        
+        phantom = self.phantom
+        self._loop = loop
+        proxied = bool(phantom.front_proxy_port and not phantom.demo_mode)
+        client_interval = phantom.client_rotation_interval
+        # Idleness is only known for traffic through the front proxy
+        self.scheduler = RotationScheduler(
+            self._rotate, self._policy(phantom.interval, phantom.rotate_idle or not proxied),
+            self._policy(phantom.interval if client_interval is None else client_interval,
+                         phantom.rotate_idle),
+            metrics=phantom.metrics)
+        self.scheduler.on_overrun = self._overrun
+        self.scheduler.on_rescheduled = self._rescheduled
+        self.scheduler.add(None, delay=0)
+        
+        tasks = [asyncio.ensure_future(self.scheduler.run())]
+        if self.health_interval and not phantom.demo_mode and phantom.uses_tor:
+            tasks.append(asyncio.ensure_future(self._health_loop()))
+        if proxied:
+            self._start_front_proxy(tasks)
+        if phantom.endpoint_health is not None and not phantom.demo_mode:
+            tasks.append(asyncio.ensure_future(self._probe_endpoints()))
+        if phantom.api_socket or phantom.api_port:
+            await self._start_control_api()
+        try:
+            # Only the scheduler ends the engine (it stops with the phantom);
+            # a helper task that fails still raises here
+            pending = set(tasks)
+            while tasks[0] in pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if self.control_api:
+                await self.control_api.close()
+            await self.http.aclose()
+            for controller in self.controllers.values():
+                await controller.close()
+            await run_in_thread(self.phantom.shutdown)
+    
+    def _start_front_proxy(self, tasks: List):
+        phantom = self.phantom
+        if phantom.client_isolation:
+            # Client schedules live in the scheduler, so the table never rotates by itself
+            self.clients = ClientTable(phantom.client_table_size, 0, metrics=phantom.metrics,
+                                       on_rotate=lambda key: self.front_proxy.rotated(key),
+                                       on_evict=self.scheduler.remove)
+        
+        def upstream(key: Optional[str]):
+            # Keyed clients get circuits of their own; anonymous ones follow the rotation
+            if key is None or self.clients is None or phantom.active_endpoint is not None:
+                return phantom.egress
+            if key not in self.clients:
+                self.scheduler.add(key)
+            return phantom.tor_socks, self.clients.credentials(key)
+        
+        proxy = FrontProxy(upstream, host=phantom.front_proxy_host, port=phantom.front_proxy_port,
+                           isolated=self.clients is not None, usage=self.scheduler,
+                           drain_timeout=phantom.front_proxy_drain, metrics=phantom.metrics)
+        try:
+            proxy.listen()
+        except OSError as e:
+            phantom.logger.warning(f"Cannot start the front proxy on port {phantom.front_proxy_port}: {e}")
+            return
+        self.front_proxy = proxy
+        tasks.append(asyncio.ensure_future(proxy.serve()))
+        safe_print(f"🔀 Front proxy at {proxy.host}:{proxy.port} (SOCKS5 and HTTP)")
+    
+    async def _start_control_api(self):
+        phantom = self.phantom
+        api = ControlAPI(self, socket_path=phantom.api_socket, port=phantom.api_port)
+        try:
+            await api.start()
+        except OSError as e:
+            phantom.logger.warning(f"Cannot start the control API: {e}")
+            await api.close()
+            return
+        self.control_api = api
+        where = [f"unix:{api.socket_path}"] if api.socket_path else []
+        if api.port:
+            where.append(f"http://{api.host}:{api.port}")
+        safe_print(f"🎛️  Control API at {', '.join(where)}")
+    
+    def status(self) -> Dict:
+        """Snapshot of the engine for the control API."""
+        phantom = self.phantom
+        status = {
+            'current_ip': phantom.current_ip,
+            'paused': self.paused,
+            'rotating': self.rotating,
+            'interval': phantom.interval,
+            'next_rotation_in': self._next_rotation_in(),
+            'rotation_count': self.rotation_count,
+            'last_rotation': self.last_rotation,
+            'circuit': phantom.last_circuit,
+            'circuit_probe': phantom.last_probe,
+        }
+        if not phantom.demo_mode:
+            status['tor_instance'] = phantom.active_tor.name
+            status['prebuilt_identity'] = phantom.active_identity is not None
+            if phantom.rotation_method != 'tor':
+                endpoint = phantom.active_endpoint
+                status['endpoint'] = ({'kind': endpoint['kind'], 'name': endpoint['name']}
+                                      if endpoint else None)
+                if phantom.endpoint_health is not None:
+                    status['endpoints'] = phantom.endpoint_health.summary()
+        if self.front_proxy:
+            status['proxy_streams'] = len(self.front_proxy.streams)
+        if self.clients is not None:
+            status['clients'] = len(self.clients)
+        return status
+    
+    def _next_rotation_in(self) -> Optional[float]:
+        due = self.scheduler.next_due(None) if self.scheduler else None
+        return None if due is None else round(due, 3)
+    
+    def set_interval(self, interval: float):
+        """Change the global rotation period, starting from now."""
+        self.phantom.interval = interval
+        self.scheduler.policy.interval = interval
+        if self.phantom.client_rotation_interval is None and self.scheduler.client_policy is not self.scheduler.policy:
+            self.scheduler.client_policy.interval = interval
+        self.scheduler.reschedule(None, self.scheduler.policy.delay())
+    
+    def rotation_done(self):
+        """Future resolved with the outcome of the next global rotation to finish."""
+        future = self._loop.create_future()
+        self._rotation_waiters.append(future)
+        return future
+    
+    def rotate_client(self, key: str, reason: str = 'request') -> bool:
+        """Give one front proxy client a new circuit (needs client_isolation)."""
+        return self.clients is not None and self.clients.rotate(key, reason)
+    
+    def request_rotation(self, key: Optional[str] = None) -> bool:
+        """Rotate the global identity (or client ``key``) now. Safe from any thread."""
+        if self.scheduler is None:
+            return False
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            return self.scheduler.trigger(key, 'request')
+        try:
+            self._loop.call_soon_threadsafe(self.scheduler.trigger, key, 'request')
+        except RuntimeError:
+            return False  # The loop is closed
+        return True
+    
+    async def _rotate(self, key: Optional[str], reason: str) -> bool:
+        if key is not None:
+            return self.rotate_client(key, reason)
+        phantom = self.phantom
+        if not phantom.running:
+            self.scheduler.stop()
+            return False
+        if self.paused and reason == 'schedule':
+            phantom.metrics.inc('ip_phantom_rotations_skipped_total', reason='paused')
+            return False
+        if reason != 'schedule':
+            safe_print(f"🔁 Rotating early ({reason})")
+        self.rotating = True
+        start = time.perf_counter()
+        rotated = False
+        try:
+            rotated = await run_in_thread(phantom.rotate_ip)
+        finally:
+            self.rotating = False
+            self.last_rotation = {'reason': reason, 'success': rotated,
+                                  'outcome': phantom.last_outcome,
+                                  'seconds': round(time.perf_counter() - start, 3),
+                                  'finished_at': round(time.time(), 3)}
+            waiters, self._rotation_waiters = self._rotation_waiters, []
+            for future in waiters:
+                if not future.done():
+                    future.set_result(rotated)
+        if rotated:
+            self.rotation_count += 1
+            if self.front_proxy:
+                self.front_proxy.rotated()
+            if phantom.demo_mode:
+                safe_print(f"✅ Identity change #{self.rotation_count} complete")
+        elif phantom.last_outcome == 'unchanged':
+            safe_print("⚠️  Exit IP unchanged, trying again at the next rotation")
+        else:
+            safe_print("⚠️  Connection failed, retrying...")
+        if not phantom.running:
+            self.scheduler.stop()
+        return rotated
+    
+    def _overrun(self, key: Optional[str], missed: int):
+        if key is None:
+            self.phantom.logger.warning(f"⚠️  Rotation took longer than the interval, skipping {missed} slot(s)")
+    
+    def _rescheduled(self, key: Optional[str], delay: float):
+        if key is None and self.phantom.running:
+            safe_print(f"⏳ Waiting {max(0, round(delay))} seconds...")
+            safe_print()
+    
+    async def _probe_endpoints(self):
+        phantom = self.phantom
+        self.endpoint_prober = EndpointProber(
+            phantom.endpoint_health, phantom.direct_services.ranked()[0],
+            interval=phantom.endpoint_probe_interval, concurrency=phantom.endpoint_probe_concurrency,
+            rate=phantom.endpoint_probe_rate, timeout=min(5.0, phantom.http_client.timeout),
+            metrics=phantom.metrics)
+        await self.endpoint_prober.run()
+    
+    async def _health_loop(self):
+        while self.phantom.running:
+            await asyncio.sleep(self.health_interval)
+            try:
+                await self.check_health()
+            except Exception as e:
+                self.phantom.logger.debug(f"Health check failed: {e}")
+    
+    def _controller(self, instance: TorInstance) -> AsyncTorController:
+        controller = self.controllers.get(instance.name)
+        if controller is None:
+            controller = self.controllers[instance.name] = AsyncTorController.like(instance.controller)
+        return controller
+    
+    async def _instance_healthy(self, instance: TorInstance) -> bool:
+        try:
+            info = await self._controller(instance).get_info('status/circuit-established')
+        except (asyncio.TimeoutError, TorControlError) + ASYNC_IO_ERRORS:
+            return False
+        return info.get('status/circuit-established') == '1'
+    
+    async def check_health(self) -> bool:
+        """Check every Tor instance concurrently and restart unhealthy ones."""
+        phantom = self.phantom
+        instances = list(phantom.tor_instances)
+        healthy = await asyncio.gather(*(self._instance_healthy(instance) for instance in instances))
+        if not all(healthy):
+            names = ', '.join(i.name for i, ok in zip(instances, healthy) if not ok)
+            phantom.logger.warning(f"⚠️  Tor health check failed ({names}), restarting")
+            return await run_in_thread(phantom.start_tor)
+        
+        if self.rotating:
+            return True  # The rotation is about to report the exit itself
+        auth = phantom.tor_socks_auth
+        for service in phantom.tor_services.ranked():
+            try:
+                status, body = await asyncio.wait_for(
+                    self.http.get(service, proxy=phantom.tor_socks, proxy_auth=auth),
+                    phantom.http_client.timeout)
+                exit_ip = parse_ip_response(body) if status == 200 else None
+            except (asyncio.TimeoutError, ValueError, AttributeError) + ASYNC_IO_ERRORS:
+                continue
+            if exit_ip:
+                if exit_ip != phantom.current_ip and not self.rotating:
+                    phantom.logger.info(f"ℹ️  Tor exit changed outside a rotation: {exit_ip}")
+                    phantom.current_ip = exit_ip
+                return True
+        phantom.logger.warning("⚠️  Tor is up but no IP service answered the health check")
+        return False
+
+
+def print_history(history: RotationHistory, query: str, hours: float) -> bool:
+    """Print one ``--history`` query over the last ``hours`` hours."""
+    since = time.time() - hours * 3600
+    try:
+        if query == 'summary':
+            summary = history.summary(since)
+            safe_print(f"📊 Last {hours:g}h: {summary['successes']} successful rotations, "
+                       f"{summary['unique_exits']} unique exit IPs, "
+                       f"{summary['reuse_rate']:.1%} IP reuse")
+            for (backend, outcome), count in sorted(summary['rotations'].items()):
+                safe_print(f"   {backend or '?':<6} {outcome:<10} {count}")
+        elif query == 'latency':
+            safe_print(f"{'country':<8} {'rotations':>9} {'p50':>8} {'p95':>8}")
+            for country, count, p50, p95 in history.latency_by_country(since):
+                safe_print(f"{country or '?':<8} {count:>9} {p50:>7.2f}s {p95:>7.2f}s")
+        else:
+            for record in reversed(history.recent()):
+                if record['ts'] < since:
+                    continue
+                stamp = datetime.fromtimestamp(record['ts']).strftime('%Y-%m-%d %H:%M:%S')
+                safe_print(f"{stamp} {record['backend'] or '?':<6} {record['outcome']:<10} "
+                           f"{record['seconds']:>6.2f}s {record['old_ip'] or '-'} -> "
+                           f"{record['new_ip'] or '-'} {record['country'] or ''}")
+    except sqlite3.Error as e:
+        safe_print(f"❌ Cannot read the rotation history {history.path}: {e}")
+        return False
+    return True
+
+
 def main():
     """Main entry point."""
     parser = argparse.ArgumentParser(
@@ -676,6 +5615,9 @@ Examples:
   python3 ip_phantom.py --interval 10    # Change IP every 10 seconds
   python3 ip_phantom.py --config my_config.json  # Use custom config
   python3 ip_phantom.py --check-ip       # Just check current IP
+  python3 ip_phantom.py --benchmark      # Measure rotation latency offline
+  python3 ip_phantom.py --prefetch       # Warm Tor's cache before a restart
+  python3 ip_phantom.py --history latency --since 24  # p95 rotation time by country
         """
     )
     
@@ -717,12 +5659,63 @@ Examples:
         help='Use Tor for real IP rotation (free, no VPN required)'
     )
     
+    parser.add_argument(
+        '--benchmark',
+        action='store_true',
+        help='Benchmark rotations against local fake Tor servers and exit'
+    )
+    
+    parser.add_argument(
+        '--prefetch',
+        action='store_true',
+        help="Bootstrap Tor once to warm its persistent cache and exit"
+    )
+    
+    parser.add_argument(
+        '--history',
+        choices=('summary', 'latency', 'recent'),
+        help='Query the rotation history (unique exits and reuse rate, '
+             'latency by country, or the latest rotations) and exit'
+    )
+    
+    parser.add_argument(
+        '--since',
+        type=float,
+        default=24.0,
+        help='Hours of history to query (default: 24)'
+    )
+    
     args = parser.parse_args()
     
     # Set logging level
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
     
+    # Benchmark against local fake servers and exit (no Tor or internet needed)
+    if args.benchmark:
+        import ip_phantom_bench
+        ip_phantom_bench.main(['rotation', '--rounds', '100'])
+        return
+    
+    # Warm Tor's DataDirectory so the next start skips the cold bootstrap
+    if args.prefetch:
+        phantom = IPPhantom(interval=args.interval, config_file=args.config)
+        if not phantom.prefetch():
+            safe_print("❌ Failed to prefetch Tor directory information")
+            sys.exit(1)
+        safe_print("✅ Tor cache is warm")
+        return
+    
+    # Answer from the rotation history without starting anything
+    if args.history:
+        phantom = IPPhantom(interval=args.interval, config_file=args.config)
+        if not phantom.history_file:
+            safe_print("❌ Rotation history is disabled (history_file)")
+            sys.exit(1)
+        if not print_history(RotationHistory(phantom.history_file), args.history, args.since):
+            sys.exit(1)
+        return
+    
     # Just check IP and exit
     if args.check_ip:
         phantom = IPPhantom(interval=args.interval, config_file=args.config, demo_mode=args.demo)
@@ -0,0 +1,1403 @@
+#!/usr/bin/env python3
+"""
+IP Phantom Benchmarks
+Local latency benchmarks for IP Phantom's hot paths. Everything runs against
+fake servers bound to 127.0.0.1, so neither Tor nor internet access is needed.
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import http.client
+import http.server
+import inspect
+import io
+import json
+import logging
+import os
+import random
+import resource
+import select
+import shutil
+import socket
+import socketserver
+import sqlite3
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Optional
+
+from ip_phantom import (AsyncRotationEngine, ClientTable, EndpointProber, FrontProxy, HTTPClient,
+                        IPPhantom, LogQueueHandler, LogWriter, Metrics, RotatingLogHandler, RotationHistory,
+                        RotationPolicy, RotationScheduler, SafeStreamHandler, TorController, TorInstance, safe_print,
+                        socks5_connect)
+
+
+class _ThreadingServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeControlPortHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough of the Tor control protocol for benchmarking.
+
+    NEWNYM is scripted like real Tor: it is acknowledged at once, and a new
+    circuit is LAUNCHED and BUILT ``build_delay`` seconds later (CIRC events).
+    NEWNYMs closer together than ``newnym_interval`` are delayed and
+    announced with Tor's "Rate limiting NEWNYM request" NOTICE event.
+    """
+
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+        self.events = set()
+
+    def handle(self):
+        server = self.server
+        authenticated = False
+        try:
+            for raw in self.rfile:
+                line = raw.decode('utf-8', 'replace').strip()
+                if not line:
+                    continue
+                command, _, argument = line.partition(' ')
+                command = command.upper()
+                if server.latency:
+                    time.sleep(server.latency)
+
+                if command == 'AUTHENTICATE':
+                    authenticated = True
+                    self._send('250 OK')
+                elif not authenticated:
+                    self._send('514 Authentication required.')
+                    return
+                elif command == 'SETEVENTS':
+                    self.events = set(argument.upper().split())
+                    with server.lock:
+                        server.listeners.add(self)
+                    self._send('250 OK')
+                elif command == 'SIGNAL':
+                    server.signals.append(argument)
+                    self._send('250 OK')
+                    if argument.upper() == 'NEWNYM':
+                        server.newnym()
+                elif command == 'SETCONF':
+                    key, _, value = argument.partition('=')
+                    with server.lock:
+                        server.conf[key] = value
+                    self._send('250 OK')
+                elif command == 'RESETCONF':
+                    with server.lock:
+                        server.conf.pop(argument, None)
+                    self._send('250 OK')
+                elif command == 'GETINFO':
+                    self._send(''.join(self._info_line(key) for key in argument.split()) + '250 OK')
+                elif command == 'QUIT':
+                    self._send('250 closing connection')
+                    return
+                else:
+                    self._send(f'510 Unrecognized command "{command}"')
+        finally:
+            with server.lock:
+                server.listeners.discard(self)
+
+    def _info_line(self, key: str) -> str:
+        value = self.server.getinfo(key)
+        if '\n' in value:
+            return f'250+{key}=\r\n' + ''.join(f'{line}\r\n' for line in value.split('\n')) + '.\r\n'
+        return f'250-{key}={value}\r\n'
+
+    def _send(self, text: str):
+        with self.write_lock:
+            self.wfile.write(f'{text}\r\n'.encode())
+            self.wfile.flush()
+
+    def emit(self, event_type: str, text: str):
+        if event_type in self.events:
+            try:
+                self._send(f'650 {text}')
+            except OSError:
+                pass
+
+
+FAKE_COUNTRIES = ('de', 'nl', 'us', 'fr', 'se', 'ch', 'ca', 'ro')
+
+
+def _fake_fingerprint(n: int) -> bytes:
+    return n.to_bytes(20, 'big')
+
+
+def _fake_country(address: str) -> str:
+    return FAKE_COUNTRIES[sum(map(int, address.split('.'))) % len(FAKE_COUNTRIES)]
+
+
+def _fake_exit_address(n: int) -> str:
+    # Spread over /16s so exit diversity can be measured
+    return f'10.{n % 200}.{n // 200 % 256}.{n // 51200 % 254 + 1}'
+
+
+class _FakeTorServer(_ThreadingServer):
+    def __init__(self, address, handler, latency, build_delay, newnym_interval, exit_pool=0):
+        super().__init__(address, handler)
+        self.latency = latency
+        self.build_delay = build_delay
+        self.newnym_interval = newnym_interval
+        self.signals = []
+        self.info = {'version': '0.4.8.0 (fake)', 'status/circuit-established': '1',
+                     'consensus/valid-after': '2024-01-21 00:00:00'}
+        self.conf = {}
+        self.lock = threading.Lock()
+        self.listeners = set()
+        self.circuits = {}
+        self.next_circuit_id = 1
+        self.last_newnym = -float('inf')
+        self.newnym_pending = False
+        # Exit IPs handed out per (NEWNYM epoch, SOCKS username)
+        self.epoch = 0
+        self.exits = {}
+        self.next_exit = 1
+        # With a pool, exits are drawn at random from that many (repeats happen)
+        self.exit_pool = exit_pool
+
+    def exit_for(self, username: str) -> str:
+        """Exit IP of the circuit a SOCKS client with ``username`` would use."""
+        return _fake_exit_address(self.exit_number(username))
+
+    def exit_number(self, username: str) -> int:
+        """Number of the fake exit relay (see ``network_status``) for ``username``."""
+        with self.lock:
+            key = (self.epoch, username)
+            if key not in self.exits:
+                allowed = self._exit_nodes()
+                if allowed:
+                    n = random.choice(allowed)
+                elif self.exit_pool:
+                    n = random.randint(1, self.exit_pool)
+                else:
+                    n = self.next_exit
+                    self.next_exit += 1
+                self.exits[key] = n
+            return self.exits[key]
+
+    def getinfo(self, key: str) -> str:
+        if key == 'circuit-status':
+            with self.lock:
+                return '\n'.join(self.circuits.values())
+        if key == 'ns/all':
+            return self.network_status()
+        if key.startswith('ip-to-country/'):
+            return _fake_country(key.partition('/')[2])
+        return self.info.get(key, '')
+
+    def _exit_nodes(self) -> List[int]:
+        """Fake relays allowed by ExitNodes (``$fingerprint`` or ``{cc}`` items)."""
+        allowed = []
+        for item in filter(None, self.conf.get('ExitNodes', '').split(',')):
+            if item.startswith('$'):
+                allowed.append(int(item[1:], 16))
+            elif item.startswith('{'):
+                country = item.strip('{}').lower()
+                allowed += [n for n in range(1, (self.exit_pool or 200) + 1)
+                            if _fake_country(_fake_exit_address(n)) == country]
+        return allowed
+
+    def network_status(self) -> str:
+        """A consensus listing every fake exit, in ``ns/all`` format."""
+        entries = []
+        for n in range(1, (self.exit_pool or 200) + 1):
+            identity = base64.b64encode(_fake_fingerprint(n)).decode().rstrip('=')
+            entries += [f'r exit{n} {identity} AAAAAAAAAAAAAAAAAAAAAAAAAAA 2024-01-21 00:00:00 '
+                        f'{_fake_exit_address(n)} 9001 0',
+                        's Exit Fast Running Stable Valid',
+                        f'w Bandwidth={100 * n}',
+                        'p accept 80,443']
+        return '\n'.join(entries)
+
+    def emit(self, event_type: str, text: str):
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener.emit(event_type, text)
+
+    def newnym(self):
+        now = time.monotonic()
+        delay = 0
+        with self.lock:
+            wait = self.last_newnym + self.newnym_interval - now
+            if wait > 0:
+                delay = int(wait) + 1
+                if self.newnym_pending:
+                    return  # Like Tor, one delayed NEWNYM covers all requests until then
+                self.newnym_pending = True
+            self.last_newnym = now + delay
+        if delay:
+            self.emit('NOTICE', f'NOTICE Rate limiting NEWNYM request: delaying by {delay} second(s)')
+            threading.Timer(delay, self.apply_newnym).start()
+        else:
+            self.apply_newnym()
+
+    def apply_newnym(self):
+        with self.lock:
+            self.newnym_pending = False
+            # Existing circuits become dirty; the fake just forgets them
+            self.circuits.clear()
+            self.epoch += 1
+            self.exits.clear()
+        threading.Timer(self.build_delay, self.build_circuit).start()
+
+    def build_circuit(self):
+        with self.lock:
+            circuit_id = self.next_circuit_id
+            self.next_circuit_id += 1
+        # The circuit anonymous SOCKS clients get, through the exit they will see
+        exit_number = self.exit_number('')
+        exit_hop = f'${_fake_fingerprint(exit_number).hex().upper()}~exit{exit_number}'
+        path = f'$AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA~guard,$BBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBBB~middle,{exit_hop}'
+        self.emit('CIRC', f'CIRC {circuit_id} LAUNCHED PURPOSE=GENERAL')
+        with self.lock:
+            self.circuits[circuit_id] = f'{circuit_id} BUILT {path} PURPOSE=GENERAL'
+        self.emit('CIRC', f'CIRC {circuit_id} BUILT {path} PURPOSE=GENERAL')
+
+
+class FakeControlPort:
+    """A fake Tor control port running in a background thread."""
+
+    def __init__(self, latency: float = 0.0, build_delay: float = 0.0,
+                 newnym_interval: float = 0.0, exit_pool: int = 0):
+        self.server = _FakeTorServer(('127.0.0.1', 0), FakeControlPortHandler,
+                                     latency, build_delay, newnym_interval, exit_pool)
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeEchoHandler(http.server.BaseHTTPRequestHandler):
+    """httpbin-style IP echo: answers every GET with {"origin": <exit IP>}.
+
+    Requests relayed by a :class:`FakeSocksServer` report the exit IP it
+    registered for the connection, others ``exit_ip`` (which may be a
+    callable returning it); a ``failure_rate`` share answer 503, and
+    a ``slow_exits`` share of exits (always the same ones) add ``slow_latency``.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.failure_rate and random.random() < self.server.failure_rate:
+            self.send_error(503)
+            return
+        exit_ip = self.server.peer_exits.get(self.client_address) or self.server.exit_ip
+        if callable(exit_ip):
+            exit_ip = exit_ip()
+        if self.server.slow_exits and zlib.crc32(exit_ip.encode()) % 1000 < self.server.slow_exits * 1000:
+            time.sleep(self.server.slow_latency)
+        body = json.dumps({'origin': exit_ip}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeEchoServer:
+    """A local HTTP IP-echo service running in a background thread."""
+
+    def __init__(self, exit_ip='203.0.113.1', latency: float = 0.0,
+                 failure_rate: float = 0.0, slow_exits: float = 0.0, slow_latency: float = 0.3):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeEchoHandler)
+        self.server.daemon_threads = True
+        self.server.exit_ip = exit_ip
+        self.server.latency = latency
+        self.server.failure_rate = failure_rate
+        self.server.slow_exits = slow_exits
+        self.server.slow_latency = slow_latency
+        self.server.peer_exits = {}
+        self.port = self.server.server_address[1]
+        self.url = f'http://127.0.0.1:{self.port}/ip'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+MOCK_OPENVPN = """#!/bin/sh
+# Mock openvpn: "connects" to the config's first remote after a delay and
+# runs until stopped. Called as: openvpn --config FILE --dev DEVICE ...
+remote=$(awk '$1 == "remote" {{print $2; exit}}' "$2")
+sleep {delay}
+echo "$remote" > {state}/$4
+echo "UDP link remote: [AF_INET]$remote:1194"
+echo "Initialization Sequence Completed"
+exec sleep 3600
+"""
+
+MOCK_IP = """#!/bin/sh
+# Mock ip: answers the default route query and logs route changes
+if [ "$1" = "-4" ]; then
+    echo "default via 192.0.2.1 dev eth0 proto dhcp"
+    exit 0
+fi
+case " $* " in
+    *" -batch "*) cat >> {state}/ip.log ;;
+    *) echo "$*" >> {state}/ip.log ;;
+esac
+"""
+
+
+class MockVPN:
+    """Mock openvpn and ip binaries plus ``count`` VPN configs in a scratch directory.
+
+    :meth:`exit_ip` reports the remote of the tunnel that the logged route
+    changes send traffic through, or ``direct_ip`` without one.
+    """
+
+    def __init__(self, count: int = 2, connect_delay: float = 0.3, direct_ip: str = '203.0.113.1'):
+        self.state = tempfile.mkdtemp(prefix='ip-phantom-vpn-')
+        self.direct_ip = direct_ip
+        self.openvpn = self._script('openvpn', MOCK_OPENVPN.format(delay=connect_delay, state=self.state))
+        self.ip = self._script('ip', MOCK_IP.format(state=self.state))
+        self.configs = []
+        for n in range(count):
+            path = os.path.join(self.state, f'server{n}.ovpn')
+            with open(path, 'w') as f:
+                f.write(f"client\ndev tun\nremote 198.51.100.{n + 1} 1194\n")
+            self.configs.append({'name': f'vpn{n}', 'config_file': path})
+
+    def _script(self, name: str, text: str) -> str:
+        path = os.path.join(self.state, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        os.chmod(path, 0o755)
+        return path
+
+    def exit_ip(self) -> str:
+        device = None
+        with contextlib.suppress(FileNotFoundError), open(os.path.join(self.state, 'ip.log')) as f:
+            for line in f:
+                words = line.split()
+                if words[1:3] == ['replace', '0.0.0.0/1']:
+                    device = words[-1]
+                elif words[1:3] == ['del', '0.0.0.0/1']:
+                    device = None
+        if device is None:
+            return self.direct_ip
+        with open(os.path.join(self.state, device)) as f:
+            return f.read().strip()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.state, ignore_errors=True)
+
+
+class FakeOpenVPNServer:
+    """Answers OpenVPN client hard resets over UDP with a server hard reset."""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def _serve(self):
+        while True:
+            try:
+                data, peer = self.sock.recvfrom(2048)
+            except OSError:
+                return  # Closed
+            if data and data[0] >> 3 == 7:
+                self.sock.sendto(bytes([8 << 3]) + os.urandom(8) + bytes(5), peer)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.sock.close()
+
+
+def _closed_port(kind: int = socket.SOCK_STREAM) -> int:
+    """A loopback port nothing listens on."""
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeSocksHandler(socketserver.BaseRequestHandler):
+    """Minimal SOCKS5 server: no-auth or username/password, CONNECT only."""
+
+    def handle(self):
+        try:
+            self._handle()
+        except ConnectionError:
+            pass  # Port probes (TorInstance.is_running) hang up right away
+
+    def _handle(self):
+        client = self.request
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        _, count = self._recv(2)
+        methods = self._recv(count)
+        username = ''
+        if 2 in methods:
+            client.sendall(b'\x05\x02')
+            _, user_len = self._recv(2)
+            username = self._recv(user_len).decode()
+            self._recv(self._recv(1)[0])
+            client.sendall(b'\x01\x00')
+            self.server.usernames.append(username)
+        else:
+            client.sendall(b'\x05\x00')
+
+        _, _, _, address_type = self._recv(4)
+        if address_type == 3:
+            host = self._recv(self._recv(1)[0]).decode()
+        else:
+            host = socket.inet_ntoa(self._recv(4))
+        port = int.from_bytes(self._recv(2), 'big')
+        try:
+            upstream = socket.create_connection((host, port), timeout=10)
+        except OSError:
+            client.sendall(b'\x05\x05\x00\x01' + bytes(6))
+            return
+        upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        local = upstream.getsockname()
+        if self.server.exit_for:
+            self.server.peer_exits[local] = self.server.exit_for(username)
+        client.sendall(b'\x05\x00\x00\x01' + bytes(6))
+        try:
+            with upstream:
+                _relay(client, upstream)
+        finally:
+            self.server.peer_exits.pop(local, None)
+
+    def _recv(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("client went away")
+            data += chunk
+        return data
+
+
+def _relay(a: socket.socket, b: socket.socket):
+    peers = {a: b, b: a}
+    while True:
+        readable, _, _ = select.select(list(peers), [], [], 30)
+        if not readable:
+            return
+        for sock in readable:
+            data = sock.recv(65536)
+            if not data:
+                return
+            peers[sock].sendall(data)
+
+
+class FakeSocksServer:
+    """A local SOCKS5 proxy running in a background thread.
+
+    With ``exit_for`` (username -> exit IP) every relayed connection's exit
+    IP is registered in ``peer_exits`` for a :class:`FakeEchoServer`.
+    """
+
+    def __init__(self, exit_for: Optional[Callable[[str], str]] = None,
+                 peer_exits: Optional[Dict] = None):
+        self.server = _ThreadingServer(('127.0.0.1', 0), FakeSocksHandler)
+        self.server.usernames = []
+        self.server.exit_for = exit_for
+        self.server.peer_exits = peer_exits if peer_exits is not None else {}
+        self.port = self.server.server_address[1]
+        self.address = ('127.0.0.1', self.port)
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _TCPEchoHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        sock = self.request
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                sock.sendall(data)
+        except OSError:
+            pass
+
+
+class TCPEchoServer:
+    """A local TCP echo service running in a background thread."""
+
+    def __init__(self):
+        self.server = _ThreadingServer(('127.0.0.1', 0), _TCPEchoHandler)
+        self.server.request_queue_size = 4096
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@contextlib.contextmanager
+def _front_proxy(zero_copy: bool = True):
+    """A front proxy on its own event loop thread.
+
+    Its upstream is a second front proxy that connects directly, standing
+    in for Tor's SocksPort, so both hops are measured without Tor.
+    """
+    loop = asyncio.new_event_loop()
+    tor = FrontProxy(lambda key: (None, None), port=0, zero_copy=zero_copy)
+    front = FrontProxy(lambda key: (('127.0.0.1', tor.port), None), port=0, zero_copy=zero_copy)
+    tasks = []
+
+    def run():
+        asyncio.set_event_loop(loop)
+        tasks.extend(loop.create_task(proxy.serve()) for proxy in (tor, front))
+        loop.run_forever()
+
+    async def stop():
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    for proxy in (tor, front):
+        proxy.listen()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        yield front
+    finally:
+        asyncio.run_coroutine_threadsafe(stop(), loop).result(30)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+class FakeTorNetwork:
+    """Fake control port, SOCKS5 proxy and IP-echo service wired together.
+
+    Like Tor, every NEWNYM and every distinct SOCKS username gets a new exit
+    IP, which the echo service reports for connections relayed by the proxy.
+    """
+
+    def __init__(self, latency: float = 0.0, build_delay: float = 0.0,
+                 newnym_interval: float = 0.0, failure_rate: float = 0.0, exit_pool: int = 0,
+                 slow_exits: float = 0.0, slow_latency: float = 0.3):
+        self.control = FakeControlPort(latency=latency, build_delay=build_delay,
+                                       newnym_interval=newnym_interval, exit_pool=exit_pool)
+        self.echo = FakeEchoServer(latency=latency, failure_rate=failure_rate,
+                                   slow_exits=slow_exits, slow_latency=slow_latency)
+        self.socks = FakeSocksServer(exit_for=self.control.server.exit_for,
+                                     peer_exits=self.echo.server.peer_exits)
+
+    def instance(self, data_dir: str) -> TorInstance:
+        """A TorInstance pointing at this network's ports."""
+        return TorInstance('fake-tor', self.socks.port, self.control.port, '', data_dir)
+
+    def __enter__(self):
+        for server in (self.control, self.echo, self.socks):
+            server.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        for server in (self.socks, self.echo, self.control):
+            server.__exit__(*exc)
+
+
+@contextlib.contextmanager
+def _phantom(config: Dict):
+    """Create an IPPhantom in a scratch directory with the given config."""
+    workdir = tempfile.mkdtemp(prefix='ip-phantom-bench-')
+    previous = os.getcwd()
+    try:
+        os.chdir(workdir)
+        with open('config.json', 'w') as f:
+            # Fake control ports only rate limit NEWNYM when asked to
+            json.dump({'newnym_interval': 0, **config}, f)
+        phantom = IPPhantom(config_file='config.json')
+        phantom.logger.setLevel(logging.WARNING)
+        yield phantom
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _cpu_seconds() -> float:
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+def _summarize(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        'mean': statistics.mean(ordered) * 1000,
+        'p50': ordered[len(ordered) // 2] * 1000,
+        'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        'p99': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+    }
+
+
+def _time(func: Callable[[], None], rounds: int) -> Dict[str, float]:
+    samples = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return _summarize(samples)
+
+
+def _report(name: str, stats: Dict[str, float]):
+    safe_print(f"  {name:<28} mean {stats['mean']:7.3f} ms   p50 {stats['p50']:7.3f} ms   "
+               f"p95 {stats['p95']:7.3f} ms   p99 {stats['p99']:7.3f} ms")
+
+
+def bench_control_port(rounds: int = 500, latency: float = 0.0):
+    """Compare reconnect-per-rotation against the persistent controller."""
+    with FakeControlPort(latency=latency) as fake:
+        def reconnect_per_call():
+            # Mirrors the old renew_tor_circuit: connect, authenticate, signal, close
+            with socket.create_connection(('127.0.0.1', fake.port), timeout=10) as sock:
+                sock.sendall(b'AUTHENTICATE\r\n')
+                sock.recv(1024)
+                sock.sendall(b'SIGNAL NEWNYM\r\n')
+                sock.recv(1024)
+
+        controller = TorController(port=fake.port, cookie_path='')
+        persistent = lambda: controller.execute('SIGNAL NEWNYM')
+        pipelined = lambda: controller.execute_many(
+            ['SIGNAL NEWNYM', 'GETINFO status/circuit-established'])
+
+        safe_print(f"📊 Control port latency ({rounds} rounds, "
+                   f"{latency * 1000:.1f} ms injected server latency)")
+        _report('reconnect per rotation', _time(reconnect_per_call, rounds))
+        _report('persistent controller', _time(persistent, rounds))
+        _report('pipelined NEWNYM+GETINFO', _time(pipelined, rounds))
+        safe_print(f"  persistent controller connected {controller.connects} time(s)")
+        controller.close()
+
+
+def bench_ip_lookup(rounds: int = 500, latency: float = 0.0):
+    """Compare per-lookup latency and CPU of the native client against curl."""
+    with FakeEchoServer(latency=latency) as echo, FakeSocksServer() as socks:
+        client = HTTPClient()
+        backends = {
+            'native': lambda proxy: client.get(echo.url, proxy=proxy),
+        }
+        if shutil.which('curl'):
+            def curl(proxy):
+                cmd = ['curl', '-s', '--connect-timeout', '10']
+                if proxy:
+                    cmd += ['--socks5-hostname', f'{proxy[0]}:{proxy[1]}']
+                subprocess.run(cmd + [echo.url], capture_output=True, check=True)
+            backends['curl'] = curl
+        else:
+            safe_print("  (curl not found - skipping the curl backend)")
+
+        safe_print(f"📊 IP lookup latency ({rounds} rounds)")
+        for route, proxy in (('direct', None), ('via SOCKS5', socks.address)):
+            for name, fetch in backends.items():
+                cpu_start = _cpu_seconds()
+                stats = _time(lambda: fetch(proxy), rounds)
+                cpu_ms = (_cpu_seconds() - cpu_start) / rounds * 1000
+                _report(f'{name} {route}', stats)
+                safe_print(f"  {'':<28} cpu  {cpu_ms:7.3f} ms/lookup")
+        client.close_idle()
+
+
+def bench_circuit_renewal(rounds: int = 500, latency: float = 0.0,
+                          build_delay: float = 0.25):
+    """Time renew_tor_circuit against a fake control port that emits CIRC events."""
+    rounds = min(rounds, 20)
+    with FakeControlPort(latency=latency, build_delay=build_delay) as fake, \
+            _phantom({'circuit_wait_timeout': 3.0}) as phantom:
+        phantom.active_tor.controller = TorController(port=fake.port, cookie_path='')
+
+        safe_print(f"📊 Circuit renewal ({rounds} rounds, fake circuit build {build_delay * 1000:.0f} ms)")
+        safe_print(f"  {'fixed sleeps (previous)':<28} mean {5000:7.3f} ms")
+        _report('event-driven', _time(phantom.renew_tor_circuit, rounds))
+
+        # A rate-limited NEWNYM must wait for the delayed circuit, not give up
+        fake.server.newnym_interval = 2.0
+        phantom.renew_tor_circuit()
+        start = time.perf_counter()
+        phantom.renew_tor_circuit()
+        safe_print(f"  {'rate-limited NEWNYM':<28} took {(time.perf_counter() - start) * 1000:7.3f} ms "
+                   f"(Tor delay 2 s + build)")
+
+
+def bench_rotation_engine(rounds: int = 500, latency: float = 0.0,
+                          rotation_time: float = 0.05, interval: int = 1):
+    """Measure schedule drift of the asyncio engine and its health-check latency."""
+    rounds = min(rounds, 5)
+    with FakeControlPort(latency=latency) as fake, FakeEchoServer(latency=latency) as echo, \
+            FakeSocksServer() as socks, _phantom({'ip_services': [echo.url]}) as phantom:
+        phantom.interval = interval
+        phantom.active_tor.controller = TorController(port=fake.port, cookie_path='')
+        phantom.active_tor.socks = socks.address
+        starts = []
+
+        def rotate_ip():
+            starts.append(time.monotonic())
+            time.sleep(rotation_time)
+            if len(starts) > rounds:
+                phantom.running = False
+            return True
+        phantom.rotate_ip = rotate_ip
+
+        engine = AsyncRotationEngine(phantom, health_interval=0)
+        asyncio.run(engine.run())
+        drift = (starts[-1] - starts[0]) - interval * (len(starts) - 1)
+
+        async def health_checks():
+            checker = AsyncRotationEngine(phantom, health_interval=0)
+            samples = []
+            for _ in range(50):
+                start = time.perf_counter()
+                assert await checker.check_health()
+                samples.append(time.perf_counter() - start)
+            await checker.http.aclose()
+            for controller in checker.controllers.values():
+                await controller.close()
+            return samples
+
+        safe_print(f"📊 Rotation engine ({len(starts)} rotations of {rotation_time * 1000:.0f} ms, "
+                   f"interval {interval} s)")
+        safe_print(f"  {'blocking loop (previous)':<28} drift {rotation_time * (len(starts) - 1) * 1000:7.3f} ms")
+        safe_print(f"  {'asyncio engine':<28} drift {drift * 1000:7.3f} ms")
+        _report('async health check', _summarize(asyncio.run(health_checks())))
+
+
+def bench_rotations(rounds: int = 500, latency: float = 0.0, build_delay: float = 0.05,
+                    failure_rate: float = 0.0, exit_pool: int = 0):
+    """Drive IPPhantom.rotate_ip end to end against a fake Tor network."""
+    rounds = min(rounds, 200)
+    pool = f", {exit_pool} exits" if exit_pool else ""
+    safe_print(f"📊 Rotations ({rounds} per mode, fake circuit build {build_delay * 1000:.0f} ms, "
+               f"{failure_rate:.0%} injected lookup failures{pool})")
+    modes = (('renew', {}), ('diverse exits', {'exit_selection': 'diverse'}),
+             ('prewarmed', {'prewarm_depth': 3}),
+             ('local exit check', {'exit_selection': 'diverse', 'exit_verification': 'local'}))
+    for mode, config in modes:
+        with FakeTorNetwork(latency=latency, build_delay=build_delay,
+                            failure_rate=failure_rate, exit_pool=exit_pool) as network, \
+                _phantom({'ip_services': [network.echo.url, network.echo.url + '?alt'],
+                          **config}) as phantom:
+            phantom.tor_instances = [network.instance(os.getcwd())]
+            phantom.active_tor = phantom.tor_instances[0]
+            phantom.relay_cache_file = None
+            samples = []
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):  # Per-rotation "IP changed" lines
+                for _ in range(rounds):
+                    rotation_start = time.perf_counter()
+                    phantom.rotate_ip()
+                    samples.append(time.perf_counter() - rotation_start)
+                elapsed = time.perf_counter() - start
+                phantom.stop_tor()
+
+            outcomes = {labels[0][1]: int(count) for (name, labels), count
+                        in phantom.metrics.counters.items() if name == 'ip_phantom_rotations_total'}
+            repeats = int(phantom.metrics.counters.get(('ip_phantom_exit_repeats_total', ()), 0))
+            _report(mode, _summarize(samples))
+            safe_print(f"  {'':<28} {rounds / elapsed * 60:9.0f} rotations/min   "
+                       + '   '.join(f'{outcome} {count}' for outcome, count in sorted(outcomes.items()))
+                       + f'   repeated exits retried {repeats}')
+            phases = ', '.join(f"{labels[0][1]} {values[-2] / values[-1] * 1000:.2f}"
+                               for (name, labels), values in phantom.metrics.histograms.items()
+                               if name == 'ip_phantom_phase_seconds')
+            if phases:
+                safe_print(f"  {'':<28} phase means (ms): {phases}")
+
+
+def bench_circuit_probe(rounds: int = 500, latency: float = 0.0, build_delay: float = 0.05,
+                        exit_pool: int = 0, slow_exits: float = 0.3, slow_latency: float = 0.3):
+    """Rotation time against steady-state TTFB, with and without circuit probing."""
+    rounds = min(rounds, 100)
+    safe_print(f"📊 Circuit probing ({rounds} rotations per mode, {slow_exits:.0%} of exits "
+               f"{slow_latency * 1000:.0f} ms slower)")
+    modes = (('no probing', {}), ('probing, max TTFB 100 ms', {'circuit_max_ttfb': 0.1}),
+             ('probing, diverse exits', {'circuit_max_ttfb': 0.1, 'exit_selection': 'diverse'}))
+    for mode, config in modes:
+        with FakeTorNetwork(latency=latency, build_delay=build_delay, exit_pool=exit_pool,
+                            slow_exits=slow_exits, slow_latency=slow_latency) as network, \
+                _phantom({'ip_services': [network.echo.url], 'exit_history_size': 0,
+                          **config}) as phantom:
+            phantom.tor_instances = [network.instance(os.getcwd())]
+            phantom.active_tor = phantom.tor_instances[0]
+            phantom.relay_cache_file = None
+            rotations, ttfb = [], []
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(rounds):
+                    start = time.perf_counter()
+                    phantom.rotate_ip()
+                    rotations.append(time.perf_counter() - start)
+                    # What traffic sees on the chosen circuit until the next rotation
+                    for _ in range(5):
+                        start = time.perf_counter()
+                        phantom.http_client.get(network.echo.url, proxy=phantom.tor_socks,
+                                                proxy_auth=phantom.tor_socks_auth)
+                        ttfb.append(time.perf_counter() - start)
+                phantom.stop_tor()
+            rejected = sum(count for (name, _), count in phantom.metrics.counters.items()
+                           if name == 'ip_phantom_circuit_rejections_total')
+            _report(f'{mode}: rotation', _summarize(rotations))
+            _report(f'{mode}: TTFB after', _summarize(ttfb))
+            safe_print(f"  {'':<28} {int(rejected)} circuits rejected, "
+                       f"{len(phantom.exit_scores or ())} exits scored")
+
+
+def bench_newnym(rounds: int = 500, latency: float = 0.0, build_delay: float = 0.05):
+    """Rotate faster than Tor's NEWNYM rate limit, with and without tracking it."""
+    rounds = min(rounds, 12)
+    limit, interval = 2.0, 0.5
+    safe_print(f"📊 NEWNYM rate limit ({rounds} rotations every {interval:.1f} s, "
+               f"fake Tor accepts one NEWNYM per {limit:.0f} s)")
+    for mode, tracked in (('blind signals (previous)', 0.0), ('tracked and coalesced', limit)):
+        with FakeTorNetwork(latency=latency, build_delay=build_delay,
+                            newnym_interval=limit) as network, \
+                _phantom({'ip_services': [network.echo.url], 'exit_history_size': 0,
+                          'circuit_wait_timeout': 0.5, 'newnym_interval': tracked}) as phantom:
+            phantom.tor_instances = [network.instance(os.getcwd())]
+            phantom.active_tor = phantom.tor_instances[0]
+            samples = []
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for _ in range(rounds):
+                    rotation_start = time.perf_counter()
+                    phantom.rotate_ip()
+                    samples.append(time.perf_counter() - rotation_start)
+                    time.sleep(interval)
+                elapsed = time.perf_counter() - start
+                phantom.stop_tor()
+            outcomes = {labels[0][1]: int(count) for (name, labels), count
+                        in phantom.metrics.counters.items() if name == 'ip_phantom_rotations_total'}
+            signals = network.control.server.signals.count('NEWNYM')
+            _report(mode, _summarize(samples))
+            safe_print(f"  {'':<28} {signals} NEWNYMs sent in {elapsed:.1f} s   "
+                       + '   '.join(f'{outcome} {count}' for outcome, count in sorted(outcomes.items())))
+
+
+def bench_endpoint_probes(rounds: int = 500, latency: float = 0.0, count: int = 2000):
+    """Probe thousands of proxies and VPN servers, a quarter of them down."""
+    vpn_count = count // 10
+    safe_print(f"📊 Endpoint health probes ({count - vpn_count} SOCKS5 proxies and {vpn_count} "
+               f"OpenVPN servers, a quarter down)")
+    with FakeEchoServer(latency=latency) as echo, FakeOpenVPNServer() as openvpn, \
+            contextlib.ExitStack() as stack:
+        proxies = [stack.enter_context(FakeSocksServer(exit_for=lambda username, n=n: f'198.51.100.{n + 1}',
+                                                       peer_exits=echo.server.peer_exits))
+                   for n in range(3)]
+        dead_tcp, dead_udp = _closed_port(), _closed_port(socket.SOCK_DGRAM)
+        proxy_configs = [{'name': f'proxy{n}', 'host': '127.0.0.1',
+                          'port': dead_tcp if n % 4 == 3 else proxies[n % 3].port}
+                         for n in range(count - vpn_count)]
+        with _phantom({'ip_services': [echo.url], 'rotation_method': 'mixed', 'tor_fallback': False,
+                       'proxy_configs': proxy_configs}) as phantom:
+            vpn_configs = []
+            for n in range(vpn_count):
+                path = os.path.abspath(f'server{n}.ovpn')
+                with open(path, 'w') as f:
+                    f.write(f"client\nproto udp\nremote 127.0.0.1 "
+                            f"{dead_udp if n % 4 == 3 else openvpn.port}\n")
+                vpn_configs.append({'name': f'vpn{n}', 'config_file': path, 'enabled': True})
+            phantom.vpn_configs = vpn_configs
+            phantom._load_endpoints()
+            health = phantom.endpoint_health
+
+            for concurrency, rate in ((50, 500), (200, 5000)):
+                health.results.clear()
+                health._ranked = None
+                prober = EndpointProber(health, echo.url, interval=3600, concurrency=concurrency,
+                                        rate=rate, timeout=2.0)
+
+                async def first_pass():
+                    task = asyncio.ensure_future(prober.run())
+                    while health.summary()['unprobed'] and not task.done():
+                        await asyncio.sleep(0.01)
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
+                start = time.perf_counter()
+                asyncio.run(first_pass())
+                elapsed = time.perf_counter() - start
+                summary = health.summary()
+                safe_print(f"  {f'concurrency {concurrency}, {rate}/s':<28} first pass {elapsed:6.2f} s   "
+                           f"{prober.probes / elapsed:7.0f} probes/s   usable {summary['usable']}   "
+                           f"failing {summary['failing']}")
+
+            def rerank():
+                health._ranked = None
+                health.ranked()
+            _report(f'rank {count} endpoints', _time(rerank, min(rounds, 100)))
+            picks = [phantom._next_endpoint() for _ in range(min(rounds, 200))]
+            good = sum(1 for endpoint in picks if (health.stats(endpoint) or (0, None, False))[2])
+            safe_print(f"  {'':<28} {good}/{len(picks)} rotations picked an endpoint that is up, "
+                       f"{len({endpoint['name'] for endpoint in picks})} distinct")
+
+
+def bench_vpn(rounds: int = 500, latency: float = 0.0, connect_delay: float = 0.3):
+    """Rotate through VPN tunnels (mock openvpn) and SOCKS proxies.
+
+    The outage is the time traffic has no working route: stopping the old
+    tunnel before starting the next (as the previous connect_vpn did, plus
+    its fixed 7 s of sleeps) against switching to a warm standby.
+    """
+    rounds = min(rounds, 10)
+    safe_print(f"📊 VPN/proxy rotation ({rounds} rotations per mode, mock tunnels connect "
+               f"in {connect_delay * 1000:.0f} ms)")
+    modes = (('stop, then connect', 'vpn', True), ('warm standby (vpn)', 'vpn', False),
+             ('warm standby (mixed)', 'mixed', False))
+    for mode, method, cold in modes:
+        with MockVPN(connect_delay=connect_delay) as vpn, \
+                FakeEchoServer(exit_ip=vpn.exit_ip, latency=latency) as echo, \
+                FakeSocksServer(exit_for=lambda username: '198.51.100.101',
+                                peer_exits=echo.server.peer_exits) as proxy1, \
+                FakeSocksServer(exit_for=lambda username: '198.51.100.102',
+                                peer_exits=echo.server.peer_exits) as proxy2, \
+                _phantom({'ip_services': [echo.url], 'rotation_method': method, 'tor_fallback': False,
+                          'vpn_configs': vpn.configs, 'openvpn_binary': vpn.openvpn,
+                          'proxy_configs': [{'name': f'proxy{n}', 'host': '127.0.0.1', 'port': port}
+                                            for n, port in enumerate((proxy1.port, proxy2.port))]}) as phantom:
+            phantom.ip_binary = vpn.ip
+            phantom.vpn_sudo = False
+            outages = []
+            switch = phantom.switch_endpoint
+
+            def timed_switch(prepared):
+                start = time.perf_counter()
+                try:
+                    return switch(prepared)
+                finally:
+                    outages.append(time.perf_counter() - start)
+            with contextlib.redirect_stdout(io.StringIO()):
+                if cold:
+                    for _ in range(rounds):
+                        start = time.perf_counter()
+                        phantom.disconnect_current_vpn()
+                        phantom.switch_endpoint(phantom._prepare_endpoint(phantom._next_endpoint()))
+                        outages.append(time.perf_counter() - start)
+                else:
+                    phantom.switch_endpoint = timed_switch
+                    phantom._prepare_next()
+                    for _ in range(rounds):
+                        time.sleep(connect_delay * 1.5)  # The rotation interval
+                        phantom.rotate_ip()
+                phantom._close_endpoints()
+            outcomes = {labels[0][1]: int(count) for (name, labels), count
+                        in phantom.metrics.counters.items() if name == 'ip_phantom_rotations_total'}
+            _report(mode, _summarize(outages))
+            if outcomes:
+                safe_print(f"  {'':<28} "
+                           + '   '.join(f'{outcome} {count}' for outcome, count in sorted(outcomes.items())))
+
+
+def bench_front_proxy(rounds: int = 500, latency: float = 0.0):
+    """Relay through the front proxy on loopback: setup latency, concurrency, throughput."""
+    payload = os.urandom(1024)
+    streams = min(rounds * 2, 2000)
+
+    def echo_once(sock: socket.socket):
+        sock.sendall(payload)
+        received = 0
+        while received < len(payload):
+            received += len(sock.recv(65536))
+
+    with TCPEchoServer() as echo:
+        safe_print(f"📊 Front proxy (two SOCKS5 hops on loopback, {len(payload)} B echo)")
+
+        def direct():
+            with socket.create_connection(('127.0.0.1', echo.port)) as sock:
+                echo_once(sock)
+
+        _report('direct connect + echo', _time(direct, rounds))
+        with _front_proxy() as front:
+            def proxied():
+                with socks5_connect(('127.0.0.1', front.port), '127.0.0.1', echo.port) as sock:
+                    echo_once(sock)
+
+            _report('front proxy connect + echo', _time(proxied, rounds))
+
+            start = time.perf_counter()
+            sockets = [socks5_connect(('127.0.0.1', front.port), '127.0.0.1', echo.port)
+                       for _ in range(streams)]
+            opened = time.perf_counter() - start
+            start = time.perf_counter()
+            for sock in sockets:
+                sock.sendall(payload)
+            for sock in sockets:
+                received = 0
+                while received < len(payload):
+                    received += len(sock.recv(65536))
+            echoed = time.perf_counter() - start
+            for sock in sockets:
+                sock.close()
+            safe_print(f"  {streams} concurrent streams      open {opened * 1000:7.1f} ms   "
+                       f"echo on all {echoed * 1000:7.1f} ms")
+
+        total = 64 * 1024 * 1024
+        chunk = bytes(1 << 16)
+        for name, zero_copy in (('splice(2)', True), ('recv_into/sendall', False)):
+            with _front_proxy(zero_copy=zero_copy) as front:
+                sock = socks5_connect(('127.0.0.1', front.port), '127.0.0.1', echo.port, timeout=30)
+
+                def send():
+                    for _ in range(total // len(chunk)):
+                        sock.sendall(chunk)
+                    sock.shutdown(socket.SHUT_WR)
+
+                cpu = _cpu_seconds()
+                start = time.perf_counter()
+                sender = threading.Thread(target=send)
+                sender.start()
+                received = 0
+                while received < total:
+                    data = sock.recv(1 << 20)
+                    if not data:
+                        break
+                    received += len(data)
+                sender.join()
+                elapsed = time.perf_counter() - start
+                cpu = _cpu_seconds() - cpu
+                sock.close()
+            safe_print(f"  {name:<28} {received / elapsed / 1e6:7.0f} MB/s echoed   "
+                       f"CPU {cpu / elapsed * 100:5.0f}%")
+
+    # Per-client circuits: 50000 clients cycling through a 10000-entry table
+    clients = ClientTable(capacity=10000, interval=60)
+    keys = [f'client-{i}' for i in range(50000)]
+    lookups = iter(range(10 ** 9))
+    _report('client table lookup (LRU)',
+            _time(lambda: clients.credentials(keys[next(lookups) % len(keys)]), rounds * 100))
+
+
+def bench_scheduler(rounds: int = 500, latency: float = 0.0, duration: float = 3.0):
+    """Run per-client rotation schedules on one event loop and measure their lateness."""
+    clients = rounds
+    policy = RotationPolicy(0.5, jitter=0.2)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        expected = {}
+        lateness = []
+
+        async def rotate(key, reason):
+            lateness.append(loop.time() - expected.pop(key))
+            await asyncio.sleep(latency)
+            return True
+
+        scheduler = RotationScheduler(rotate, policy)
+        scheduler.on_rescheduled = lambda key, delay: expected.__setitem__(key, loop.time() + delay)
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(0)
+        for i in range(clients):
+            delay = policy.delay()
+            expected[f'client-{i}'] = loop.time() + delay
+            scheduler.add(f'client-{i}', delay=delay)
+        cpu = _cpu_seconds()
+        await asyncio.sleep(duration)
+        cpu = _cpu_seconds() - cpu
+        scheduler.stop()
+        await task
+        return lateness, cpu
+
+    lateness, cpu = asyncio.run(run())
+    safe_print(f"📊 Rotation scheduler ({clients} clients every {policy.interval:.1f} s "
+               f"± {policy.jitter:.0%}, {duration:.0f} s)")
+    _report('rotation lateness', _summarize(lateness))
+    safe_print(f"  {'':<28} {len(lateness)} rotations   CPU {cpu / duration * 100:5.1f}%")
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """``http.client`` connection over a Unix domain socket."""
+
+    def __init__(self, path: str, timeout: float = 10.0):
+        super().__init__('localhost', timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def bench_control_api(rounds: int = 500, latency: float = 0.0,
+                      rotation_time: float = 0.05, clients: int = 20):
+    """Measure control API latency and whether a burst of calls delays rotations."""
+    with _phantom({'api_socket': 'api.sock'}) as phantom:
+        phantom.interval = 1
+        phantom.demo_mode = True
+        starts = []
+
+        def rotate_ip():
+            starts.append(time.monotonic())
+            time.sleep(rotation_time + latency)
+            return True
+        phantom.rotate_ip = rotate_ip
+
+        status, rotate, burst = [], [], []
+
+        def call(connection, method, target, samples):
+            start = time.perf_counter()
+            connection.request(method, target)
+            response = connection.getresponse()
+            response.read()
+            samples.append(time.perf_counter() - start)
+            assert response.status == 200, response.status
+
+        def drive():
+            while not (os.path.exists('api.sock') and starts):
+                time.sleep(0.01)
+            connection = _UnixHTTPConnection('api.sock')
+            for _ in range(rounds):
+                call(connection, 'GET', '/status', status)
+            for _ in range(5):
+                call(connection, 'POST', '/rotate?wait=1', rotate)
+
+            deadline = time.monotonic() + 3.5  # A few scheduled rotations under load
+
+            def hammer():
+                own = _UnixHTTPConnection('api.sock')
+                while time.monotonic() < deadline:
+                    call(own, 'GET', '/status', burst)
+                own.close()
+            threads = [threading.Thread(target=hammer) for _ in range(clients)]
+            burst_start = len(starts)
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            connection.close()
+            phantom.running = False
+            return burst_start
+
+        result = {}
+        driver = threading.Thread(target=lambda: result.update(burst_start=drive()), daemon=True)
+        driver.start()
+        engine = AsyncRotationEngine(phantom, health_interval=0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(engine.run())
+        driver.join()
+
+        gaps = [b - a for a, b in zip(starts[result['burst_start']:], starts[result['burst_start'] + 1:])]
+        safe_print(f"📊 Control API over a Unix socket ({rounds} requests, then {len(burst)} "
+                   f"from {clients} clients at once)")
+        _report('GET /status', _summarize(status))
+        _report('POST /rotate?wait=1', _summarize(rotate))
+        _report(f'GET /status x{clients} clients', _summarize(burst))
+        if gaps:
+            _report('rotation period during burst', _summarize(gaps))
+
+
+class _SlowStream(io.StringIO):
+    """A console that takes ``delay`` seconds per write, like a stalled terminal or pipe."""
+
+    def __init__(self, delay: float):
+        super().__init__()
+        self.delay = delay
+
+    def write(self, text: str) -> int:
+        time.sleep(self.delay)
+        return len(text)
+
+
+def bench_logging(rounds: int = 500, latency: float = 0.0):
+    """Time logger.info on the calling thread, and check the disk bound."""
+    rounds = max(rounds, 2000)
+    safe_print(f"📊 Logging ({rounds} records per mode; the slow console takes 1 ms per write)")
+    workdir = tempfile.mkdtemp(prefix='ip-phantom-bench-')
+    try:
+        for console_delay in (0.0, 0.001):
+            for mode in ('file + console (previous)', 'queue + writer thread'):
+                logger = logging.Logger(f'bench-{mode}')
+                console = SafeStreamHandler(_SlowStream(console_delay))
+                path = os.path.join(workdir, f'{len(os.listdir(workdir))}.log')
+                writer = None
+                if mode.startswith('queue'):
+                    writer = LogWriter([console, RotatingLogHandler(path, 16 * 1024, 3)])
+                    writer.start()
+                    logger.addHandler(LogQueueHandler(writer))
+                else:
+                    logger.addHandler(logging.FileHandler(path))
+                    logger.addHandler(console)
+                counter = iter(range(rounds))
+                stats = _time(lambda: logger.info(f"👻 IP changed via Tor: 10.0.0.1 → 10.0.{next(counter)}.2"),
+                              rounds)
+                start = time.perf_counter()
+                if writer:
+                    writer.stop()
+                drained = time.perf_counter() - start
+                label = mode if not console_delay else f"{mode.split(' ')[0]}, slow console"
+                _report(label, stats)
+                if writer:
+                    on_disk = sum(os.path.getsize(os.path.join(workdir, name))
+                                  for name in os.listdir(workdir) if name.startswith(os.path.basename(path)))
+                    safe_print(f"  {'':<28} writer drained {drained * 1000:.0f} ms after the last call, "
+                               f"{on_disk / 1024:.0f} KiB on disk (cap {4 * 16} KiB)")
+                for handler in logger.handlers:
+                    handler.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_metrics(rounds: int = 500, latency: float = 0.0):
+    """Measure the cost of recording one rotation's metrics and event."""
+    rounds = rounds * 20
+    workdir = tempfile.mkdtemp(prefix='ip-phantom-bench-')
+    safe_print(f"📊 Metrics overhead per rotation ({rounds} rounds)")
+    try:
+        for name, metrics in (('in-memory', Metrics()),
+                              ('with JSON-lines events', Metrics(os.path.join(workdir, 'events.jsonl')))):
+            def record_rotation():
+                metrics.rotation_started()
+                for phase in ('tor_ready', 'pre_ip_lookup', 'newnym', 'circuit_settle', 'post_ip_lookup'):
+                    with metrics.phase(phase):
+                        pass
+                metrics.inc('ip_phantom_ip_service_requests_total', service='bench', result='ok')
+                metrics.annotate(path='renew', old_ip='203.0.113.1', new_ip='203.0.113.2')
+                metrics.rotation_finished(True)
+            _report(name, _time(record_rotation, rounds))
+            metrics.close()
+        _report('render /metrics', _time(metrics.render, 100))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_history(rounds: int = 500, latency: float = 0.0, count: int = 1000000):
+    """Time recording a rotation and the --history queries over a week of rotations."""
+    workdir = tempfile.mkdtemp(prefix='ip-phantom-bench-')
+    path = os.path.join(workdir, 'history.db')
+    history = RotationHistory(path)
+    safe_print(f"📊 Rotation history ({count} rotations over 7 days)")
+    try:
+        rng = random.Random(25)
+        now = time.time()
+        start = time.perf_counter()
+        with contextlib.closing(history._connect()) as conn:
+            for first in range(0, count, 10000):
+                batch = []
+                for n in range(first, min(first + 10000, count)):
+                    address = _fake_exit_address(rng.randrange(20000))
+                    batch.append({'ts': now - 7 * 86400 * (1 - n / count), 'backend': 'tor',
+                                  'old_ip': _fake_exit_address(n), 'new_ip': address,
+                                  'exit': _fake_fingerprint(n).hex(), 'country': _fake_country(address),
+                                  'seconds': rng.lognormvariate(0, 0.6),
+                                  'outcome': 'success' if rng.random() < 0.97 else 'failure',
+                                  'phases': {'newnym': 0.01, 'post_ip_lookup': 0.2}})
+                RotationHistory.write(conn, batch)
+        safe_print(f"  {'fill':<28} {(time.perf_counter() - start) / count * 1e6:.1f} µs per rotation, "
+                   f"{os.path.getsize(path) / count:.0f} bytes per rotation on disk")
+
+        record = {'ts': now, 'backend': 'tor', 'outcome': 'success', 'seconds': 1.2,
+                  'phases': {'newnym': 0.01}, 'new_ip': '10.0.0.1'}
+        _report('add() on the rotation thread', _time(lambda: history.add(dict(record)), rounds * 20))
+        history.pending.clear()
+
+        since = now - 86400
+        _report('summary (24h)', _time(lambda: history.summary(since), 10))
+        _report('latency by country (24h)', _time(lambda: history.latency_by_country(since), 10))
+        _report('latency by country (7d)', _time(lambda: history.latency_by_country(now - 7 * 86400), 10))
+        _report('recent', _time(history.recent, 10))
+
+        def raw_scan():
+            with contextlib.closing(sqlite3.connect(path)) as conn:
+                samples = {}
+                for country, seconds in conn.execute(
+                        "SELECT country, seconds FROM rotations WHERE ts >= ? AND outcome = 'success'",
+                        (since,)):
+                    samples.setdefault(country, []).append(seconds)
+            return {country: sorted(values)[int(0.95 * len(values))] for country, values in samples.items()}
+        _report('raw row scan (previous)', _time(raw_scan, 3))
+        exact = raw_scan()
+        error = max(abs(p95 / exact[country] - 1) for country, _, _, p95 in history.latency_by_country(since))
+        safe_print(f"  {'':<28} p95 within {error:.1%} of the exact value")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+BENCHMARKS = {
+    'api': bench_control_api,
+    'circuit': bench_circuit_renewal,
+    'control': bench_control_port,
+    'endpoints': bench_endpoint_probes,
+    'engine': bench_rotation_engine,
+    'history': bench_history,
+    'logging': bench_logging,
+    'lookup': bench_ip_lookup,
+    'metrics': bench_metrics,
+    'newnym': bench_newnym,
+    'probe': bench_circuit_probe,
+    'proxy': bench_front_proxy,
+    'rotation': bench_rotations,
+    'scheduler': bench_scheduler,
+    'vpn': bench_vpn,
+}
+
+
+def main(argv: Optional[List[str]] = None):
+    """Run the selected benchmarks."""
+    parser = argparse.ArgumentParser(description="IP Phantom local benchmarks")
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help=f"Benchmarks to run: {', '.join(sorted(BENCHMARKS))} (default: all)")
+    parser.add_argument('--rounds', '-n', type=int, default=500,
+                        help='Iterations per measurement (default: 500)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Injected fake-server latency in seconds (default: 0)')
+    parser.add_argument('--build-delay', type=float,
+                        help='Fake circuit build time in seconds (default: per benchmark)')
+    parser.add_argument('--failure-rate', type=float,
+                        help='Share of fake IP lookups that fail with HTTP 503 (default: 0)')
+    parser.add_argument('--exit-pool', type=int,
+                        help='Draw fake exit IPs from this many addresses so they repeat (default: unique)')
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+
+    options = {'rounds': args.rounds, 'latency': args.latency,
+               'build_delay': args.build_delay, 'failure_rate': args.failure_rate,
+               'exit_pool': args.exit_pool}
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        benchmark = BENCHMARKS[name]
+        accepted = inspect.signature(benchmark).parameters
+        benchmark(**{key: value for key, value in options.items()
+                     if key in accepted and value is not None})
+
+
+if __name__ == "__main__":
+    main()